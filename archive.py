@@ -0,0 +1,41 @@
+"""Background archival of old paid invoices (hot/cold split) for PayTrackBot"""
+import asyncio
+import logging
+import time
+from datetime import date
+from typing import Dict
+import config
+import async_db as adb
+
+logger = logging.getLogger(__name__)
+
+async def archive_paid_invoices(bot=None, older_than_days: int = None, batch_size: int = None,
+                                today: date = None) -> Dict:
+    """Scheduler job: move paid invoices older than ARCHIVE_AFTER_DAYS to invoices_archive,
+    one batch per writer-thread transaction with a pause in between, so bot commands
+    queued behind the archiver wait for at most one batch"""
+    batch_size = batch_size or config.ARCHIVE_BATCH_SIZE
+    start = time.perf_counter()
+    moved = batches = 0
+
+    while True:
+        count = await adb.archive_paid_invoices(older_than_days, batch_size, today)
+        moved += count
+        batches += 1 if count else 0
+        if count < batch_size:
+            break
+        await asyncio.sleep(config.ARCHIVE_BATCH_PAUSE)
+
+    seconds = time.perf_counter() - start
+    logger.info(f"✅ Archived {moved} paid invoices in {batches} batches ({seconds:.1f}s)")
+    return {'archived': moved, 'batches': batches, 'seconds': seconds}
+
+def run_archival():
+    """Archive once, outside the bot (manual runs / cron). The bot schedules this itself"""
+    try:
+        return asyncio.run(archive_paid_invoices())
+    finally:
+        adb.close_db()
+
+if __name__ == '__main__':
+    run_archival()
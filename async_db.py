@@ -0,0 +1,121 @@
+"""Non-blocking database access for PayTrackBot handlers (mirrors database.py)"""
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import config
+import database as db
+import export
+import importer
+
+# Reads run on a bounded pool (WAL lets them overlap a writer); writes are
+# queued on a single thread so SQLite never has two writers contending.
+_lock = threading.Lock()
+_read_executor = None
+_write_executor = None
+
+def _executors():
+    """Create the reader pool and writer queue on first use"""
+    global _read_executor, _write_executor
+
+    with _lock:
+        if _read_executor is None:
+            _read_executor = ThreadPoolExecutor(
+                max_workers=config.DB_READ_WORKERS,
+                thread_name_prefix='db-read'
+            )
+            _write_executor = ThreadPoolExecutor(
+                max_workers=1,
+                thread_name_prefix='db-write'
+            )
+        return _read_executor, _write_executor
+
+def _run_on(index: int, fn):
+    """Wrap a blocking database function as a coroutine on one of the executors"""
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        executor = _executors()[index]
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+    return wrapper
+
+def _reader(fn):
+    return _run_on(0, fn)
+
+def _writer(fn):
+    return _run_on(1, fn)
+
+# Reads
+get_user = _reader(db.get_user)
+get_unpaid_invoices = _reader(db.get_unpaid_invoices)
+get_all_invoices = _reader(db.get_all_invoices)
+get_unpaid_invoices_page = _reader(db.get_unpaid_invoices_page)
+get_invoices_page = _reader(db.get_invoices_page)
+get_invoice = _reader(db.get_invoice)
+count_unpaid_invoices = _reader(db.count_unpaid_invoices)
+get_revenue_stats = _reader(db.get_revenue_stats)
+check_user_stats = _reader(db.check_user_stats)
+get_reminder_invoices = _reader(db.get_reminder_invoices)
+get_pending_reminder_cohorts = _reader(db.get_pending_reminder_cohorts)
+get_weekly_summaries = _reader(db.get_weekly_summaries)
+get_conversation_states = _reader(db.get_conversation_states)
+get_conversation_user_data = _reader(db.get_conversation_user_data)
+export_invoices = _reader(export.export_invoices)  # streams rows into a spooled file
+
+# Writes (serialized on the single writer thread)
+create_user = _writer(db.create_user)
+get_or_create_user = _writer(db.get_or_create_user)
+create_invoice = _writer(db.create_invoice)
+mark_invoice_paid = _writer(db.mark_invoice_paid)
+mark_invoices_paid = _writer(db.mark_invoices_paid)
+delete_invoice = _writer(db.delete_invoice)
+update_user_subscription = _writer(db.update_user_subscription)
+update_user_timezone = _writer(db.update_user_timezone)
+rebuild_user_stats = _writer(db.rebuild_user_stats)
+log_reminder = _writer(db.log_reminder)
+log_reminders = _writer(db.log_reminders)
+start_reminder_run = _writer(db.start_reminder_run)
+finish_reminder_run = _writer(db.finish_reminder_run)
+record_reminder_run_users = _writer(db.record_reminder_run_users)
+advance_reminders = _writer(db.advance_reminders)
+archive_paid_invoices = _writer(db.archive_paid_invoices)  # one batch per call
+prune_reminders = _writer(db.prune_reminders)  # one batch per call
+incremental_vacuum = _writer(db.incremental_vacuum)
+claim_job_run = _writer(db.claim_job_run)
+finish_job_run = _writer(db.finish_job_run)
+save_conversation_state = _writer(db.save_conversation_state)
+create_invoices = _writer(db.create_invoices)
+
+async def import_invoices(user_id: int, fileobj, max_unpaid: int = None, chunk_size: int = None):
+    """importer.import_invoices without tying up the writer: the CSV is decoded and validated
+    on the reader pool, and each chunk is its own create_invoices call on the writer queue,
+    so other users' writes run in between"""
+    report = importer.new_report()
+    chunks = importer.read_chunks(fileobj, report, chunk_size)
+    next_chunk = _reader(functools.partial(next, chunks, None))
+    try:
+        while (chunk := await next_chunk()) is not None:
+            inserted = 0
+            if not importer.skip_chunk(report, max_unpaid):
+                inserted = await create_invoices(user_id, chunk, max_unpaid)
+            importer.record_chunk(report, len(chunk), inserted)
+    finally:
+        chunks.close()
+    return importer.finish_report(report)
+
+# In-memory only, so no executor needed
+user_cache_stats = db.user_cache_stats
+
+def close_db():
+    """Drain pending queries, stop the executors and close all connections"""
+    global _read_executor, _write_executor
+
+    with _lock:
+        executors = (_read_executor, _write_executor)
+        _read_executor = _write_executor = None
+
+    for executor in executors:
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    db.close_db()
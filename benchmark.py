@@ -0,0 +1,838 @@
+"""Microbenchmarks for PayTrackBot
+
+Usage: python benchmark.py [name ...]   (no names = run all)
+"""
+import asyncio
+import json
+import logging
+import os
+import socket
+import sys
+import sqlite3
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+import config
+import database as db
+from connection import transaction
+
+def _temp_db(name: str) -> str:
+    """Point config.DB_PATH at a fresh database in a temp dir"""
+    path = os.path.join(tempfile.mkdtemp(prefix='paytrack-bench-'), name)
+    config.DB_PATH = path
+    db.init_db()
+    return path
+
+def _per_call_us(fn, iterations: int) -> float:
+    """Average microseconds per call of fn()"""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+def bench_connection(iterations: int = 2000):
+    """Per-call latency: connect-per-call (old) vs pooled connection (new), plus a user cache hit"""
+    path = _temp_db('connection.db')
+    db.create_user(1, 'bench', 'Bench')
+    due = date.today() + timedelta(days=7)
+
+    # Baseline: what every database.py function used to do
+    def legacy_get_user():
+        conn = sqlite3.connect(path)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM users WHERE telegram_id = ?', (1,))
+        row = cursor.fetchone()
+        conn.close()
+        return dict(row) if row else None
+
+    def legacy_create_invoice():
+        conn = sqlite3.connect(path)
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO invoices (user_id, client_name, amount, currency, due_date, notes)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (1, 'Client', 100.0, 'USD', due, None))
+        conn.commit()
+        conn.close()
+
+    def pooled_get_user():
+        db.user_cache.invalidate(1)  # measure the query, not a user cache hit
+        return db.get_user(1)
+
+    results = [
+        ('get_user (connect per call)', _per_call_us(legacy_get_user, iterations)),
+        ('get_user (pooled)', _per_call_us(pooled_get_user, iterations)),
+        ('get_user (user cache hit)', _per_call_us(lambda: db.get_user(1), iterations)),
+        ('create_invoice (connect per call)', _per_call_us(legacy_create_invoice, iterations)),
+        ('create_invoice (pooled)',
+         _per_call_us(lambda: db.create_invoice(1, 'Client', 100.0, due), iterations)),
+    ]
+
+    print(f"\nConnection layer ({iterations} calls each)")
+    for label, us in results:
+        print(f"  {label:<36} {us:8.1f} us/call")
+
+    db.close_db()
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+class FakeBotAPI:
+    """Minimal local stand-in for api.telegram.org (getMe, getUpdates, sendMessage, webhooks)"""
+
+    def __init__(self, latency: float = 0):
+        self.latency = latency  # simulated round trip for sendMessage
+        self.pending = []  # updates waiting for getUpdates
+        self.replies = 0
+        self.done = asyncio.Event()
+        self.expected = 0
+        self.port = _free_port()
+
+    def make_update(self, update_id: int, text: str, chat_id: int) -> dict:
+        command = text.split()[0]
+        return {
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': {'id': chat_id, 'is_bot': False, 'first_name': f'User{chat_id}'},
+                'text': text,
+                'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+                            if command.startswith('/') else [],
+            }
+        }
+
+    def result(self, method: str, params: dict):
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        if method == 'getUpdates':
+            batch, self.pending = self.pending[:100], self.pending[100:]
+            return batch
+        if method == 'sendMessage':
+            self.replies += 1
+            if self.replies >= self.expected:
+                self.done.set()
+            chat_id = int(params.get('chat_id', 0))
+            return {'message_id': self.replies, 'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': 'private'}, 'text': params.get('text', '')}
+        return True  # setWebhook, deleteWebhook, ...
+
+    def start(self):
+        import tornado.web
+        api = self
+
+        class Handler(tornado.web.RequestHandler):
+            async def post(self, method):
+                params = {k: self.get_body_argument(k) for k in self.request.body_arguments}
+                if method == 'getUpdates' and not api.pending:
+                    await asyncio.sleep(0.05)  # short long-poll
+                elif method == 'sendMessage' and api.latency:
+                    await asyncio.sleep(api.latency)
+                self.write(json.dumps({'ok': True, 'result': api.result(method, params)}))
+
+        self._server = tornado.web.Application([(r'/bot[^/]+/(\w+)', Handler)]).listen(
+            self.port, address='127.0.0.1')
+
+    def stop(self):
+        self._server.stop()
+
+async def _measure_mode(mode: str, updates: int, workers: int) -> float:
+    """Push `updates` /help commands through a real Application in the given mode; returns updates/s"""
+    import httpx
+    from telegram.ext import Application
+    from update_processor import BoundedUpdateQueue
+    import bot
+
+    api = FakeBotAPI()
+    api.expected = updates
+    api.start()
+
+    app = (
+        Application.builder()
+        .token('123:bench')
+        .base_url(f'http://127.0.0.1:{api.port}/bot')
+        .update_queue(BoundedUpdateQueue(config.UPDATE_QUEUE_SIZE, config.UPDATE_QUEUE_SIZE))
+        .concurrent_updates(workers)
+        .build()
+    )
+    bot.register_handlers(app)
+    await app.initialize()
+
+    batch = [api.make_update(i + 1, '/help', 1000 + i % 50) for i in range(updates)]
+    start = time.perf_counter()
+
+    if mode == 'polling':
+        api.pending = batch
+        await app.updater.start_polling(poll_interval=0, timeout=1,
+                                        allowed_updates=config.ALLOWED_UPDATES)
+        await app.start()
+    else:
+        port, secret = _free_port(), 'bench-secret'
+        await app.updater.start_webhook(
+            listen='127.0.0.1', port=port, url_path='telegram',
+            webhook_url=f'http://127.0.0.1:{port}/telegram', secret_token=secret,
+            allowed_updates=config.ALLOWED_UPDATES)
+        await app.start()
+        url = f'http://127.0.0.1:{port}/telegram'
+        # Telegram keeps at most max_connections webhook requests open at once
+        connections = asyncio.Semaphore(config.WEBHOOK_MAX_CONNECTIONS)
+        
+        async def push(client, update):
+            async with connections:
+                response = await client.post(
+                    url, json=update, headers={'X-Telegram-Bot-Api-Secret-Token': secret})
+                response.raise_for_status()
+
+        async with httpx.AsyncClient(timeout=60) as client:
+            bad = await client.post(url, json=batch[0],
+                                    headers={'X-Telegram-Bot-Api-Secret-Token': 'wrong'})
+            assert bad.status_code == 403, "webhook accepted a wrong secret token"
+            start = time.perf_counter()
+            await asyncio.gather(*[push(client, update) for update in batch])
+
+    await asyncio.wait_for(api.done.wait(), timeout=120)
+    elapsed = time.perf_counter() - start
+
+    await app.updater.stop()
+    await app.stop()
+    await app.shutdown()
+    api.stop()
+    return updates / elapsed
+
+def bench_update_modes(updates: int = 1000):
+    """Local load test: updates/s sustained by long polling vs webhook mode.
+    The bot, fake API and webhook client share one process, so this compares
+    per-update overhead; network round trips to Telegram are not modelled."""
+    import bot  # configures logging; keep per-request access logs out of the timing
+    logging.getLogger().setLevel(logging.WARNING)
+
+    print(f"\nUpdate delivery ({updates} /help updates through a local fake Bot API)")
+    for workers in (1, 8):
+        for mode in ('polling', 'webhook'):
+            rate = asyncio.run(_measure_mode(mode, updates, workers))
+            print(f"  {mode:<8} workers={workers:<3} {rate:8.0f} updates/s")
+
+def _percentile(values, pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+async def _replay_mixed_stream(processor, chats: int, rate: float, latency: float):
+    """Replay a mixed command stream into an Application; returns (latencies, invoices created, expected)"""
+    import random
+    from telegram import Update
+    from telegram.ext import Application, TypeHandler
+    import bot
+
+    scripts = [
+        ['/help'], ['/list'], ['/stats'], ['/all'], ['/account'],
+        ['/new', 'Bench Client', '250', '7d', '/skip'],
+    ]
+    rng = random.Random(42)
+    chat_scripts = {1000 + i: rng.choice(scripts) + rng.choice(scripts) for i in range(chats)}
+    for chat_id in chat_scripts:
+        db.get_or_create_user(chat_id, f'user{chat_id}', 'Bench')
+    expected = sum(script.count('/new') for script in chat_scripts.values())
+
+    # Interleave chats randomly while keeping each chat's own messages in order
+    cursors = {chat_id: 0 for chat_id in chat_scripts}
+    stream = []
+    while cursors:
+        chat_id = rng.choice(list(cursors))
+        stream.append((chat_id, chat_scripts[chat_id][cursors[chat_id]]))
+        cursors[chat_id] += 1
+        if cursors[chat_id] == len(chat_scripts[chat_id]):
+            del cursors[chat_id]
+
+    api = FakeBotAPI(latency=latency)
+    api.start()
+    app = (
+        Application.builder()
+        .token('123:bench')
+        .base_url(f'http://127.0.0.1:{api.port}/bot')
+        .concurrent_updates(processor)
+        .build()
+    )
+    bot.register_handlers(app)
+
+    received, finished = {}, {}
+    async def record_done(update, context):
+        finished[update.update_id] = time.perf_counter()
+    app.add_handler(TypeHandler(Update, record_done), group=99)
+
+    await app.initialize()
+    await app.start()
+    for update_id, (chat_id, text) in enumerate(stream, start=1):
+        update = Update.de_json(api.make_update(update_id, text, chat_id), app.bot)
+        received[update_id] = time.perf_counter()
+        await app.update_queue.put(update)
+        await asyncio.sleep(1 / rate)
+    while len(finished) < len(stream):
+        await asyncio.sleep(0.01)
+    await app.stop()
+    await app.shutdown()
+    api.stop()
+
+    with transaction() as cursor:
+        cursor.execute("SELECT COUNT(*) FROM invoices WHERE client_name = 'Bench Client'")
+        created = cursor.fetchone()[0]
+        cursor.execute("DELETE FROM invoices WHERE client_name = 'Bench Client'")
+    latencies = [finished[i] - received[i] for i in received]
+    return latencies, created, expected
+
+def bench_update_latency(chats: int = 300, rate: float = 300, latency: float = 0.02):
+    """p50/p99 handler latency for a synthetic mixed-command stream, per update processor"""
+    from telegram.ext import SimpleUpdateProcessor
+    from update_processor import PerChatUpdateProcessor
+    import bot  # configures logging
+    logging.getLogger().setLevel(logging.WARNING)
+
+    _temp_db('latency.db')
+    processors = [
+        ('sequential', lambda: SimpleUpdateProcessor(1)),
+        (f'concurrent ({config.UPDATE_WORKERS}, unordered)',
+         lambda: SimpleUpdateProcessor(config.UPDATE_WORKERS)),
+        (f'per-chat ordered ({config.UPDATE_WORKERS})',
+         lambda: PerChatUpdateProcessor(config.UPDATE_WORKERS, max_pending=config.UPDATE_QUEUE_SIZE)),
+    ]
+
+    print(f"\nHandler latency ({chats} chats, {rate:.0f} updates/s arriving, "
+          f"{latency * 1000:.0f} ms simulated Telegram round trip)")
+    for label, make_processor in processors:
+        latencies, created, expected = asyncio.run(
+            _replay_mixed_stream(make_processor(), chats, rate, latency))
+        print(f"  {label:<30} p50 {_percentile(latencies, 50) * 1000:7.1f} ms   "
+              f"p99 {_percentile(latencies, 99) * 1000:7.1f} ms   "
+              f"/new flows completed {created}/{expected}")
+
+    db.close_db()
+
+def _rss_mb() -> float:
+    """Current anonymous resident memory (Linux /proc). File-backed pages such as
+    SQLite's mmap window are left out: the kernel can drop those at any time"""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('RssAnon:'):
+                return int(line.split()[1]) / 1024
+    raise RuntimeError("RssAnon not available")
+
+def _peak_rss_during(fn):
+    """Run fn() while sampling RssAnon; returns (result, peak growth in MB, seconds)"""
+    import threading
+    baseline = peak = _rss_mb()
+    stop = threading.Event()
+    
+    def sample():
+        nonlocal peak
+        while not stop.is_set():
+            peak = max(peak, _rss_mb())
+            stop.wait(0.005)
+    
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    start = time.perf_counter()
+    try:
+        result = fn()
+    finally:
+        elapsed = time.perf_counter() - start
+        stop.set()
+        sampler.join()
+    return result, max(peak, _rss_mb()) - baseline, elapsed
+
+def bench_export(rows: int = 1_000_000, ceiling_mb: float = 32):
+    """Export `rows` synthetic invoices and assert the streaming path's RSS growth stays flat"""
+    import export
+    _temp_db('export.db')
+    db.create_user(1, 'bench', 'Bench')
+    db.update_user_subscription(1, config.TIER_PRO)
+    
+    start = time.perf_counter()
+    base = date.today()
+    with transaction() as cursor:
+        cursor.executemany('''
+            INSERT INTO invoices (user_id, client_name, amount, due_date, status, notes)
+            VALUES (1, ?, ?, ?, ?, ?)
+        ''', ((f'Client {i % 5000}', 100 + i % 900, base + timedelta(days=i % 400 - 200),
+               'paid' if i % 3 == 0 else 'unpaid', 'Net 30' if i % 2 else None)
+              for i in range(rows)))
+    print(f"\nExport ({rows} invoices, seeded in {time.perf_counter() - start:.1f}s)")
+    
+    def run(fmt):
+        # No size cap: this measures streaming the whole export
+        document, count = export.export_invoices(1, fmt, max_bytes=sys.maxsize)
+        size = export.file_size(document)
+        document.close()
+        return count, size
+    
+    for fmt in export.FORMATS:
+        (count, size), growth, elapsed = _peak_rss_during(lambda: run(fmt))
+        assert count == rows
+        print(f"  streaming {fmt:<4} {elapsed:6.1f}s  {count / elapsed:9.0f} rows/s  "
+              f"{size / 2**20:6.1f} MB file  peak RSS +{growth:6.1f} MB")
+        assert growth < ceiling_mb, f"{fmt} export grew RSS by {growth:.1f} MB (ceiling {ceiling_mb} MB)"
+    
+    # For comparison: what a fetchall() + in-memory render would cost
+    def naive():
+        rows = db.get_connection().execute(
+            f"SELECT {', '.join(db.EXPORT_COLUMNS)} FROM invoices WHERE user_id = 1").fetchall()
+        return len(json.dumps([dict(zip(db.EXPORT_COLUMNS, row)) for row in rows]))
+    _, growth, elapsed = _peak_rss_during(naive)
+    print(f"  fetchall + render {elapsed:6.1f}s  peak RSS +{growth:6.1f} MB  (not streamed)")
+    
+    db.close_db()
+
+def bench_import(rows: int = 100_000, baseline_rows: int = 5000):
+    """CSV import throughput: chunked executemany vs one create_invoice per row"""
+    import io
+    import importer
+    _temp_db('import.db')
+    db.create_user(1, 'bench', 'Bench')
+    
+    lines = ['client_name,amount,due_date,currency,notes']
+    lines.extend(f'Client {i},{100 + i % 900},{i % 90}d,USD,Net 30' for i in range(rows))
+    data = '\n'.join(lines).encode()
+    
+    print(f"\nImport ({rows} CSV rows, {len(data) / 2**20:.1f} MB)")
+    for chunk_size in (100, config.IMPORT_CHUNK_SIZE, 5000):
+        result = importer.import_invoices(1, io.BytesIO(data), chunk_size=chunk_size)
+        assert result['imported'] == rows and not result['error_count']
+        print(f"  chunk={chunk_size:<5} {result['seconds']:6.2f}s  {result['rows_per_sec']:9.0f} rows/s")
+    
+    due = date.today()
+    start = time.perf_counter()
+    for i in range(baseline_rows):
+        db.create_invoice(1, f'Client {i}', 100, due, notes='Net 30')
+    elapsed = time.perf_counter() - start
+    print(f"  create_invoice per row ({baseline_rows} rows)  {baseline_rows / elapsed:9.0f} rows/s")
+    
+    db.close_db()
+
+def bench_buckets(rows: int = 1_000_000):
+    """Classify `rows` unpaid invoices into due-date buckets: per-row Python date math vs SQL"""
+    import dates
+    _temp_db('buckets.db')
+    db.create_user(1, 'bench', 'Bench')
+    today = date.today()
+    with transaction() as cursor:
+        cursor.executemany('''
+            INSERT INTO invoices (user_id, client_name, amount, due_date) VALUES (1, 'Client', 100, ?)
+        ''', ((today + timedelta(days=i % 60 - 30),) for i in range(rows)))
+    conn = db.get_connection()
+    
+    def python_strptime():
+        rows = conn.execute("SELECT id, due_date FROM invoices WHERE status = 'unpaid'").fetchall()
+        counts = dict.fromkeys(dates.BUCKETS, 0)
+        for row in rows:
+            days = (datetime.strptime(row['due_date'], '%Y-%m-%d').date() - today).days
+            counts[dates.classify(days)] += 1
+        return counts
+    
+    def python_fromisoformat():
+        rows = conn.execute("SELECT id, due_date FROM invoices WHERE status = 'unpaid'").fetchall()
+        counts = dict.fromkeys(dates.BUCKETS, 0)
+        for row in rows:
+            counts[dates.classify((date.fromisoformat(row['due_date']) - today).days)] += 1
+        return counts
+    
+    def sql_columns():
+        rows = conn.execute(f'''
+            SELECT id, {dates.bucket_sql(dates.days_until_sql())} AS bucket
+            FROM invoices WHERE status = 'unpaid'
+        ''', {'today': today}).fetchall()
+        groups = dates.group_by_bucket(rows)
+        return {bucket: len(members) for bucket, members in groups.items()}
+    
+    def sql_grouped():
+        counts = dict.fromkeys(dates.BUCKETS, 0)
+        counts.update(conn.execute(f'''
+            SELECT {dates.bucket_sql(dates.days_until_sql())} AS bucket, COUNT(*)
+            FROM invoices WHERE status = 'unpaid' GROUP BY bucket
+        ''', {'today': today}).fetchall())
+        return counts
+    
+    print(f"\nDue-date buckets ({rows} unpaid invoices)")
+    expected = None
+    for label, fn in (('strptime per row', python_strptime),
+                      ('fromisoformat per row', python_fromisoformat),
+                      ('SQL days_until/bucket', sql_columns),
+                      ('SQL bucket counts', sql_grouped)):
+        start = time.perf_counter()
+        counts = fn()
+        elapsed = time.perf_counter() - start
+        expected = expected or counts
+        assert counts == expected, f"{label} disagrees: {counts} != {expected}"
+        print(f"  {label:<24} {elapsed:6.2f}s  {rows / elapsed:10.0f} invoices/s")
+    
+    db.close_db()
+
+def bench_render(users: int = 2000, invoices_per_user: int = 200):
+    """Render daily reminders for users with large invoice lists: per-line f-strings
+    (unescaped and unbounded, or escaped and split line by line) vs render.daily_reminder"""
+    import dates
+    import render
+    groups = []
+    for user in range(users):
+        invoices = [{'id': user * invoices_per_user + i, 'client_name': f"Client_{i} [{user}]",
+                     'amount': 100.0 + i, 'days_until': i % 12 - 4}
+                    for i in range(invoices_per_user)]
+        for inv in invoices:
+            inv['bucket'] = dates.classify(inv['days_until'])
+        groups.append(dates.group_by_bucket(invoices))
+    
+    def fstrings(buckets):
+        # The pre-render.py message builder (unescaped, never split)
+        msg_parts = []
+        if buckets[dates.OVERDUE]:
+            msg_parts.append("⚠️ **OVERDUE INVOICES:**")
+            for inv in buckets[dates.OVERDUE]:
+                msg_parts.append(f"• #{inv['id']} {inv['client_name']} - "
+                                 f"${inv['amount']:.2f} ({-inv['days_until']} days overdue)")
+        for bucket, heading in ((dates.DUE_TODAY, "\n🔴 **DUE TODAY:**"),
+                                (dates.DUE_TOMORROW, "\n🟡 **DUE TOMORROW:**")):
+            if buckets[bucket]:
+                msg_parts.append(heading)
+                for inv in buckets[bucket]:
+                    msg_parts.append(f"• #{inv['id']} {inv['client_name']} - ${inv['amount']:.2f}")
+        if buckets[dates.DUE_SOON]:
+            msg_parts.append("\n📅 **Coming up soon:**")
+            for inv in buckets[dates.DUE_SOON]:
+                msg_parts.append(f"• #{inv['id']} {inv['client_name']} - "
+                                 f"${inv['amount']:.2f} (in {inv['days_until']} days)")
+        msg_parts.insert(0, "📊 **Daily Invoice Reminder**\n")
+        msg_parts.append("\nUse /paid <id> to mark as paid!")
+        return ['\n'.join(msg_parts)]
+    
+    escapes = str.maketrans({'_': '\\_', '*': '\\*', '`': '\\`', '[': '\\['})
+    
+    def fstrings_split(buckets):
+        # The same, made correct the obvious way: escape and measure every line
+        msg_parts, size = [[]], 0
+        for line in fstrings({bucket: [{**inv, 'client_name': inv['client_name'].translate(escapes)}
+                                       for inv in invoices]
+                              for bucket, invoices in buckets.items()})[0].split('\n'):
+            line_size = render.length(line) + 1
+            if size + line_size > render.MAX_MESSAGE_LENGTH:
+                msg_parts.append([])
+                size = 0
+            msg_parts[-1].append(line)
+            size += line_size
+        return ['\n'.join(part) for part in msg_parts]
+    
+    def packed(buckets):
+        return render.daily_reminder(buckets)[0]
+    
+    lines = users * invoices_per_user
+    print(f"\nReminder rendering ({users} users x {invoices_per_user} invoices)")
+    for label, fn in (('f-strings, one message', fstrings),
+                      ('f-strings, escape + split', fstrings_split),
+                      ('render.daily_reminder', packed)):
+        start = time.perf_counter()
+        messages = [part for buckets in groups for part in fn(buckets)]
+        elapsed = time.perf_counter() - start
+        too_long = sum(render.length(text) > render.MAX_MESSAGE_LENGTH for text in messages)
+        print(f"  {label:<26} {elapsed:6.2f}s  {lines / elapsed:10.0f} lines/s  "
+              f"{len(messages)} messages, {too_long} over the limit")
+
+class NullBot:
+    """Accepts send_message and does nothing (isolates query + render + dispatch overhead)"""
+    def __init__(self):
+        self.sent = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent += 1
+
+def bench_weekly(users: int = 100_000, invoices_per_user: int = 5):
+    """send_weekly_summary runtime as the Pro user count grows, vs one query per user"""
+    import reminders
+    _temp_db('weekly.db')
+    # Telegram's limits would dominate; lift them to time our own pipeline
+    config.TELEGRAM_GLOBAL_RATE = config.TELEGRAM_PER_CHAT_RATE = 1e9
+    config.TELEGRAM_MAX_IN_FLIGHT = 1000
+    today = date.today()
+    
+    def seed(first: int, last: int):
+        with transaction() as cursor:
+            cursor.executemany('''
+                INSERT INTO users (telegram_id, first_name, subscription_tier) VALUES (?, 'Bench', ?)
+            ''', ((uid, config.TIER_PRO) for uid in range(first, last)))
+            cursor.executemany('''
+                INSERT INTO invoices (user_id, client_name, amount, due_date, status, paid_date)
+                VALUES (?, 'Client', ?, ?, ?, ?)
+            ''', ((uid, 100 + n, today + timedelta(days=n * 7 - 14),
+                   'paid' if n == 0 else 'unpaid', today - timedelta(days=2) if n == 0 else None)
+                  for uid in range(first, last) for n in range(invoices_per_user)))
+    
+    def grouped_queries():
+        after, count = 0, 0
+        while True:
+            batch = db.get_weekly_summaries(today - timedelta(days=7), today, after)
+            if not batch:
+                return count
+            count += len(batch)
+            after = batch[-1]['user_id']
+    
+    def per_user_queries():
+        conn = db.get_connection()
+        pro = [row[0] for row in conn.execute(
+            'SELECT telegram_id FROM users WHERE subscription_tier = ?', (config.TIER_PRO,))]
+        for uid in pro:
+            conn.execute('''
+                SELECT SUM(CASE WHEN status = 'paid' AND paid_date >= ? THEN amount END),
+                       SUM(CASE WHEN status = 'unpaid' THEN amount END),
+                       SUM(CASE WHEN status = 'unpaid' AND due_date < ? THEN amount END)
+                FROM invoices WHERE user_id = ?
+            ''', (today - timedelta(days=7), today, uid)).fetchone()
+        return len(pro)
+    
+    print(f"\nWeekly summary ({invoices_per_user} invoices per Pro user, no send rate limit)")
+    seeded = 0
+    for target in (users // 10, users // 2, users):
+        seed(seeded + 1, target + 1)
+        seeded = target
+        
+        bot = NullBot()
+        start = time.perf_counter()
+        sent = asyncio.run(reminders.send_weekly_summary(bot, today))
+        pipeline = time.perf_counter() - start
+        assert sent == bot.sent == target
+        
+        timings = []
+        for fn in (grouped_queries, per_user_queries):
+            start = time.perf_counter()
+            assert fn() == target
+            timings.append(time.perf_counter() - start)
+        print(f"  {target:>7} users  full pipeline {pipeline:6.2f}s ({pipeline / target * 1e6:5.1f} us/user)"
+              f"  queries: grouped {timings[0]:5.2f}s, one per user {timings[1]:5.2f}s")
+    
+    db.close_db()
+
+def bench_schedule(users: int = 10_000, invoices_per_user: int = 100, days: int = 8):
+    """Daily reminder reads over a week: scanning every unpaid invoice due by the horizon
+    (old query) vs the next_reminder_at range, with overdue reminders backing off"""
+    import dates
+    _temp_db('schedule.db')
+    config.OVERDUE_REMINDER_INTERVALS = [(0, 1), (7, 3), (30, 7)]
+    today = date.today()
+    with transaction() as cursor:
+        cursor.executemany('''
+            INSERT INTO users (telegram_id, first_name, subscription_tier) VALUES (?, 'Bench', ?)
+        ''', ((uid, config.TIER_PRO) for uid in range(1, users + 1)))
+        # Due dates spread over a year back and a year ahead
+        cursor.executemany(db._INSERT_INVOICE, (
+            {'user_id': uid, 'client_name': 'Client', 'amount': 100, 'currency': 'USD',
+             'due_date': today + timedelta(days=(uid * 7 + n * 13) % 730 - 365), 'notes': None,
+             'scheduled_from': today - timedelta(days=2)}
+            for uid in range(1, users + 1) for n in range(invoices_per_user)
+        ))
+        # The index the old query ran on
+        cursor.execute('CREATE INDEX idx_invoices_tz_status_due ON invoices (tz_offset, status, due_date)')
+    conn = db.get_connection()
+    
+    def horizon_scan(day):
+        return conn.execute(f'''
+            SELECT *, {dates.bucket_sql()} AS bucket FROM (
+                SELECT i.*, {dates.days_until_sql(column='i.due_date')} AS days_until
+                FROM invoices i JOIN users u ON u.telegram_id = i.user_id
+                WHERE i.tz_offset = 0 AND i.status = 'unpaid' AND i.due_date <= :horizon
+                AND u.subscription_tier = :tier
+            ) WHERE days_until != 2 ORDER BY user_id, due_date, id
+        ''', {'today': day, 'horizon': day + timedelta(days=dates.SOON_DAYS),
+              'tier': config.TIER_PRO}).fetchall()
+    
+    print(f"\nReminder reads per daily run ({users * invoices_per_user} unpaid invoices, "
+          f"overdue policy {config.OVERDUE_REMINDER_INTERVALS})")
+    for offset in range(days):
+        day = today + timedelta(days=offset)
+        start = time.perf_counter()
+        scanned = len(horizon_scan(day))
+        scan_time = time.perf_counter() - start
+        
+        start = time.perf_counter()
+        run = db.start_reminder_run(day)
+        due = sum(len(invoices) for _, invoices in db.get_reminder_invoices(day, run['id']))
+        read_time = time.perf_counter() - start
+        start = time.perf_counter()
+        advanced = db.advance_reminders(run['id'], day)
+        db.finish_reminder_run(run['id'])
+        advance_time = time.perf_counter() - start
+        print(f"  day {offset}: horizon scan {scanned:>7} rows {scan_time:5.2f}s  |  "
+              f"next_reminder_at {due:>7} rows {read_time:5.2f}s + reschedule {advanced:>7} {advance_time:5.2f}s")
+    
+    db.close_db()
+
+def bench_paid(invoices: int = 20_000, concurrency: int = 100):
+    """Concurrent /paid throughput: get_invoice + mark_invoice_paid (two round trips, old
+    handler) vs one ownership-checked UPDATE ... RETURNING, and how often a raced invoice
+    is reported paid twice"""
+    import async_db as adb
+    _temp_db('paid.db')
+    db.create_user(1, 'bench', 'Bench')
+    
+    def seed():
+        with transaction() as cursor:
+            cursor.execute('DELETE FROM invoices')
+            cursor.executemany('''
+                INSERT INTO invoices (user_id, client_name, amount, due_date) VALUES (1, 'Client', 100, ?)
+            ''', ((date.today(),) for _ in range(invoices)))
+        return [row[0] for row in db.get_connection().execute('SELECT id FROM invoices')]
+    
+    async def read_then_update(invoice_id):
+        invoice = await adb.get_invoice(invoice_id)
+        if not invoice or invoice['user_id'] != 1 or invoice['status'] == 'paid':
+            return False
+        await adb.mark_invoice_paid(invoice_id, 1)
+        return True
+    
+    async def conditional_update(invoice_id):
+        return await adb.mark_invoice_paid(invoice_id, 1) is not None
+    
+    async def load(handler, ids):
+        # Each id is paid twice (a double-tapped command), `concurrency` commands at a time
+        semaphore = asyncio.Semaphore(concurrency)
+        async def command(invoice_id):
+            async with semaphore:
+                return await handler(invoice_id)
+        start = time.perf_counter()
+        results = await asyncio.gather(*[command(i) for i in ids for _ in range(2)])
+        return time.perf_counter() - start, sum(results)
+    
+    print(f"\n/paid under load ({invoices} invoices, each paid twice, {concurrency} concurrent)")
+    for label, handler in (('get_invoice + UPDATE', read_then_update),
+                           ('UPDATE ... RETURNING', conditional_update)):
+        ids = seed()
+        elapsed, succeeded = asyncio.run(load(handler, ids))
+        adb.close_db()
+        print(f"  {label:<22} {elapsed:6.2f}s  {2 * invoices / elapsed:8.0f} commands/s  "
+              f"{succeeded - invoices} double 'paid' replies")
+    
+    db.close_db()
+
+def bench_archive(users: int = 2000, invoices_per_user: int = 250, paid_share: float = 0.9):
+    """Hot/cold split: archival throughput and the longest single batch (how long other
+    writers wait), and per-user reads before vs after paid history leaves invoices"""
+    import random
+    _temp_db('archive.db')
+    today = date.today()
+    rng = random.Random(1)
+    with transaction() as cursor:
+        cursor.executemany('''
+            INSERT INTO users (telegram_id, first_name) VALUES (?, 'Bench')
+        ''', ((uid,) for uid in range(1, users + 1)))
+        cursor.executemany(db._INSERT_INVOICE, (
+            {'user_id': uid, 'client_name': 'Client', 'amount': 100, 'currency': 'USD',
+             'due_date': today + timedelta(days=rng.randint(-30, 60)), 'notes': None,
+             'scheduled_from': today - timedelta(days=2)}
+            for uid in range(1, users + 1) for _ in range(invoices_per_user)
+        ))
+        # Most history is paid, nearly all of it long ago
+        cursor.execute('''
+            UPDATE invoices SET status = 'paid', next_reminder_at = NULL,
+                   paid_date = date('now', '-' || (abs(random()) % 1000) || ' days')
+            WHERE abs(random()) % 1000 < ?
+        ''', (int(paid_share * 1000),))
+        cursor.execute('ANALYZE')
+    conn = db.get_connection()
+    sample = [rng.randint(1, users) for _ in range(2000)]
+    
+    def reads():
+        return {
+            '/list page': _per_call_us(lambda: db.get_unpaid_invoices_page(rng.choice(sample)), 2000),
+            '/all page': _per_call_us(lambda: db.get_invoices_page(rng.choice(sample)), 2000),
+            '/stats': _per_call_us(lambda: db.get_revenue_stats(rng.choice(sample)), 2000),
+            'unpaid count': _per_call_us(lambda: db.count_unpaid_invoices(rng.choice(sample)), 2000),
+        }
+    
+    total = users * invoices_per_user
+    print(f"\nArchiving paid invoices older than {config.ARCHIVE_AFTER_DAYS} days "
+          f"({total} invoices, ~{paid_share:.0%} paid)")
+    before = reads()
+    
+    batches, longest = 0, 0.0
+    start = time.perf_counter()
+    while True:
+        batch_start = time.perf_counter()
+        moved = db.archive_paid_invoices()
+        longest = max(longest, time.perf_counter() - batch_start)
+        batches += 1
+        if moved < config.ARCHIVE_BATCH_SIZE:
+            break
+    elapsed = time.perf_counter() - start
+    archived = conn.execute('SELECT COUNT(*) FROM invoices_archive').fetchone()[0]
+    print(f"  archived {archived} in {batches} batches of {config.ARCHIVE_BATCH_SIZE}: "
+          f"{elapsed:.2f}s ({archived / elapsed:.0f} rows/s), longest batch {longest * 1000:.1f} ms")
+    assert not db.check_user_stats()
+    
+    conn.execute('ANALYZE')
+    after = reads()
+    for label in before:
+        print(f"  {label:<13} {before[label]:10.0f} us -> {after[label]:10.0f} us")
+    
+    db.close_db()
+
+def bench_retention(invoices: int = 1000, days: int = 365):
+    """Reminder log retention over a year of daily reminders for `invoices` invoices: one big DELETE (old way to
+    prune) vs batched roll-up + incremental_vacuum, by longest write lock and space reclaimed"""
+    import retention
+    import async_db as adb
+    path = _temp_db('retention.db')
+    today = date.today()
+    
+    def seed():
+        with transaction() as cursor:
+            cursor.execute('DELETE FROM reminders')
+            cursor.execute('DELETE FROM reminder_counts')
+            cursor.executemany('''
+                INSERT INTO reminders (invoice_id, reminder_type, reminder_date) VALUES (?, 'overdue', ?)
+            ''', ((invoice_id, today - timedelta(days=day))
+                  for day in range(days) for invoice_id in range(1, invoices + 1)))
+        db.get_connection().execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        return os.path.getsize(path), db.get_connection().execute('SELECT COUNT(*) FROM reminders').fetchone()[0]
+    
+    def file_mb():
+        db.get_connection().execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        return os.path.getsize(path) / (1024 * 1024)
+    
+    size, rows = seed()
+    cutoff = today - timedelta(days=config.REMINDER_RETENTION_DAYS)
+    print(f"\nPruning reminders older than {config.REMINDER_RETENTION_DAYS} days "
+          f"({rows} rows, {size / (1024 * 1024):.1f} MB file)")
+    
+    start = time.perf_counter()
+    with transaction() as cursor:
+        cursor.execute('DELETE FROM reminders WHERE reminder_date < ?', (cutoff,))
+        deleted = cursor.rowcount
+    elapsed = time.perf_counter() - start
+    print(f"  single DELETE          {deleted:>8} rows  write lock {elapsed * 1000:8.0f} ms  "
+          f"file {file_mb():6.1f} MB (free pages kept)")
+    
+    seed()
+    result = asyncio.run(retention.prune_reminders())
+    adb.close_db()
+    print(f"  batched roll-up        {result['pruned']:>8} rows  longest lock {result['longest_lock_seconds'] * 1000:5.0f} ms "
+          f"(total {result['lock_seconds'] * 1000:.0f} ms)  file {file_mb():6.1f} MB "
+          f"({result['reclaimed_bytes'] / (1024 * 1024):.1f} MB reclaimed)")
+    
+    db.close_db()
+
+BENCHMARKS = {
+    'connection': bench_connection,
+    'updates': bench_update_modes,
+    'latency': bench_update_latency,
+    'export': bench_export,
+    'import': bench_import,
+    'buckets': bench_buckets,
+    'render': bench_render,
+    'weekly': bench_weekly,
+    'schedule': bench_schedule,
+    'paid': bench_paid,
+    'archive': bench_archive,
+    'retention': bench_retention,
+}
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
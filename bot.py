@@ -1,8 +1,10 @@
 """PayTrackBot - Telegram Invoice Tracker for Freelancers"""
 import logging
+import secrets
 import sys
+import tempfile
 import os
-from datetime import datetime, date, timedelta
+from datetime import date
 
 # Setup logging FIRST
 logging.basicConfig(
@@ -26,13 +28,24 @@ from telegram.ext import (
 try:
     import config
     import database as db
+    import async_db as adb
+    from update_processor import PerChatUpdateProcessor, BoundedUpdateQueue
+    from persistence import SQLitePersistence
+    import export
+    import render
+    import dates
+    import reminders
+    import archive
+    import retention
+    from scheduler import Scheduler
+    from dates import parse_due_date, DueDateTooOld
     logger.info("[OK] Modules imported")
 except Exception as e:
     logger.error(f"[ERROR] Import failed: {e}")
     sys.exit(1)
 
 # Conversation states
-CLIENT_NAME, AMOUNT, DUE_DATE, NOTES = range(4)
+CLIENT_NAME, AMOUNT, DUE_DATE, NOTES, IMPORT_FILE = range(5)
 
 # === COMMAND HANDLERS ===
 
@@ -42,7 +55,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info(f"[CMD] /start from {user.username} (ID: {user.id})")
     
     try:
-        db_user = db.get_or_create_user(
+        db_user = await adb.get_or_create_user(
             telegram_id=user.id,
             username=user.username,
             first_name=user.first_name
@@ -80,19 +93,21 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 **Invoice Management:**
 /new - Create new invoice
+/import - Import invoices from a CSV file
 /list - View unpaid invoices
-/all - View all invoices (last 50)
-/paid <id> - Mark invoice as paid
+/all - View all invoices (newest first)
+/paid <id> [ids...] - Mark invoices as paid (ranges like 20-25 work)
 /delete <id> - Delete an invoice
 /view <id> - View invoice details
 
 **Statistics:**
 /stats - Revenue statistics
-/export - Export to CSV (Pro only)
+/export - Export to CSV or JSON (Pro only)
 
 **Account:**
 /upgrade - Upgrade to Pro ($7/month)
 /account - View subscription status
+/timezone - Set your timezone for reminders
 /help - This help message
 
 **Need help?** Contact @YourSupportUsername
@@ -100,64 +115,105 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(help_msg, parse_mode='Markdown')
 
+# Paged views: name -> (page query, cursor column)
+PAGE_VIEWS = {
+    'list': (adb.get_unpaid_invoices_page, 'due_date'),
+    'all': (adb.get_invoices_page, 'created_at'),
+}
+
+def _page_keyboard(view: str, page: dict):
+    """Prev/next buttons (callback data carries the (key, id) of the edge row),
+    under mark-paid buttons on /list"""
+    _, key = PAGE_VIEWS[view]
+    invoices = page['invoices']
+    rows = render.paid_buttons(view, [inv['id'] for inv in invoices]) if view == 'list' else []
+    buttons = []
+    if page['has_prev']:
+        first = invoices[0]
+        buttons.append(InlineKeyboardButton(
+            "◀️ Prev", callback_data=f"{view}:prev:{first['id']}:{first[key]}"))
+    if page['has_next']:
+        last = invoices[-1]
+        buttons.append(InlineKeyboardButton(
+            "Next ▶️", callback_data=f"{view}:next:{last['id']}:{last[key]}"))
+    if buttons:
+        rows.append(buttons)
+    return InlineKeyboardMarkup(rows) if rows else None
+
+def _render_page(view: str, page: dict, note: list = ()) -> list:
+    """Message parts for a page (more than one only for very long client names),
+    with optional note lines on top"""
+    msg_lines = list(note)
+    if view == 'list':
+        msg_lines.append("**📋 Unpaid Invoices:**\n")
+        msg_lines.extend(map(render.unpaid_line, page['invoices']))
+        msg_lines.append("\n💡 Use `/paid <id>` to mark as paid")
+    else:
+        msg_lines.append("**📊 All Invoices:**\n")
+        msg_lines.extend(map(render.invoice_line, page['invoices']))
+    return render.pack(msg_lines)
+
+async def _reply_page(message, view: str, page: dict, edit: bool = False, note: list = ()):
+    """Send (or edit in the first part) a page; the keyboard goes under the last part"""
+    parts = _render_page(view, page, note)
+    keyboard = _page_keyboard(view, page)
+    for i, text in enumerate(parts):
+        markup = keyboard if i == len(parts) - 1 else None
+        if edit and i == 0:
+            await message.edit_text(text, parse_mode='Markdown', reply_markup=markup)
+        else:
+            await message.reply_text(text, parse_mode='Markdown', reply_markup=markup)
+
 async def list_invoices(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """List all unpaid invoices"""
+    """List unpaid invoices, one page at a time"""
     user_id = update.effective_user.id
-    invoices = db.get_unpaid_invoices(user_id)
+    page = await adb.get_unpaid_invoices_page(user_id)
     
-    if not invoices:
+    if not page['invoices']:
         await update.message.reply_text("✅ No unpaid invoices! You're all caught up.")
         return
     
-    today = date.today()
-    msg_lines = ["**📋 Unpaid Invoices:**\n"]
-    
-    for inv in invoices:
-        due = datetime.strptime(inv['due_date'], '%Y-%m-%d').date()
-        days_diff = (due - today).days
-        
-        if days_diff < 0:
-            status = f"⚠️ *OVERDUE by {abs(days_diff)} days*"
-        elif days_diff == 0:
-            status = "🔴 *Due TODAY*"
-        elif days_diff <= 3:
-            status = f"🟡 Due in {days_diff} days"
-        else:
-            status = f"🟢 Due in {days_diff} days"
-        
-        msg_lines.append(
-            f"**#{inv['id']}** {inv['client_name']}\n"
-            f"  💵 {inv['currency']} {inv['amount']:.2f} | {status}\n"
-        )
-    
-    msg_lines.append(f"\n💡 Use `/paid <id>` to mark as paid")
-    
-    await update.message.reply_text('\n'.join(msg_lines), parse_mode='Markdown')
+    await _reply_page(update.message, 'list', page)
 
 async def all_invoices(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """List all invoices (paid and unpaid)"""
+    """List all invoices (paid and unpaid), newest first, one page at a time"""
     user_id = update.effective_user.id
-    invoices = db.get_all_invoices(user_id, limit=50)
+    page = await adb.get_invoices_page(user_id)
     
-    if not invoices:
+    if not page['invoices']:
         await update.message.reply_text("No invoices yet. Create one with /new")
         return
     
-    msg_lines = ["**📊 All Invoices (Last 50):**\n"]
+    await _reply_page(update.message, 'all', page)
+
+async def page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Prev/next buttons under /list and /all - edit the message in place"""
+    query = update.callback_query
+    await query.answer()
     
-    for inv in invoices:
-        status_emoji = "✅" if inv['status'] == 'paid' else "⏳"
-        msg_lines.append(
-            f"{status_emoji} **#{inv['id']}** {inv['client_name']} - "
-            f"{inv['currency']} {inv['amount']:.2f}"
-        )
+    try:
+        view, direction, invoice_id, key_value = query.data.split(':', 3)
+        fetch_page, _ = PAGE_VIEWS[view]
+        boundary = (key_value, int(invoice_id))
+    except (ValueError, KeyError):
+        return
+    
+    # Pages are always scoped to whoever pressed the button
+    if direction == 'next':
+        page = await fetch_page(query.from_user.id, after=boundary)
+    else:
+        page = await fetch_page(query.from_user.id, before=boundary)
     
-    await update.message.reply_text('\n'.join(msg_lines), parse_mode='Markdown')
+    if not page['invoices']:
+        await query.edit_message_text("Nothing more to show. Use /list or /all to start over.")
+        return
+    
+    await _reply_page(query.message, view, page, edit=True)
 
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show revenue statistics"""
     user_id = update.effective_user.id
-    stats = db.get_revenue_stats(user_id)
+    stats = await adb.get_revenue_stats(user_id)
     
     stats_msg = f"""**📈 Your Revenue Stats**
 
@@ -180,8 +236,8 @@ Keep crushing it! 🚀
 async def account_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show account status"""
     user_id = update.effective_user.id
-    user = db.get_user(user_id)
-    unpaid_count = db.count_unpaid_invoices(user_id)
+    user = await adb.get_user(user_id)
+    unpaid_count = await adb.count_unpaid_invoices(user_id)
     
     tier = user['subscription_tier'].upper()
     
@@ -203,6 +259,36 @@ async def account_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(account_msg, parse_mode='Markdown')
 
+async def timezone_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show or set the user's UTC offset (reminders arrive at REMINDER_TIME local time)"""
+    user = update.effective_user
+    db_user = await adb.get_or_create_user(user.id, user.username, user.first_name)
+    reminder_time = f"{config.REMINDER_TIME_HOUR:02d}:{config.REMINDER_TIME_MINUTE:02d}"
+    
+    if not context.args:
+        await update.message.reply_text(
+            f"🕘 Your timezone: {dates.format_tz_offset(db_user['tz_offset'])}\n"
+            f"Reminders arrive around {reminder_time} your time.\n\n"
+            f"Change it with `/timezone +2`, `/timezone -5` or `/timezone +5:30`",
+            parse_mode='Markdown'
+        )
+        return
+    
+    try:
+        tz_offset = dates.parse_tz_offset(' '.join(context.args))
+    except ValueError:
+        await update.message.reply_text(
+            "Please give a UTC offset between -12 and +14, e.g. `/timezone +2` or `/timezone -3:30`",
+            parse_mode='Markdown'
+        )
+        return
+    
+    await adb.update_user_timezone(user.id, tz_offset)
+    await update.message.reply_text(
+        f"✅ Timezone set to {dates.format_tz_offset(tz_offset)}. "
+        f"Reminders will arrive around {reminder_time} your time."
+    )
+
 async def upgrade_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show upgrade options"""
     upgrade_msg = """**💎 Upgrade to Pro**
@@ -223,39 +309,190 @@ Questions? Contact @YourSupport
     
     await update.message.reply_text(upgrade_msg, parse_mode='Markdown')
 
-async def mark_paid(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Mark invoice as paid: /paid <invoice_id>"""
+def _parse_export_args(args) -> tuple:
+    """/export [csv|json] [paid|unpaid] [from-date] [to-date] in any order; the dates are
+    plain YYYY-MM-DD due dates, the first one the start of the range"""
+    fmt, status, due_dates = 'csv', None, []
+    for arg in (a.lower() for a in args):
+        if arg in export.FORMATS:
+            fmt = arg
+        elif arg in ('paid', 'unpaid'):
+            status = arg
+        elif arg == 'all':
+            status = None
+        else:
+            due_dates.append(date.fromisoformat(arg))  # ValueError on anything else
+    if len(due_dates) > 2:
+        raise ValueError("too many dates")
+    due_from, due_to = (due_dates + [None, None])[:2]
+    return fmt, status, due_from, due_to
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Send the user's invoices as a CSV or JSON document (Pro only)"""
     user_id = update.effective_user.id
+    user = await adb.get_or_create_user(user_id, update.effective_user.username,
+                                        update.effective_user.first_name)
     
-    if not context.args:
-        await update.message.reply_text("Usage: /paid <invoice_id>\nExample: /paid 5")
+    if user['subscription_tier'] == config.TIER_FREE:
+        await update.message.reply_text(
+            "💾 Export is a Pro feature.\n\n"
+            "💎 Upgrade to Pro with /upgrade"
+        )
         return
     
     try:
-        invoice_id = int(context.args[0])
+        fmt, status, due_from, due_to = _parse_export_args(context.args)
     except ValueError:
-        await update.message.reply_text("Invalid invoice ID. Must be a number.")
+        await update.message.reply_text(
+            "Usage: `/export [csv|json] [paid|unpaid] [from-date] [to-date]`\n"
+            "Example: `/export json unpaid 2024-01-01 2024-12-31`\n"
+            "Dates filter on due date (YYYY-MM-DD).",
+            parse_mode='Markdown'
+        )
         return
     
-    invoice = db.get_invoice(invoice_id)
+    try:
+        document, count = await adb.export_invoices(user_id, fmt, status, due_from, due_to)
+    except export.ExportTooLarge as e:
+        await update.message.reply_text(
+            f"That export (over {e.count} invoices) is too large to send. "
+            f"Narrow it with a status or date range."
+        )
+        return
+    try:
+        if count == 0:
+            await update.message.reply_text("No invoices match those filters.")
+            return
+        
+        await update.message.reply_document(
+            document=document,
+            filename=f"invoices-{date.today()}.{fmt}",
+            caption=f"📄 {count} invoices"
+        )
+        logger.info(f"[EXPORT] {count} invoices as {fmt} for user {user_id}")
+    finally:
+        document.close()
+
+async def import_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Start a bulk import - ask for the CSV file"""
+    await update.message.reply_text(
+        "📥 **Import Invoices**\n\n"
+        "Send a CSV file with a header row:\n"
+        "`client_name,amount,due_date,currency,notes`\n\n"
+        "currency and notes are optional. Due dates take the same formats as /new "
+        "(YYYY-MM-DD, 'today', '30d').\n\n"
+        "(Send /cancel to abort)",
+        parse_mode='Markdown'
+    )
+    return IMPORT_FILE
+
+async def import_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Import the uploaded CSV and report what happened"""
+    user_id = update.effective_user.id
+    document = update.message.document
     
-    if not invoice:
-        await update.message.reply_text("❌ Invoice not found.")
+    if document.file_size and document.file_size > config.IMPORT_MAX_BYTES:
+        await update.message.reply_text(
+            f"That file is too large (max {config.IMPORT_MAX_BYTES // 2**20} MB). Split it and try again."
+        )
+        return IMPORT_FILE
+    
+    user = await adb.get_or_create_user(user_id, update.effective_user.username,
+                                        update.effective_user.first_name)
+    max_unpaid = config.FREE_TIER_MAX_INVOICES if user['subscription_tier'] == config.TIER_FREE else None
+    
+    with tempfile.SpooledTemporaryFile(max_size=config.EXPORT_SPOOL_SIZE) as upload:
+        telegram_file = await document.get_file()
+        await telegram_file.download_to_memory(upload)
+        upload.seek(0)
+        try:
+            result = await adb.import_invoices(user_id, upload, max_unpaid)
+        except (ValueError, UnicodeDecodeError) as e:
+            await update.message.reply_text(f"❌ Couldn't read that CSV: {e}\nFix it and send it again, or /cancel.")
+            return IMPORT_FILE
+    
+    logger.info(f"[IMPORT] {result['imported']} invoices for user {user_id} "
+                f"({result['rows_per_sec']:.0f} rows/s, {result['error_count']} errors)")
+    
+    msg_lines = [f"✅ Imported {result['imported']} invoices in {result['seconds']:.2f}s "
+                 f"({result['rows_per_sec']:.0f} rows/s)"]
+    if result['over_limit']:
+        msg_lines.append(
+            f"\n⚠️ {result['over_limit']} rows skipped: free plan limit of "
+            f"{config.FREE_TIER_MAX_INVOICES} unpaid invoices. Upgrade with /upgrade"
+        )
+    if result['error_count']:
+        msg_lines.append(f"\n❌ {result['error_count']} rows had errors:")
+        msg_lines.extend(f"  line {line}: {error}" for line, error in result['errors'])
+        hidden = result['error_count'] - len(result['errors'])
+        if hidden:
+            msg_lines.append(f"  ...and {hidden} more")
+    
+    await update.message.reply_text('\n'.join(msg_lines))
+    return ConversationHandler.END
+
+async def import_not_a_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Anything but a document while waiting for the CSV - say what's expected"""
+    await update.message.reply_text(
+        "Please send the invoices as a CSV file (attach it as a document), or /cancel to abort."
+    )
+    return IMPORT_FILE
+
+def _parse_invoice_ids(args) -> list:
+    """'12 13 20-25' or '12,13,20-25' -> [12, 13, 20, ..., 25]; raises ValueError"""
+    ids = []
+    for token in ','.join(args).replace(',', ' ').split():
+        first, _, last = token.partition('-')
+        first = int(first)
+        last = int(last) if last else first
+        if last < first or len(ids) + last - first + 1 > config.PAID_MAX_BATCH:
+            raise ValueError(f"bad range {token!r}")
+        ids.extend(range(first, last + 1))
+    if not ids:
+        raise ValueError("no invoice IDs")
+    return list(dict.fromkeys(ids))
+
+async def mark_paid(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Mark invoices as paid: /paid <invoice_id> [more ids or ranges like 20-25]"""
+    user_id = update.effective_user.id
+    
+    if not context.args:
+        await update.message.reply_text(
+            "Usage: /paid <invoice_id> [...]\nExample: /paid 5 or /paid 12 13 20-25")
         return
     
-    if invoice['user_id'] != user_id:
-        await update.message.reply_text("❌ This invoice doesn't belong to you.")
+    try:
+        invoice_ids = _parse_invoice_ids(context.args)
+    except ValueError:
+        await update.message.reply_text(
+            f"Invalid invoice ID. Use numbers or ranges like 20-25 (up to {config.PAID_MAX_BATCH} invoices).")
         return
     
-    if invoice['status'] == 'paid':
-        await update.message.reply_text("✅ This invoice is already marked as paid!")
+    if len(invoice_ids) > 1:
+        # The whole batch is one UPDATE ... WHERE id IN (...) in one transaction
+        paid = await adb.mark_invoices_paid(invoice_ids, user_id)
+        for text in render.pack(_paid_summary(paid, invoice_ids)):
+            await update.message.reply_text(text, parse_mode='Markdown')
         return
     
-    db.mark_invoice_paid(invoice_id)
+    invoice_id = invoice_ids[0]
+    
+    # One conditional UPDATE decides and returns the row; a miss is explained afterwards
+    invoice = await adb.mark_invoice_paid(invoice_id, user_id)
+    
+    if not invoice:
+        current = await adb.get_invoice(invoice_id)
+        if not current:
+            await update.message.reply_text("❌ Invoice not found.")
+        elif current['user_id'] != user_id:
+            await update.message.reply_text("❌ This invoice doesn't belong to you.")
+        else:
+            await update.message.reply_text("✅ This invoice is already marked as paid!")
+        return
     
     success_msg = f"""✅ **Invoice Marked Paid!**
 
-**#{invoice_id}** {invoice['client_name']}
+**#{invoice_id}** {render.escape(invoice['client_name'])}
 💵 {invoice['currency']} {invoice['amount']:.2f}
 
 Great job getting paid! 🎉
@@ -263,6 +500,75 @@ Great job getting paid! 🎉
     
     await update.message.reply_text(success_msg, parse_mode='Markdown')
 
+def _paid_summary(paid: list, requested: list = ()) -> list:
+    """Confirmation lines for a batch of invoices marked paid, noting requested IDs that weren't"""
+    if paid:
+        lines = [f"✅ **Marked {len(paid)} invoice{'s' if len(paid) != 1 else ''} paid!**\n"]
+        lines.extend(map(render.paid_line, paid))
+    else:
+        lines = ["Nothing to mark paid."]
+    skipped = sorted(set(requested) - {inv['id'] for inv in paid})
+    if skipped:
+        lines.append(f"\nSkipped (not found, not yours or already paid): "
+                     f"{', '.join(f'#{invoice_id}' for invoice_id in skipped)}")
+    return lines
+
+def _button_invoice_ids(markup) -> list:
+    """Invoice IDs of the mark-paid buttons on a message"""
+    ids = []
+    for row in (markup.inline_keyboard if markup else ()):
+        for button in row:
+            parts = (button.callback_data or '').split(':')
+            if parts[0] == 'paid' and parts[-1].isdigit():
+                ids.append(int(parts[-1]))
+    return ids
+
+def _list_page_start(markup):
+    """/list cursor that re-reads the page a message shows (from its Prev button), None on page 1"""
+    for row in (markup.inline_keyboard if markup else ()):
+        for button in row:
+            if (button.callback_data or '').startswith('list:prev:'):
+                _, _, invoice_id, key_value = button.callback_data.split(':', 3)
+                return (key_value, int(invoice_id) - 1)  # after the row before it
+    return None
+
+async def paid_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Mark-paid buttons under /list pages and reminders - pay, then edit the message in place"""
+    query = update.callback_query
+    
+    try:
+        _, view, target = query.data.split(':', 2)
+        shown = _button_invoice_ids(query.message.reply_markup)
+        invoice_ids = shown if target == 'all' else [int(target)]
+    except ValueError:
+        await query.answer()
+        return
+    
+    paid = await adb.mark_invoices_paid(invoice_ids, query.from_user.id)
+    await query.answer(f"Marked {len(paid)} paid" if paid else "Already paid")
+    summary = _paid_summary(paid, invoice_ids)
+    
+    if view == 'list':
+        # Re-read the same page without the paid invoices
+        start = _list_page_start(query.message.reply_markup)
+        page = await adb.get_unpaid_invoices_page(query.from_user.id, after=start)
+        if not page['invoices'] and start:
+            page = await adb.get_unpaid_invoices_page(query.from_user.id)  # paid the whole last page
+        if not page['invoices']:
+            summary.append("\n✅ No unpaid invoices! You're all caught up.")
+            await query.edit_message_text(render.pack(summary)[0], parse_mode='Markdown')
+            return
+        await _reply_page(query.message, 'list', page, edit=True, note=summary + [''])
+        return
+    
+    # Reminder: keep the text, add the confirmation and drop the buttons just used
+    remaining = [invoice_id for invoice_id in shown if invoice_id not in invoice_ids]
+    buttons = render.paid_buttons(view, remaining)
+    parts = render.pack([query.message.text_markdown, ''] + summary)
+    text = parts[0] if len(parts) == 1 else render.pack(summary)[0]
+    await query.edit_message_text(text, parse_mode='Markdown',
+                                  reply_markup=InlineKeyboardMarkup(buttons) if buttons else None)
+
 async def delete_invoice_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Delete invoice: /delete <invoice_id>"""
     user_id = update.effective_user.id
@@ -277,10 +583,13 @@ async def delete_invoice_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text("Invalid invoice ID. Must be a number.")
         return
     
-    success = db.delete_invoice(invoice_id, user_id)
+    invoice = await adb.delete_invoice(invoice_id, user_id)
     
-    if success:
-        await update.message.reply_text(f"🗑️ Invoice #{invoice_id} deleted.")
+    if invoice:
+        await update.message.reply_text(
+            f"🗑️ Invoice #{invoice_id} ({render.escape(invoice['client_name'])}) deleted.",
+            parse_mode='Markdown'
+        )
     else:
         await update.message.reply_text("❌ Invoice not found or doesn't belong to you.")
 
@@ -289,11 +598,11 @@ async def delete_invoice_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def new_invoice_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start new invoice conversation"""
     user_id = update.effective_user.id
-    user = db.get_user(user_id)
+    user = await adb.get_user(user_id)
     
     # Check free tier limit
     if user['subscription_tier'] == config.TIER_FREE:
-        unpaid_count = db.count_unpaid_invoices(user_id)
+        unpaid_count = await adb.count_unpaid_invoices(user_id)
         if unpaid_count >= config.FREE_TIER_MAX_INVOICES:
             await update.message.reply_text(
                 f"⚠️ Free plan limit reached ({config.FREE_TIER_MAX_INVOICES} unpaid invoices).\n\n"
@@ -315,7 +624,7 @@ async def get_client_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['client_name'] = update.message.text
     
     await update.message.reply_text(
-        f"✅ Client: **{update.message.text}**\n\n"
+        f"✅ Client: **{render.escape(update.message.text)}**\n\n"
         f"What's the invoice amount?\n"
         f"(Example: 500 or 1250.50)",
         parse_mode='Markdown'
@@ -347,21 +656,11 @@ async def get_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def get_due_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Save due date, ask for notes"""
-    text = update.message.text.strip().lower()
-    
     try:
-        if text == 'today':
-            due_date = date.today()
-        elif text.endswith('d') and text[:-1].isdigit():
-            days = int(text[:-1])
-            due_date = date.today() + timedelta(days=days)
-        else:
-            due_date = datetime.strptime(text, '%Y-%m-%d').date()
-        
-        if due_date < date.today() - timedelta(days=365):
-            await update.message.reply_text("Due date seems too far in the past. Try again.")
-            return DUE_DATE
-            
+        due_date = parse_due_date(update.message.text)
+    except DueDateTooOld:
+        await update.message.reply_text("Due date seems too far in the past. Try again.")
+        return DUE_DATE
     except ValueError:
         await update.message.reply_text(
             "Invalid date format. Use:\n"
@@ -398,7 +697,7 @@ async def create_invoice_final(update: Update, context: ContextTypes.DEFAULT_TYP
     """Final step - create the invoice"""
     user_id = update.effective_user.id
     
-    invoice_id = db.create_invoice(
+    invoice_id = await adb.create_invoice(
         user_id=user_id,
         client_name=context.user_data['client_name'],
         amount=context.user_data['amount'],
@@ -408,13 +707,13 @@ async def create_invoice_final(update: Update, context: ContextTypes.DEFAULT_TYP
     
     success_msg = f"""✅ **Invoice Created!**
 
-**#{invoice_id}** {context.user_data['client_name']}
+**#{invoice_id}** {render.escape(context.user_data['client_name'])}
 💵 ${context.user_data['amount']:.2f}
 📅 Due: {context.user_data['due_date']}
 """
     
     if context.user_data.get('notes'):
-        success_msg += f"📝 {context.user_data['notes']}\n"
+        success_msg += f"📝 {render.escape(context.user_data['notes'])}\n"
     
     success_msg += f"\nUse /list to view all invoices."
     
@@ -431,8 +730,106 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
     return ConversationHandler.END
 
+async def cancel_import(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Cancel a pending /import"""
+    await update.message.reply_text("❌ Import cancelled.")
+    return ConversationHandler.END
+
 # === MAIN APPLICATION ===
 
+def register_handlers(app: Application):
+    """Register all command and conversation handlers on the application"""
+    # Conversation handler for creating invoices
+    conv_handler = ConversationHandler(
+        entry_points=[CommandHandler('new', new_invoice_start)],
+        states={
+            CLIENT_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_client_name)],
+            AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_amount)],
+            DUE_DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_due_date)],
+            NOTES: [
+                CommandHandler('skip', skip_notes),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, get_notes)
+            ],
+        },
+        fallbacks=[CommandHandler('cancel', cancel)],
+        name='new_invoice',
+        # Survive restarts when the application has a persistence backend
+        persistent=app.persistence is not None
+    )
+    
+    import_handler = ConversationHandler(
+        entry_points=[CommandHandler('import', import_start)],
+        states={
+            IMPORT_FILE: [
+                MessageHandler(filters.Document.ALL, import_file),
+                MessageHandler(~filters.COMMAND, import_not_a_file)
+            ],
+        },
+        fallbacks=[CommandHandler('cancel', cancel_import)],
+        name='import',
+        persistent=app.persistence is not None
+    )
+    
+    app.add_handler(CommandHandler('start', start))
+    app.add_handler(CommandHandler('help', help_command))
+    app.add_handler(CommandHandler('list', list_invoices))
+    app.add_handler(CommandHandler('all', all_invoices))
+    app.add_handler(CommandHandler('stats', stats_command))
+    app.add_handler(CommandHandler('account', account_command))
+    app.add_handler(CommandHandler('timezone', timezone_command))
+    app.add_handler(CommandHandler('upgrade', upgrade_command))
+    app.add_handler(CommandHandler('paid', mark_paid))
+    app.add_handler(CommandHandler('delete', delete_invoice_cmd))
+    app.add_handler(CommandHandler('export', export_command))
+    app.add_handler(CallbackQueryHandler(page_callback, pattern=r'^(list|all):'))
+    app.add_handler(CallbackQueryHandler(paid_callback, pattern=r'^paid:'))
+    app.add_handler(conv_handler)
+    app.add_handler(import_handler)
+
+async def start_scheduler(app: Application):
+    """post_init hook: run reminders, summaries and maintenance on the bot's own loop and HTTP client"""
+    if not config.SCHEDULER_ENABLED:
+        return
+    scheduler = Scheduler(app.bot)
+    # Each tick sends the timezone cohorts whose local REMINDER_TIME has come
+    scheduler.add_interval('daily_reminders', reminders.send_due_reminders,
+                           config.REMINDER_TICK_MINUTES)
+    scheduler.add_weekly('weekly_summary', reminders.send_weekly_summary,
+                         config.WEEKLY_SUMMARY_WEEKDAY, config.WEEKLY_SUMMARY_HOUR,
+                         config.WEEKLY_SUMMARY_MINUTE)
+    scheduler.add_daily('archive_invoices', archive.archive_paid_invoices,
+                        config.ARCHIVE_HOUR, config.ARCHIVE_MINUTE)
+    scheduler.add_daily('prune_reminders', retention.prune_reminders,
+                        config.REMINDER_PRUNE_HOUR, config.REMINDER_PRUNE_MINUTE)
+    scheduler.start()
+    app.bot_data['scheduler'] = scheduler
+
+async def stop_scheduler(app: Application):
+    """post_stop hook"""
+    scheduler = app.bot_data.pop('scheduler', None)
+    if scheduler:
+        await scheduler.stop()
+
+def run_webhook(app: Application):
+    """Serve updates from a local HTTP listener that Telegram pushes to"""
+    if not config.WEBHOOK_URL:
+        raise ValueError("WEBHOOK_URL must be set when BOT_MODE=webhook")
+    
+    # Telegram echoes the secret in a header on every request; without a
+    # configured one, a fresh random secret is registered on each start
+    secret_token = config.WEBHOOK_SECRET_TOKEN or secrets.token_urlsafe(32)
+    
+    logger.info(f"[*] Webhook listening on {config.WEBHOOK_LISTEN}:{config.WEBHOOK_PORT}/{config.WEBHOOK_PATH}")
+    app.run_webhook(
+        listen=config.WEBHOOK_LISTEN,
+        port=config.WEBHOOK_PORT,
+        url_path=config.WEBHOOK_PATH,
+        webhook_url=f"{config.WEBHOOK_URL.rstrip('/')}/{config.WEBHOOK_PATH}",
+        secret_token=secret_token,
+        allowed_updates=config.ALLOWED_UPDATES,
+        max_connections=config.WEBHOOK_MAX_CONNECTIONS
+    )
+
 def main():
     """Start the bot"""
     logger.info("[*] Initializing database...")
@@ -451,39 +848,25 @@ def main():
     
     # Create application
     try:
-        app = Application.builder().token(config.TELEGRAM_BOT_TOKEN).build()
+        app = (
+            Application.builder()
+            .token(config.TELEGRAM_BOT_TOKEN)
+            .update_queue(BoundedUpdateQueue(config.UPDATE_QUEUE_SIZE, config.UPDATE_QUEUE_SIZE))
+            .concurrent_updates(PerChatUpdateProcessor(
+                config.UPDATE_WORKERS, max_pending=config.UPDATE_QUEUE_SIZE))
+            .persistence(SQLitePersistence())
+            .post_init(start_scheduler)
+            .post_stop(stop_scheduler)
+            .build()
+        )
         logger.info("[OK] Application created")
     except Exception as e:
         logger.error(f"[ERROR] Failed to create application: {e}")
         return
     
-    # Conversation handler for creating invoices
-    conv_handler = ConversationHandler(
-        entry_points=[CommandHandler('new', new_invoice_start)],
-        states={
-            CLIENT_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_client_name)],
-            AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_amount)],
-            DUE_DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_due_date)],
-            NOTES: [
-                CommandHandler('skip', skip_notes),
-                MessageHandler(filters.TEXT & ~filters.COMMAND, get_notes)
-            ],
-        },
-        fallbacks=[CommandHandler('cancel', cancel)]
-    )
-    
     # Add handlers
     try:
-        app.add_handler(CommandHandler('start', start))
-        app.add_handler(CommandHandler('help', help_command))
-        app.add_handler(CommandHandler('list', list_invoices))
-        app.add_handler(CommandHandler('all', all_invoices))
-        app.add_handler(CommandHandler('stats', stats_command))
-        app.add_handler(CommandHandler('account', account_command))
-        app.add_handler(CommandHandler('upgrade', upgrade_command))
-        app.add_handler(CommandHandler('paid', mark_paid))
-        app.add_handler(CommandHandler('delete', delete_invoice_cmd))
-        app.add_handler(conv_handler)
+        register_handlers(app)
         logger.info("[OK] All handlers registered")
     except Exception as e:
         logger.error(f"[ERROR] Handler registration failed: {e}")
@@ -491,15 +874,22 @@ def main():
     
     # Start bot
     logger.info("=" * 60)
-    logger.info("[START] PayTrackBot is LIVE and listening for messages")
+    logger.info(f"[START] PayTrackBot is LIVE and listening for messages ({config.BOT_MODE} mode)")
     logger.info("=" * 60)
     
     try:
-        app.run_polling(allowed_updates=Update.ALL_TYPES)
+        if config.BOT_MODE == 'webhook':
+            run_webhook(app)
+        else:
+            app.run_polling(allowed_updates=config.ALLOWED_UPDATES)
     except KeyboardInterrupt:
         logger.info("[STOP] Bot stopped by user")
     except Exception as e:
-        logger.error(f"[ERROR] Polling error: {e}")
+        logger.error(f"[ERROR] {config.BOT_MODE.capitalize()} error: {e}")
+    finally:
+        logger.info(f"[STATS] User cache: {adb.user_cache_stats()}")
+        adb.close_db()
+        logger.info("[OK] Database connections closed")
 
 if __name__ == '__main__':
     main()
@@ -13,6 +13,24 @@ TELEGRAM_BOT_TOKEN = os.getenv('BOT_TOKEN', '')
 if not TELEGRAM_BOT_TOKEN:
     raise ValueError("BOT_TOKEN environment variable not set. Please set it before running the bot.")
 
+# How updates reach the bot: 'polling' (default) or 'webhook'
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+
+# Webhook mode (Telegram POSTs updates to WEBHOOK_URL/WEBHOOK_PATH)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')  # public https base URL, e.g. https://paytrack.up.railway.app
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('PORT', '8443'))  # Railway provides PORT
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN', '')  # random per start if unset
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+
+# Only subscribe to the update types we handle
+ALLOWED_UPDATES = ['message', 'callback_query']
+
+# Update processing
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', '1000'))  # max unfinished updates taken in, and max waiting behind them, before intake pauses
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', '16'))  # updates processed concurrently (one at a time per chat)
+
 # Stripe API Key (for subscription payments)
 STRIPE_API_KEY = os.getenv('STRIPE_API_KEY', '')
 STRIPE_PRICE_ID_PRO = os.getenv('STRIPE_PRICE_ID_PRO', '')  # $7/month price ID
@@ -20,6 +38,35 @@ STRIPE_PRICE_ID_PRO = os.getenv('STRIPE_PRICE_ID_PRO', '')  # $7/month price ID
 # Database path
 DB_PATH = 'data/paytrack.db'
 
+# SQLite tuning (applied once per long-lived connection)
+DB_CACHE_SIZE_KB = 16 * 1024  # 16 MB page cache
+DB_MMAP_SIZE = 64 * 1024 * 1024  # 64 MB memory-mapped I/O
+DB_READ_WORKERS = 4  # Threads serving async reads (writes use a single thread)
+
+# In-process user cache (subscription tier etc.)
+USER_CACHE_SIZE = 10000  # max cached users
+USER_CACHE_TTL = 300  # seconds before a cached user is re-read
+
+# /list and /all
+INVOICE_PAGE_SIZE = 10  # invoices per message; pages are navigated with inline buttons
+
+# /paid
+PAID_MAX_BATCH = 100  # invoice IDs accepted by one /paid (e.g. /paid 12 13 20-25)
+PAID_BUTTONS_MAX = 20  # mark-paid buttons under one /list page or reminder
+
+# /export
+EXPORT_CHUNK_SIZE = 1000  # rows fetched from SQLite per fetchmany()
+EXPORT_SPOOL_SIZE = 1024 * 1024  # bytes kept in memory before the file spills to disk
+EXPORT_MAX_BYTES = 50 * 1024 * 1024  # Telegram's upload limit for bots
+
+# /import
+IMPORT_CHUNK_SIZE = 500  # rows per INSERT transaction
+IMPORT_MAX_BYTES = 20 * 1024 * 1024  # Telegram's download limit for bots
+IMPORT_MAX_REPORTED_ERRORS = 10  # per-row errors listed in the reply
+
+# Conversation persistence
+PERSISTENCE_INTERVAL = 10  # seconds between batched writes of /new progress
+
 # Subscription tiers
 TIER_FREE = 'free'
 TIER_PRO = 'pro'
@@ -28,8 +75,44 @@ TIER_PRO = 'pro'
 FREE_TIER_MAX_INVOICES = 3
 
 # Reminder times (24-hour format)
-REMINDER_TIME_HOUR = 9  # 9 AM daily check
+REMINDER_TIME_HOUR = 9  # 9 AM in each user's own timezone
 REMINDER_TIME_MINUTE = 0
+REMINDER_BATCH_SIZE = 200  # users sent (and logged in one transaction) per chunk
+REMINDER_TICK_MINUTES = 15  # how often due timezone cohorts are checked (offsets are 15-min multiples)
+# Overdue escalation policy: (days overdue, remind every N days from then on).
+# E.g. [(0, 1), (7, 3), (30, 7)] is daily for a week, then every 3 days, weekly after a month
+OVERDUE_REMINDER_INTERVALS = [(0, 1)]
+
+# In-process scheduler (daily reminders at REMINDER_TIME, weekly summary below)
+SCHEDULER_ENABLED = os.getenv('SCHEDULER_ENABLED', 'true').lower() == 'true'
+SCHEDULER_JITTER_SECONDS = 120  # random delay added to each firing
+SCHEDULER_CATCHUP_HOURS = 12  # on startup, run a slot missed within this window
+SCHEDULER_LEASE_SECONDS = 2 * 3600  # a started run is retried only after this long
+WEEKLY_SUMMARY_WEEKDAY = 0  # Monday
+WEEKLY_SUMMARY_HOUR = 9
+WEEKLY_SUMMARY_MINUTE = 0
+
+# Archival (hot/cold split): paid invoices move to invoices_archive once this old
+ARCHIVE_AFTER_DAYS = 180  # days since paid_date
+ARCHIVE_BATCH_SIZE = 200  # invoices moved per transaction (~40 ms of write lock)
+ARCHIVE_BATCH_PAUSE = 0.05  # seconds between batches, so commands queue in between
+ARCHIVE_HOUR = 3  # daily archival run (server local time)
+ARCHIVE_MINUTE = 30
+
+# Reminder log retention: older rows are rolled up into per-invoice counters
+REMINDER_RETENTION_DAYS = 90
+REMINDER_PRUNE_BATCH_SIZE = 500  # reminder rows rolled up and deleted per transaction
+REMINDER_PRUNE_PAUSE = 0.05  # seconds between batches and vacuum steps
+VACUUM_PAGES_PER_STEP = 256  # free pages returned to the filesystem per incremental_vacuum
+REMINDER_PRUNE_HOUR = 4  # daily retention run (server local time)
+REMINDER_PRUNE_MINUTE = 0
+
+# Telegram send limits (Bot API allows ~30 msg/s overall and ~1 msg/s per chat)
+TELEGRAM_GLOBAL_RATE = 25  # messages per second across all chats
+TELEGRAM_PER_CHAT_RATE = 1  # messages per second to a single chat
+TELEGRAM_MAX_IN_FLIGHT = 10  # concurrent send_message requests
+TELEGRAM_MAX_RETRIES = 3
+TELEGRAM_RETRY_BACKOFF = 1.0  # seconds, doubled on each network error retry
 
 # Currency options
 DEFAULT_CURRENCY = 'USD'
@@ -0,0 +1,79 @@
+"""Long-lived SQLite connection management for PayTrackBot"""
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+import config
+
+_local = threading.local()
+_lock = threading.Lock()
+_connections = []
+_generation = 0
+
+def _open(path: str) -> sqlite3.Connection:
+    """Open a connection and apply the tuning pragmas once"""
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+
+    # Only takes effect on a new, empty file (before journal_mode writes the header);
+    # older databases are converted with database.enable_incremental_vacuum()
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f'PRAGMA cache_size = -{int(config.DB_CACHE_SIZE_KB)}')
+    conn.execute(f'PRAGMA mmap_size = {int(config.DB_MMAP_SIZE)}')
+    conn.execute('PRAGMA temp_store = MEMORY')
+
+    return conn
+
+def get_connection() -> sqlite3.Connection:
+    """Get this thread's connection, opening it on first use"""
+    conn = getattr(_local, 'conn', None)
+
+    # Drop connections closed by close_all() since this thread last used one
+    if conn is not None and _local.generation != _generation:
+        conn = None
+
+    # Reopen if the database path changed (e.g. the test suite swaps it)
+    if conn is not None and _local.path != config.DB_PATH:
+        _discard(conn)
+        conn = None
+
+    if conn is None:
+        conn = _open(config.DB_PATH)
+        with _lock:
+            _connections.append(conn)
+            _local.generation = _generation
+        _local.conn = conn
+        _local.path = config.DB_PATH
+
+    return conn
+
+@contextmanager
+def transaction() -> Iterator[sqlite3.Cursor]:
+    """Run statements in one transaction; commit on success, roll back on error"""
+    conn = get_connection()
+    with conn:
+        yield conn.cursor()
+
+def _discard(conn: sqlite3.Connection):
+    """Close a single connection and forget about it"""
+    with _lock:
+        if conn in _connections:
+            _connections.remove(conn)
+    conn.close()
+
+def close_all():
+    """Close every connection opened by any thread (call on shutdown)"""
+    global _generation
+
+    with _lock:
+        conns = list(_connections)
+        _connections.clear()
+        _generation += 1
+
+    for conn in conns:
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
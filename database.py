@@ -1,9 +1,17 @@
 """Database management for PayTrackBot"""
-import sqlite3
 import os
-from datetime import datetime, date
-from typing import List, Dict, Optional
+import time
+from datetime import datetime, date, timedelta
+from itertools import groupby
+from typing import List, Dict, Iterable, Iterator, Optional, Tuple
 import config
+import dates
+from cache import TTLCache
+from connection import get_connection, transaction, close_all
+
+# User rows (mostly subscription_tier) are read far more often than written;
+# every function that writes to users must invalidate its entry here.
+user_cache = TTLCache(config.USER_CACHE_SIZE, config.USER_CACHE_TTL)
 
 def init_db():
     """Initialize database with schema"""
@@ -12,7 +20,7 @@ def init_db():
     if db_dir:
         os.makedirs(db_dir, exist_ok=True)
     
-    conn = sqlite3.connect(config.DB_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
     
     # Users table
@@ -57,33 +65,334 @@ def init_db():
     ''')
     
     conn.commit()
-    conn.close()
+    
+    migrate(conn)
     print("[OK] Database initialized")
 
+def _stats_delta(row: str, sign: str) -> str:
+    """Trigger statements that add (sign '+') or remove (sign '-') one invoice row
+    (NEW or OLD) from the user_stats and user_monthly_revenue summaries"""
+    return f'''
+        INSERT INTO user_stats (user_id, paid_total, paid_count, outstanding_total, outstanding_count)
+        VALUES (
+            {row}.user_id,
+            CASE WHEN {row}.status = 'paid' THEN {sign}{row}.amount ELSE 0 END,
+            CASE WHEN {row}.status = 'paid' THEN {sign}1 ELSE 0 END,
+            CASE WHEN {row}.status = 'unpaid' THEN {sign}{row}.amount ELSE 0 END,
+            CASE WHEN {row}.status = 'unpaid' THEN {sign}1 ELSE 0 END
+        )
+        ON CONFLICT (user_id) DO UPDATE SET
+            paid_total = paid_total + excluded.paid_total,
+            paid_count = paid_count + excluded.paid_count,
+            outstanding_total = outstanding_total + excluded.outstanding_total,
+            outstanding_count = outstanding_count + excluded.outstanding_count;
+        INSERT INTO user_monthly_revenue (user_id, month, paid_total, paid_count)
+        SELECT {row}.user_id, strftime('%Y-%m', {row}.paid_date), {sign}{row}.amount, {sign}1
+        WHERE {row}.status = 'paid' AND {row}.paid_date IS NOT NULL
+        ON CONFLICT (user_id, month) DO UPDATE SET
+            paid_total = paid_total + excluded.paid_total,
+            paid_count = paid_count + excluded.paid_count;
+    '''
+
+# Recompute the summaries from scratch (used to backfill and to check them)
+def _user_stats_rebuild(source: str) -> str:
+    return f'''
+    SELECT user_id,
+           TOTAL(CASE WHEN status = 'paid' THEN amount END),
+           COUNT(CASE WHEN status = 'paid' THEN 1 END),
+           TOTAL(CASE WHEN status = 'unpaid' THEN amount END),
+           COUNT(CASE WHEN status = 'unpaid' THEN 1 END)
+    FROM {source}
+    GROUP BY user_id
+'''
+
+def _monthly_revenue_rebuild(source: str) -> str:
+    return f'''
+    SELECT user_id, strftime('%Y-%m', paid_date), TOTAL(amount), COUNT(*)
+    FROM {source}
+    WHERE status = 'paid' AND paid_date IS NOT NULL
+    GROUP BY user_id, strftime('%Y-%m', paid_date)
+'''
+
+# Migration 3 backfilled from invoices alone; since migration 8 the summaries also
+# cover invoices_archive
+_INVOICE_HISTORY = '''(
+    SELECT user_id, amount, status, paid_date FROM invoices
+    UNION ALL
+    SELECT user_id, amount, status, paid_date FROM invoices_archive
+)'''
+_USER_STATS_REBUILD = _user_stats_rebuild(_INVOICE_HISTORY)
+_MONTHLY_REVENUE_REBUILD = _monthly_revenue_rebuild(_INVOICE_HISTORY)
+
+# Columns shared by invoices and invoices_archive, for statements that span both
+INVOICE_COLUMNS = ('id', 'user_id', 'client_name', 'amount', 'currency', 'due_date', 'status',
+                   'paid_date', 'notes', 'created_at', 'tz_offset', 'next_reminder_at',
+                   'reminder_stage')
+
+# Versioned schema migrations, applied in order by init_db().
+# PRAGMA user_version stores how many have been applied; append new ones, never edit old ones.
+MIGRATIONS = [
+    # 1: indexes for the hot invoice queries
+    [
+        '''CREATE INDEX IF NOT EXISTS idx_invoices_user_status_due
+           ON invoices (user_id, status, due_date)''',
+        '''CREATE INDEX IF NOT EXISTS idx_invoices_status_due
+           ON invoices (status, due_date)''',
+        '''CREATE INDEX IF NOT EXISTS idx_invoices_user_created
+           ON invoices (user_id, created_at)''',
+    ],
+    # 2: reminder run ledger + at most one reminder per invoice, type and day
+    [
+        'ALTER TABLE reminders ADD COLUMN reminder_date DATE',
+        "UPDATE reminders SET reminder_date = date(sent_at)",
+        '''DELETE FROM reminders WHERE id NOT IN (
+               SELECT MIN(id) FROM reminders
+               GROUP BY invoice_id, reminder_type, reminder_date
+           )''',
+        '''CREATE UNIQUE INDEX IF NOT EXISTS idx_reminders_invoice_type_date
+           ON reminders (invoice_id, reminder_type, reminder_date)''',
+        '''CREATE TABLE IF NOT EXISTS reminder_runs (
+               id INTEGER PRIMARY KEY AUTOINCREMENT,
+               run_date DATE NOT NULL UNIQUE,
+               started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+               finished_at TIMESTAMP
+           )''',
+        '''CREATE TABLE IF NOT EXISTS reminder_run_users (
+               run_id INTEGER NOT NULL,
+               user_id INTEGER NOT NULL,
+               state TEXT NOT NULL,
+               updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+               PRIMARY KEY (run_id, user_id),
+               FOREIGN KEY (run_id) REFERENCES reminder_runs(id)
+           ) WITHOUT ROWID''',
+    ],
+    # 3: per-user revenue summaries kept current by triggers on invoices
+    [
+        '''CREATE TABLE IF NOT EXISTS user_stats (
+               user_id INTEGER PRIMARY KEY,
+               paid_total REAL NOT NULL DEFAULT 0,
+               paid_count INTEGER NOT NULL DEFAULT 0,
+               outstanding_total REAL NOT NULL DEFAULT 0,
+               outstanding_count INTEGER NOT NULL DEFAULT 0
+           )''',
+        '''CREATE TABLE IF NOT EXISTS user_monthly_revenue (
+               user_id INTEGER NOT NULL,
+               month TEXT NOT NULL,
+               paid_total REAL NOT NULL DEFAULT 0,
+               paid_count INTEGER NOT NULL DEFAULT 0,
+               PRIMARY KEY (user_id, month)
+           ) WITHOUT ROWID''',
+        f'''CREATE TRIGGER IF NOT EXISTS invoices_stats_insert AFTER INSERT ON invoices
+           BEGIN {_stats_delta('NEW', '+')} END''',
+        f'''CREATE TRIGGER IF NOT EXISTS invoices_stats_delete AFTER DELETE ON invoices
+           BEGIN {_stats_delta('OLD', '-')} END''',
+        f'''CREATE TRIGGER IF NOT EXISTS invoices_stats_update
+           AFTER UPDATE OF user_id, amount, status, paid_date ON invoices
+           BEGIN {_stats_delta('OLD', '-')} {_stats_delta('NEW', '+')} END''',
+        'DELETE FROM user_stats',
+        'DELETE FROM user_monthly_revenue',
+        f"INSERT INTO user_stats {_user_stats_rebuild('invoices')}",
+        f"INSERT INTO user_monthly_revenue {_monthly_revenue_rebuild('invoices')}",
+    ],
+    # 4: persisted ConversationHandler states and user_data (only live entries are kept)
+    [
+        '''CREATE TABLE IF NOT EXISTS conversation_states (
+               name TEXT NOT NULL,
+               conversation_key TEXT NOT NULL,
+               state,
+               PRIMARY KEY (name, conversation_key)
+           ) WITHOUT ROWID''',
+        '''CREATE TABLE IF NOT EXISTS conversation_user_data (
+               user_id INTEGER PRIMARY KEY,
+               data BLOB NOT NULL
+           )''',
+    ],
+    # 5: scheduler ledger - one row per job firing, used for catch-up and overlap protection
+    [
+        '''CREATE TABLE IF NOT EXISTS job_runs (
+               name TEXT NOT NULL,
+               scheduled_for TIMESTAMP NOT NULL,
+               started_at TIMESTAMP NOT NULL,
+               finished_at TIMESTAMP,
+               PRIMARY KEY (name, scheduled_for)
+           ) WITHOUT ROWID''',
+    ],
+    # 6: per-user timezones; invoices carry a copy of their owner's tz_offset so each
+    # reminder cohort is one range on (tz_offset, status, due_date)
+    [
+        'ALTER TABLE users ADD COLUMN tz_offset INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE invoices ADD COLUMN tz_offset INTEGER NOT NULL DEFAULT 0',
+        '''UPDATE invoices SET tz_offset = (
+               SELECT u.tz_offset FROM users u WHERE u.telegram_id = invoices.user_id
+           ) WHERE user_id IN (SELECT telegram_id FROM users WHERE tz_offset != 0)''',
+        '''CREATE INDEX IF NOT EXISTS idx_invoices_tz_status_due
+           ON invoices (tz_offset, status, due_date)''',
+        'DROP INDEX IF EXISTS idx_invoices_status_due',
+        '''CREATE INDEX IF NOT EXISTS idx_users_tier_tz
+           ON users (subscription_tier, tz_offset)''',
+        '''CREATE TRIGGER IF NOT EXISTS invoices_tz_insert AFTER INSERT ON invoices
+           WHEN NEW.tz_offset IS NOT (SELECT tz_offset FROM users WHERE telegram_id = NEW.user_id)
+           BEGIN
+               UPDATE invoices SET tz_offset = (
+                   SELECT tz_offset FROM users WHERE telegram_id = NEW.user_id
+               ) WHERE id = NEW.id;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS users_tz_update AFTER UPDATE OF tz_offset ON users
+           BEGIN
+               UPDATE invoices SET tz_offset = NEW.tz_offset WHERE user_id = NEW.telegram_id;
+           END''',
+        # One reminder run per local date *and* timezone cohort
+        '''CREATE TABLE reminder_runs_new (
+               id INTEGER PRIMARY KEY AUTOINCREMENT,
+               run_date DATE NOT NULL,
+               tz_offset INTEGER NOT NULL DEFAULT 0,
+               started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+               finished_at TIMESTAMP,
+               UNIQUE (run_date, tz_offset)
+           )''',
+        '''INSERT INTO reminder_runs_new (id, run_date, started_at, finished_at)
+           SELECT id, run_date, started_at, finished_at FROM reminder_runs''',
+        'DROP TABLE reminder_runs',
+        'ALTER TABLE reminder_runs_new RENAME TO reminder_runs',
+    ],
+    # 7: each unpaid invoice carries the local date of its next reminder (NULL once paid)
+    # and the last reminder stage sent, so a run reads one range of due work per cohort
+    [
+        'ALTER TABLE invoices ADD COLUMN next_reminder_at DATE',
+        'ALTER TABLE invoices ADD COLUMN reminder_stage TEXT',
+        f'''UPDATE invoices SET next_reminder_at = {dates.next_reminder_sql(
+                "date('now', '-2 days')", config.OVERDUE_REMINDER_INTERVALS)}
+           WHERE status = 'unpaid' ''',
+        '''CREATE INDEX IF NOT EXISTS idx_invoices_tz_next_reminder
+           ON invoices (tz_offset, next_reminder_at) WHERE next_reminder_at IS NOT NULL''',
+        'DROP INDEX IF EXISTS idx_invoices_tz_status_due',
+    ],
+    # 8: hot/cold split - paid invoices older than ARCHIVE_AFTER_DAYS move (same columns,
+    # same ids) to invoices_archive. Inserting there adds back to the summaries what the
+    # delete from invoices took out, so user_stats keeps covering the whole history
+    [
+        '''CREATE TABLE IF NOT EXISTS invoices_archive (
+               id INTEGER PRIMARY KEY,
+               user_id INTEGER NOT NULL,
+               client_name TEXT NOT NULL,
+               amount REAL NOT NULL,
+               currency TEXT,
+               due_date DATE NOT NULL,
+               status TEXT,
+               paid_date DATE,
+               notes TEXT,
+               created_at TIMESTAMP,
+               tz_offset INTEGER NOT NULL DEFAULT 0,
+               next_reminder_at DATE,
+               reminder_stage TEXT,
+               archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+           )''',
+        '''CREATE INDEX IF NOT EXISTS idx_invoices_archive_user_created
+           ON invoices_archive (user_id, created_at)''',
+        # Archival candidates, oldest payment first
+        '''CREATE INDEX IF NOT EXISTS idx_invoices_paid_date
+           ON invoices (paid_date) WHERE status = 'paid' ''',
+        f'''CREATE TRIGGER IF NOT EXISTS invoices_archive_stats_insert AFTER INSERT ON invoices_archive
+           BEGIN {_stats_delta('NEW', '+')} END''',
+        f'''CREATE TRIGGER IF NOT EXISTS invoices_archive_stats_delete AFTER DELETE ON invoices_archive
+           BEGIN {_stats_delta('OLD', '-')} END''',
+    ],
+    # 9: reminder log retention - rows past REMINDER_RETENTION_DAYS are rolled up into
+    # per-invoice, per-type counters and deleted
+    [
+        '''CREATE TABLE IF NOT EXISTS reminder_counts (
+               invoice_id INTEGER NOT NULL,
+               reminder_type TEXT NOT NULL,
+               sent_count INTEGER NOT NULL DEFAULT 0,
+               first_date DATE,
+               last_date DATE,
+               PRIMARY KEY (invoice_id, reminder_type)
+           ) WITHOUT ROWID''',
+        '''CREATE INDEX IF NOT EXISTS idx_reminders_date
+           ON reminders (reminder_date)''',
+    ],
+    # 10: invoices of a user with no users row keep tz_offset 0 (migration 6's trigger
+    # copied the missing offset as NULL into the NOT NULL column)
+    [
+        'DROP TRIGGER IF EXISTS invoices_tz_insert',
+        '''CREATE TRIGGER invoices_tz_insert AFTER INSERT ON invoices
+           WHEN NEW.tz_offset IS NOT COALESCE(
+               (SELECT tz_offset FROM users WHERE telegram_id = NEW.user_id), 0)
+           BEGIN
+               UPDATE invoices SET tz_offset = COALESCE(
+                   (SELECT tz_offset FROM users WHERE telegram_id = NEW.user_id), 0
+               ) WHERE id = NEW.id;
+           END''',
+    ],
+    # 11: interval jobs no longer record job_runs rows; drop the ones daily_reminders
+    # left behind every REMINDER_TICK_MINUTES
+    [
+        "DELETE FROM job_runs WHERE name = 'daily_reminders'",
+    ],
+    # 12: only Pro users' invoices carry a next_reminder_at, so reminder runs never
+    # read or reschedule invoices of users who get no reminders
+    [
+        f'''UPDATE invoices SET next_reminder_at = NULL
+           WHERE next_reminder_at IS NOT NULL AND user_id NOT IN (
+               SELECT telegram_id FROM users WHERE subscription_tier = '{config.TIER_PRO}'
+           )''',
+    ],
+]
+
+def migrate(conn) -> int:
+    """Apply pending schema migrations, each in its own transaction; returns the schema version"""
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    
+    for number in range(version + 1, len(MIGRATIONS) + 1):
+        try:
+            conn.execute('BEGIN')
+            for statement in MIGRATIONS[number - 1]:
+                conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {number}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        version = number
+    
+    return version
+
+def close_db():
+    """Close all pooled database connections (call on shutdown)"""
+    close_all()
+    user_cache.clear()
+
+def user_cache_stats() -> Dict:
+    """Get hit/miss counters for the user cache"""
+    return user_cache.stats()
+
 def get_user(telegram_id: int) -> Optional[Dict]:
     """Get user by Telegram ID"""
-    conn = sqlite3.connect(config.DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+    user = user_cache.get(telegram_id)
+    if user is not None:
+        return dict(user)
+    
+    # A write committing while we read bumps the generation, so a stale row isn't cached
+    generation = user_cache.generation(telegram_id)
+    cursor = get_connection().cursor()
     
     cursor.execute('SELECT * FROM users WHERE telegram_id = ?', (telegram_id,))
     row = cursor.fetchone()
-    conn.close()
+    if not row:
+        return None
     
-    return dict(row) if row else None
+    user = dict(row)
+    user_cache.set(telegram_id, user, generation)
+    return dict(user)
 
 def create_user(telegram_id: int, username: str = None, first_name: str = None) -> Dict:
     """Create new user"""
-    conn = sqlite3.connect(config.DB_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        INSERT INTO users (telegram_id, username, first_name)
-        VALUES (?, ?, ?)
-    ''', (telegram_id, username, first_name))
-    
-    conn.commit()
-    conn.close()
+    with transaction() as cursor:
+        cursor.execute('''
+            INSERT INTO users (telegram_id, username, first_name)
+            VALUES (?, ?, ?)
+        ''', (telegram_id, username, first_name))
+    user_cache.invalidate(telegram_id)
     
     return get_user(telegram_id)
 
@@ -94,28 +403,63 @@ def get_or_create_user(telegram_id: int, username: str = None, first_name: str =
         user = create_user(telegram_id, username, first_name)
     return user
 
+# New invoices are scheduled from two days back, which is before "today" in every
+# timezone, so none is scheduled past its first reminder; a run that picks one up
+# early just reschedules it. Only Pro users get reminders, so only their invoices are
+# scheduled (update_user_subscription schedules or clears them when the tier changes)
+_NEXT_REMINDER = f'''CASE
+    WHEN (SELECT subscription_tier FROM users WHERE telegram_id = :user_id) = '{config.TIER_PRO}'
+    THEN {dates.next_reminder_sql(':scheduled_from', config.OVERDUE_REMINDER_INTERVALS, ':due_date')}
+END'''
+
+_INSERT_INVOICE = f'''
+    INSERT INTO invoices (user_id, client_name, amount, currency, due_date, notes, next_reminder_at)
+    VALUES (:user_id, :client_name, :amount, :currency, :due_date, :notes, {_NEXT_REMINDER})
+'''
+
+# The same, but only while the user has fewer than :max_unpaid unpaid invoices; the
+# count is taken per row inside the INSERT, so the free plan cap needs no held lock
+_INSERT_INVOICE_WITHIN_LIMIT = f'''
+    INSERT INTO invoices (user_id, client_name, amount, currency, due_date, notes, next_reminder_at)
+    SELECT :user_id, :client_name, :amount, :currency, :due_date, :notes, {_NEXT_REMINDER}
+    WHERE (SELECT COUNT(*) FROM invoices WHERE user_id = :user_id AND status = 'unpaid') < :max_unpaid
+'''
+
+def _scheduled_from() -> date:
+    return date.today() - timedelta(days=2)
+
 def create_invoice(user_id: int, client_name: str, amount: float, 
                    due_date: date, currency: str = 'USD', notes: str = None) -> int:
     """Create new invoice and return ID"""
-    conn = sqlite3.connect(config.DB_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        INSERT INTO invoices (user_id, client_name, amount, currency, due_date, notes)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', (user_id, client_name, amount, currency, due_date, notes))
-    
-    invoice_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    with transaction() as cursor:
+        cursor.execute(_INSERT_INVOICE, {
+            'user_id': user_id, 'client_name': client_name, 'amount': amount, 'currency': currency,
+            'due_date': due_date, 'notes': notes, 'scheduled_from': _scheduled_from()
+        })
+        
+        invoice_id = cursor.lastrowid
     
     return invoice_id
 
+def create_invoices(user_id: int, rows: Iterable[Tuple[str, float, str, date, Optional[str]]],
+                    max_unpaid: int = None) -> int:
+    """Insert (client_name, amount, currency, due_date, notes) rows in one transaction.
+    With max_unpaid, rows that would take the user past that many unpaid invoices are
+    skipped. Returns the number inserted"""
+    scheduled_from = _scheduled_from()
+    sql = _INSERT_INVOICE if max_unpaid is None else _INSERT_INVOICE_WITHIN_LIMIT
+    with transaction() as cursor:
+        cursor.executemany(sql, (
+            {'user_id': user_id, 'client_name': client_name, 'amount': amount, 'currency': currency,
+             'due_date': due_date, 'notes': notes, 'scheduled_from': scheduled_from,
+             'max_unpaid': max_unpaid}
+            for client_name, amount, currency, due_date, notes in rows
+        ))
+        return cursor.rowcount
+
 def get_unpaid_invoices(user_id: int) -> List[Dict]:
     """Get all unpaid invoices for user"""
-    conn = sqlite3.connect(config.DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+    cursor = get_connection().cursor()
     
     cursor.execute('''
         SELECT * FROM invoices 
@@ -124,80 +468,211 @@ def get_unpaid_invoices(user_id: int) -> List[Dict]:
     ''', (user_id,))
     
     rows = cursor.fetchall()
-    conn.close()
     
     return [dict(row) for row in rows]
 
+_COLUMN_LIST = ', '.join(INVOICE_COLUMNS)
+# Hot and archived invoices as one relation. SQLite pushes outer WHERE terms into both
+# arms, and with ORDER BY ... LIMIT merges their index order instead of sorting
+_ALL_INVOICES = f'''(
+    SELECT {_COLUMN_LIST} FROM invoices
+    UNION ALL
+    SELECT {_COLUMN_LIST} FROM invoices_archive
+)'''
+
+def _has_archived(cursor, user_id: int, created_since: str = None) -> bool:
+    """Whether the user has archived invoices (created at or after created_since, if given).
+    One probe of idx_invoices_archive_user_created; reads union the archive only if it is true"""
+    cursor.execute('''
+        SELECT 1 FROM invoices_archive WHERE user_id = ? AND created_at >= ? LIMIT 1
+    ''', (user_id, created_since or ''))
+    return cursor.fetchone() is not None
+
 def get_all_invoices(user_id: int, limit: int = 50) -> List[Dict]:
-    """Get all invoices for user (paid and unpaid)"""
-    conn = sqlite3.connect(config.DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+    """Get all invoices for user (paid and unpaid), newest first, archived ones included"""
+    cursor = get_connection().cursor()
     
-    cursor.execute('''
-        SELECT * FROM invoices 
+    cursor.execute(f'''
+        SELECT {_COLUMN_LIST} FROM invoices 
         WHERE user_id = ?
         ORDER BY created_at DESC
         LIMIT ?
     ''', (user_id, limit))
     
     rows = cursor.fetchall()
-    conn.close()
+    
+    # Archived rows only matter if they fill a short page or sort in among these
+    since = rows[-1]['created_at'] if len(rows) == limit else None
+    if _has_archived(cursor, user_id, since):
+        cursor.execute(f'''
+            SELECT * FROM {_ALL_INVOICES}
+            WHERE user_id = ?
+            ORDER BY created_at DESC
+            LIMIT ?
+        ''', (user_id, limit))
+        rows = cursor.fetchall()
     
     return [dict(row) for row in rows]
 
-def mark_invoice_paid(invoice_id: int, paid_date: date = None) -> bool:
-    """Mark invoice as paid"""
-    if paid_date is None:
-        paid_date = date.today()
+def _keyset_page(cursor, where: str, params: Dict, key: str, descending: bool,
+                 after: Tuple = None, before: Tuple = None, limit: int = None,
+                 columns: str = '*', source: str = 'invoices') -> Dict:
+    """Fetch one page ordered by (key, id) starting after/before a cursor row value.
+    Reads one extra row to learn whether another page exists in that direction"""
+    limit = limit or config.INVOICE_PAGE_SIZE
+    backwards = before is not None
+    # Walking backwards flips both the comparison and the sort order
+    newer = descending != backwards
+    op, order = ('<', 'DESC') if newer else ('>', 'ASC')
     
-    conn = sqlite3.connect(config.DB_PATH)
-    cursor = conn.cursor()
+    params = dict(params, limit=limit + 1)
+    boundary = before if backwards else after
+    if boundary is not None:
+        where += f' AND ({key}, id) {op} (:key_value, :key_id)'
+        params['key_value'], params['key_id'] = boundary
     
-    cursor.execute('''
-        UPDATE invoices 
-        SET status = 'paid', paid_date = ?
-        WHERE id = ?
-    ''', (paid_date, invoice_id))
+    cursor.execute(f'''
+        SELECT {columns} FROM {source}
+        WHERE {where}
+        ORDER BY {key} {order}, id {order}
+        LIMIT :limit
+    ''', params)
     
-    success = cursor.rowcount > 0
-    conn.commit()
-    conn.close()
+    rows = [dict(row) for row in cursor.fetchmany(limit + 1)]
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if backwards:
+        rows.reverse()
+        return {'invoices': rows, 'has_prev': more, 'has_next': True}
+    return {'invoices': rows, 'has_prev': boundary is not None, 'has_next': more}
+
+def get_unpaid_invoices_page(user_id: int, after: Tuple = None, before: Tuple = None,
+                             limit: int = None, today: date = None) -> Dict:
+    """One page of unpaid invoices, soonest due first, keyed on (due_date, id), with
+    'days_until' and 'bucket' computed in SQL.
+    Returns {'invoices': [...], 'has_prev': bool, 'has_next': bool}"""
+    days_until = dates.days_until_sql()
+    return _keyset_page(get_connection().cursor(), "user_id = :user_id AND status = 'unpaid'",
+                        {'user_id': user_id, 'today': today or date.today()},
+                        'due_date', False, after, before, limit,
+                        f'*, {days_until} AS days_until, {dates.bucket_sql(days_until)} AS bucket')
+
+def get_invoices_page(user_id: int, after: Tuple = None, before: Tuple = None,
+                      limit: int = None) -> Dict:
+    """One page of all invoices, newest first, keyed on (created_at, id), archived ones included"""
+    cursor = get_connection().cursor()
+    source = _ALL_INVOICES if _has_archived(cursor, user_id) else 'invoices'
+    return _keyset_page(cursor, 'user_id = :user_id', {'user_id': user_id},
+                        'created_at', True, after, before, limit, _COLUMN_LIST, source)
+
+EXPORT_COLUMNS = ('id', 'client_name', 'amount', 'currency', 'due_date', 'status',
+                  'paid_date', 'notes', 'created_at')
+
+def iter_invoices(user_id: int, status: str = None, due_from: date = None, due_to: date = None,
+                  chunk_size: int = None) -> Iterator[Tuple]:
+    """Stream a user's invoices as EXPORT_COLUMNS tuples, oldest first, fetchmany() at a time.
+    Walks idx_invoices_user_created in order so SQLite never has to sort (or hold) the result;
+    archived invoices (all paid) are merged in along their own created_at index when present"""
+    chunk_size = chunk_size or config.EXPORT_CHUNK_SIZE
+    conditions, params = ['user_id = ?'], [user_id]
+    # Unary + keeps these as filters so the planner stays on the created_at index
+    if status:
+        conditions.append('+status = ?')
+        params.append(status)
+    if due_from:
+        conditions.append('+due_date >= ?')
+        params.append(due_from)
+    if due_to:
+        conditions.append('+due_date <= ?')
+        params.append(due_to)
     
-    return success
+    cursor = get_connection().cursor()
+    select = f"SELECT {', '.join(EXPORT_COLUMNS)} FROM %s WHERE {' AND '.join(conditions)}"
+    query = select % 'invoices'
+    if status != 'unpaid' and _has_archived(cursor, user_id):
+        # A compound ORDER BY merges both index walks; sorting a UNION ALL subquery
+        # would build the whole export in a temp b-tree first
+        query += ' UNION ALL ' + select % 'invoices_archive'
+        params += params
+    cursor.execute(query + ' ORDER BY created_at, id', params)
+    
+    try:
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                yield tuple(row)
+    finally:
+        cursor.close()
 
-def delete_invoice(invoice_id: int, user_id: int) -> bool:
-    """Delete invoice (only if belongs to user)"""
-    conn = sqlite3.connect(config.DB_PATH)
-    cursor = conn.cursor()
+def mark_invoice_paid(invoice_id: int, user_id: int, paid_date: date = None) -> Optional[Dict]:
+    """Mark one of the user's unpaid invoices as paid in one conditional UPDATE.
+    Returns the updated invoice, or None if nothing matched"""
+    if paid_date is None:
+        paid_date = date.today()
     
-    cursor.execute('''
-        DELETE FROM invoices 
-        WHERE id = ? AND user_id = ?
-    ''', (invoice_id, user_id))
+    with transaction() as cursor:
+        cursor.execute('''
+            UPDATE invoices 
+            SET status = 'paid', paid_date = :paid_date, next_reminder_at = NULL
+            WHERE id = :id AND user_id = :user_id AND status = 'unpaid'
+            RETURNING *
+        ''', {'id': invoice_id, 'user_id': user_id, 'paid_date': paid_date})
+        
+        row = cursor.fetchone()
     
-    success = cursor.rowcount > 0
-    conn.commit()
-    conn.close()
+    return dict(row) if row else None
+
+def mark_invoices_paid(invoice_ids: Iterable[int], user_id: int, paid_date: date = None) -> List[Dict]:
+    """Mark a batch of the user's unpaid invoices as paid with one UPDATE ... WHERE id IN (...).
+    Returns the invoices that changed, by id; others were missing, not theirs or already paid"""
+    ids = list(dict.fromkeys(invoice_ids))
+    if not ids:
+        return []
+    if paid_date is None:
+        paid_date = date.today()
+    
+    with transaction() as cursor:
+        cursor.execute(f'''
+            UPDATE invoices
+            SET status = 'paid', paid_date = ?, next_reminder_at = NULL
+            WHERE id IN ({', '.join('?' * len(ids))}) AND user_id = ? AND status = 'unpaid'
+            RETURNING *
+        ''', (paid_date, *ids, user_id))
+        
+        rows = cursor.fetchall()
     
-    return success
+    return sorted((dict(row) for row in rows), key=lambda inv: inv['id'])
+
+def delete_invoice(invoice_id: int, user_id: int) -> Optional[Dict]:
+    """Delete invoice (only if belongs to user); returns the deleted invoice or None"""
+    with transaction() as cursor:
+        cursor.execute('''
+            DELETE FROM invoices 
+            WHERE id = ? AND user_id = ?
+            RETURNING *
+        ''', (invoice_id, user_id))
+        
+        row = cursor.fetchone()
+    
+    return dict(row) if row else None
 
 def get_invoice(invoice_id: int) -> Optional[Dict]:
-    """Get invoice by ID"""
-    conn = sqlite3.connect(config.DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+    """Get invoice by ID (falling back to the archive, which keeps the original IDs)"""
+    cursor = get_connection().cursor()
     
-    cursor.execute('SELECT * FROM invoices WHERE id = ?', (invoice_id,))
+    cursor.execute(f'SELECT {_COLUMN_LIST} FROM invoices WHERE id = ?', (invoice_id,))
     row = cursor.fetchone()
-    conn.close()
+    if row is None:
+        cursor.execute(f'SELECT {_COLUMN_LIST} FROM invoices_archive WHERE id = ?', (invoice_id,))
+        row = cursor.fetchone()
     
     return dict(row) if row else None
 
 def count_unpaid_invoices(user_id: int) -> int:
     """Count unpaid invoices for user"""
-    conn = sqlite3.connect(config.DB_PATH)
-    cursor = conn.cursor()
+    cursor = get_connection().cursor()
     
     cursor.execute('''
         SELECT COUNT(*) FROM invoices 
@@ -205,96 +680,463 @@ def count_unpaid_invoices(user_id: int) -> int:
     ''', (user_id,))
     
     count = cursor.fetchone()[0]
-    conn.close()
     
     return count
 
+def archive_paid_invoices(older_than_days: int = None, batch_size: int = None,
+                          today: date = None) -> int:
+    """Move one batch of invoices paid more than older_than_days ago (oldest payment first)
+    to invoices_archive in one short transaction. Returns how many moved; fewer than
+    batch_size means nothing is left to archive"""
+    older_than_days = config.ARCHIVE_AFTER_DAYS if older_than_days is None else older_than_days
+    batch_size = batch_size or config.ARCHIVE_BATCH_SIZE
+    cutoff = (today or date.today()) - timedelta(days=older_than_days)
+    
+    with transaction() as cursor:
+        cursor.execute('''
+            SELECT id FROM invoices
+            WHERE status = 'paid' AND paid_date < ?
+            ORDER BY paid_date, id
+            LIMIT ?
+        ''', (cutoff, batch_size))
+        ids = [row[0] for row in cursor.fetchall()]
+        if not ids:
+            return 0
+        
+        placeholders = ', '.join('?' * len(ids))
+        cursor.execute(f'''
+            INSERT INTO invoices_archive ({_COLUMN_LIST})
+            SELECT {_COLUMN_LIST} FROM invoices
+            WHERE id IN ({placeholders}) AND status = 'paid'
+        ''', ids)
+        cursor.execute(f'''
+            DELETE FROM invoices WHERE id IN ({placeholders}) AND status = 'paid'
+        ''', ids)
+        return cursor.rowcount
+
 def get_revenue_stats(user_id: int, period: str = 'month') -> Dict:
-    """Get revenue statistics for user"""
-    conn = sqlite3.connect(config.DB_PATH)
-    cursor = conn.cursor()
+    """Get revenue statistics for user (from the trigger-maintained summary tables, which
+    already count archived invoices, so no read of invoices_archive is needed)"""
+    cursor = get_connection().cursor()
     
     # This month's paid invoices
     cursor.execute('''
-        SELECT SUM(amount) as total, COUNT(*) as count
-        FROM invoices
-        WHERE user_id = ? 
-        AND status = 'paid'
-        AND strftime('%Y-%m', paid_date) = strftime('%Y-%m', 'now')
+        SELECT paid_total, paid_count
+        FROM user_monthly_revenue
+        WHERE user_id = ? AND month = strftime('%Y-%m', 'now')
     ''', (user_id,))
     
-    month_data = cursor.fetchone()
+    month_data = cursor.fetchone() or (0, 0)
     
-    # All time stats
+    # All time and outstanding
     cursor.execute('''
-        SELECT SUM(amount) as total, COUNT(*) as count
-        FROM invoices
-        WHERE user_id = ? AND status = 'paid'
-    ''', (user_id,))
-    
-    all_time_data = cursor.fetchone()
-    
-    # Outstanding amount
-    cursor.execute('''
-        SELECT SUM(amount) as total
-        FROM invoices
-        WHERE user_id = ? AND status = 'unpaid'
+        SELECT paid_total, paid_count, outstanding_total
+        FROM user_stats
+        WHERE user_id = ?
     ''', (user_id,))
     
-    outstanding = cursor.fetchone()[0] or 0
-    
-    conn.close()
+    totals = cursor.fetchone() or (0, 0, 0)
     
     return {
         'month_total': month_data[0] or 0,
         'month_count': month_data[1] or 0,
-        'all_time_total': all_time_data[0] or 0,
-        'all_time_count': all_time_data[1] or 0,
-        'outstanding': outstanding
+        'all_time_total': totals[0] or 0,
+        'all_time_count': totals[1] or 0,
+        'outstanding': totals[2] or 0
     }
 
+def check_user_stats() -> List[Dict]:
+    """Rebuild the revenue summaries from scratch and diff them against the live tables.
+    Returns one entry per mismatching row (empty list = consistent)."""
+    cursor = get_connection().cursor()
+    mismatches = []
+    
+    checks = [
+        ('user_stats', ('user_id',),
+         ('paid_total', 'paid_count', 'outstanding_total', 'outstanding_count'),
+         _USER_STATS_REBUILD),
+        ('user_monthly_revenue', ('user_id', 'month'),
+         ('paid_total', 'paid_count'),
+         _MONTHLY_REVENUE_REBUILD),
+    ]
+    
+    for table, key_cols, value_cols, rebuild_sql in checks:
+        width = len(key_cols)
+        cursor.execute(rebuild_sql)
+        expected = {tuple(row[:width]): tuple(row[width:]) for row in cursor.fetchall()}
+        cursor.execute(f"SELECT {', '.join(key_cols + value_cols)} FROM {table}")
+        live = {tuple(row[:width]): tuple(row[width:]) for row in cursor.fetchall()}
+        
+        zeros = (0,) * len(value_cols)
+        for key in expected.keys() | live.keys():
+            want = expected.get(key, zeros)
+            got = live.get(key, zeros)
+            if any(abs((a or 0) - (b or 0)) > 0.005 for a, b in zip(want, got)):
+                mismatches.append({
+                    'table': table,
+                    'key': key,
+                    'expected': dict(zip(value_cols, want)),
+                    'live': dict(zip(value_cols, got))
+                })
+    
+    return mismatches
+
+def rebuild_user_stats():
+    """Recompute the revenue summary tables from invoices and invoices_archive"""
+    with transaction() as cursor:
+        cursor.execute('DELETE FROM user_stats')
+        cursor.execute('DELETE FROM user_monthly_revenue')
+        cursor.execute(f'INSERT INTO user_stats {_USER_STATS_REBUILD}')
+        cursor.execute(f'INSERT INTO user_monthly_revenue {_MONTHLY_REVENUE_REBUILD}')
+
 def update_user_subscription(telegram_id: int, tier: str, expires: datetime = None, 
                              stripe_customer_id: str = None):
-    """Update user subscription tier"""
-    conn = sqlite3.connect(config.DB_PATH)
-    cursor = conn.cursor()
-    
+    """Update user subscription tier, scheduling reminders for the user's unpaid invoices
+    on an upgrade to Pro and clearing them on a downgrade"""
+    with transaction() as cursor:
+        cursor.execute('''
+            UPDATE users 
+            SET subscription_tier = ?, 
+                subscription_expires = ?,
+                stripe_customer_id = COALESCE(?, stripe_customer_id)
+            WHERE telegram_id = ?
+        ''', (tier, expires, stripe_customer_id, telegram_id))
+        if tier == config.TIER_PRO:
+            cursor.execute(f'''
+                UPDATE invoices
+                SET next_reminder_at = {dates.next_reminder_sql(
+                    ':scheduled_from', config.OVERDUE_REMINDER_INTERVALS)}
+                WHERE user_id = :user_id AND status = 'unpaid' AND next_reminder_at IS NULL
+            ''', {'scheduled_from': _scheduled_from(), 'user_id': telegram_id})
+        else:
+            cursor.execute('''
+                UPDATE invoices SET next_reminder_at = NULL
+                WHERE user_id = ? AND next_reminder_at IS NOT NULL
+            ''', (telegram_id,))
+    user_cache.invalidate(telegram_id)
+
+def update_user_timezone(telegram_id: int, tz_offset: int):
+    """Set a user's UTC offset in minutes (a trigger copies it onto their invoices)"""
+    with transaction() as cursor:
+        cursor.execute('''
+            UPDATE users SET tz_offset = ? WHERE telegram_id = ?
+        ''', (tz_offset, telegram_id))
+    user_cache.invalidate(telegram_id)
+
+def get_pending_reminder_cohorts(utc_now: datetime) -> List[int]:
+    """tz_offsets of Pro users whose reminder run for their current local date isn't finished.
+    Runs every REMINDER_TICK_MINUTES, so the distinct offsets are found by hopping from one
+    to the next on idx_users_tier_tz (one seek per cohort) rather than reading every Pro user"""
+    cursor = get_connection().cursor()
     cursor.execute('''
-        UPDATE users 
-        SET subscription_tier = ?, 
-            subscription_expires = ?,
-            stripe_customer_id = COALESCE(?, stripe_customer_id)
-        WHERE telegram_id = ?
-    ''', (tier, expires, stripe_customer_id, telegram_id))
+        WITH RECURSIVE cohorts(tz_offset) AS (
+            SELECT MIN(tz_offset) FROM users WHERE subscription_tier = :tier
+            UNION ALL
+            SELECT (SELECT MIN(u.tz_offset) FROM users u
+                    WHERE u.subscription_tier = :tier AND u.tz_offset > cohorts.tz_offset)
+            FROM cohorts WHERE cohorts.tz_offset IS NOT NULL
+        )
+        SELECT c.tz_offset FROM cohorts c
+        WHERE c.tz_offset IS NOT NULL
+        AND NOT EXISTS (
+            SELECT 1 FROM reminder_runs r
+            WHERE r.run_date = date(:now, c.tz_offset || ' minutes')
+            AND r.tz_offset = c.tz_offset
+            AND r.finished_at IS NOT NULL
+        )
+        ORDER BY c.tz_offset DESC
+    ''', {'tier': config.TIER_PRO, 'now': utc_now})
+    return [row[0] for row in cursor.fetchall()]
+
+def log_reminder(invoice_id: int, reminder_type: str, reminder_date: date = None):
+    """Log that a reminder was sent (ignored if already logged for that day)"""
+    log_reminders([(invoice_id, reminder_type)], reminder_date)
+
+def _insert_reminders(cursor, entries: List[Tuple[int, str]], reminder_date: date):
+    cursor.executemany('''
+        INSERT OR IGNORE INTO reminders (invoice_id, reminder_type, reminder_date)
+        VALUES (?, ?, ?)
+    ''', [(invoice_id, reminder_type, reminder_date) for invoice_id, reminder_type in entries])
+
+def log_reminders(entries: Iterable[Tuple[int, str]], reminder_date: date = None) -> int:
+    """Log many sent reminders as (invoice_id, reminder_type) in one transaction"""
+    if reminder_date is None:
+        reminder_date = date.today()
     
-    conn.commit()
-    conn.close()
+    entries = list(entries)
+    if not entries:
+        return 0
+    
+    with transaction() as cursor:
+        _insert_reminders(cursor, entries, reminder_date)
+    
+    return len(entries)
 
-def log_reminder(invoice_id: int, reminder_type: str):
-    """Log that a reminder was sent"""
-    conn = sqlite3.connect(config.DB_PATH)
-    cursor = conn.cursor()
+def prune_reminders(older_than_days: int = None, batch_size: int = None,
+                    today: date = None) -> Dict:
+    """Roll one batch of reminder rows older than older_than_days (oldest first) into
+    reminder_counts and delete them, in one short transaction.
+    Returns {'pruned': rows, 'seconds': how long the write lock was held}"""
+    older_than_days = config.REMINDER_RETENTION_DAYS if older_than_days is None else older_than_days
+    batch_size = batch_size or config.REMINDER_PRUNE_BATCH_SIZE
+    cutoff = (today or date.today()) - timedelta(days=older_than_days)
     
+    cursor = get_connection().cursor()
     cursor.execute('''
-        INSERT INTO reminders (invoice_id, reminder_type)
-        VALUES (?, ?)
-    ''', (invoice_id, reminder_type))
+        SELECT id FROM reminders WHERE reminder_date < ? ORDER BY reminder_date LIMIT ?
+    ''', (cutoff, batch_size))
+    ids = [row[0] for row in cursor.fetchall()]
+    if not ids:
+        return {'pruned': 0, 'seconds': 0.0}
     
-    conn.commit()
-    conn.close()
+    placeholders = ', '.join('?' * len(ids))
+    start = time.perf_counter()
+    with transaction() as cursor:
+        cursor.execute(f'''
+            INSERT INTO reminder_counts (invoice_id, reminder_type, sent_count, first_date, last_date)
+            SELECT invoice_id, reminder_type, COUNT(*), MIN(reminder_date), MAX(reminder_date)
+            FROM reminders
+            WHERE id IN ({placeholders})
+            GROUP BY invoice_id, reminder_type
+            ON CONFLICT (invoice_id, reminder_type) DO UPDATE SET
+                sent_count = sent_count + excluded.sent_count,
+                first_date = MIN(first_date, excluded.first_date),
+                last_date = MAX(last_date, excluded.last_date)
+        ''', ids)
+        cursor.execute(f'DELETE FROM reminders WHERE id IN ({placeholders})', ids)
+        pruned = cursor.rowcount
+    return {'pruned': pruned, 'seconds': time.perf_counter() - start}
 
-def get_all_users_for_reminders() -> List[int]:
-    """Get all user IDs who have unpaid invoices for reminder checking"""
-    conn = sqlite3.connect(config.DB_PATH)
-    cursor = conn.cursor()
+def get_reminder_counts(invoice_id: int) -> Dict[str, int]:
+    """Reminders sent for an invoice by type: rolled-up counters plus rows not yet pruned"""
+    cursor = get_connection().cursor()
+    cursor.execute('''
+        SELECT reminder_type, sent_count FROM reminder_counts WHERE invoice_id = ?
+    ''', (invoice_id,))
+    counts = dict(cursor.fetchall())
+    cursor.execute('''
+        SELECT reminder_type, COUNT(*) FROM reminders WHERE invoice_id = ? GROUP BY reminder_type
+    ''', (invoice_id,))
+    for reminder_type, sent in cursor.fetchall():
+        counts[reminder_type] = counts.get(reminder_type, 0) + sent
+    return counts
+
+def database_space() -> Dict:
+    """Database file usage: page size, total and free pages, and the auto_vacuum mode
+    (0 none, 1 full, 2 incremental)"""
+    conn = get_connection()
+    return {pragma: conn.execute(f'PRAGMA {pragma}').fetchone()[0]
+            for pragma in ('page_size', 'page_count', 'freelist_count', 'auto_vacuum')}
+
+def incremental_vacuum(pages: int = None) -> Dict:
+    """Hand up to `pages` free pages back to the filesystem (the file itself shrinks at
+    the next WAL checkpoint). A no-op unless auto_vacuum is incremental.
+    Returns {'pages': freed, 'bytes': freed, 'seconds': how long the write lock was held}"""
+    pages = pages or config.VACUUM_PAGES_PER_STEP
+    before = database_space()
+    if before['auto_vacuum'] != 2 or not before['freelist_count']:
+        return {'pages': 0, 'bytes': 0, 'seconds': 0.0}
+    
+    start = time.perf_counter()
+    # executescript() steps the pragma to completion; execute() would free a single page
+    get_connection().executescript(f'PRAGMA incremental_vacuum({int(pages)})')
+    seconds = time.perf_counter() - start
+    
+    freed = before['page_count'] - database_space()['page_count']
+    return {'pages': freed, 'bytes': freed * before['page_size'], 'seconds': seconds}
+
+def enable_incremental_vacuum():
+    """Switch a database created without auto_vacuum = INCREMENTAL over. VACUUM rewrites
+    the whole file under the write lock, so run this once, while the bot is stopped"""
+    conn = get_connection()
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    conn.execute('VACUUM')
+
+def start_reminder_run(run_date: date = None, tz_offset: int = 0) -> Dict:
+    """Get a cohort's reminder run for a day from the ledger, creating it on the first attempt"""
+    if run_date is None:
+        run_date = date.today()
+    
+    with transaction() as cursor:
+        cursor.execute('''
+            INSERT OR IGNORE INTO reminder_runs (run_date, tz_offset) VALUES (?, ?)
+        ''', (run_date, tz_offset))
+        cursor.execute('''
+            SELECT * FROM reminder_runs WHERE run_date = ? AND tz_offset = ?
+        ''', (run_date, tz_offset))
+        run = dict(cursor.fetchone())
+    
+    return run
+
+def finish_reminder_run(run_id: int):
+    """Mark a reminder run as complete so reruns on the same day are no-ops"""
+    with transaction() as cursor:
+        cursor.execute('''
+            UPDATE reminder_runs SET finished_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (run_id,))
+
+def claim_job_run(name: str, scheduled_for: datetime, lease_seconds: float) -> bool:
+    """Claim one firing of a scheduled job; False if it already finished or another
+    run started it less than lease_seconds ago (a run that died is retried after that)"""
+    now = datetime.now()
+    with transaction() as cursor:
+        cursor.execute('''
+            INSERT INTO job_runs (name, scheduled_for, started_at) VALUES (?, ?, ?)
+            ON CONFLICT (name, scheduled_for) DO UPDATE SET started_at = excluded.started_at
+            WHERE job_runs.finished_at IS NULL AND job_runs.started_at < ?
+            RETURNING started_at
+        ''', (name, scheduled_for, now, now - timedelta(seconds=lease_seconds)))
+        return cursor.fetchone() is not None
+
+def finish_job_run(name: str, scheduled_for: datetime):
+    """Mark a claimed job firing as done"""
+    with transaction() as cursor:
+        cursor.execute('''
+            UPDATE job_runs SET finished_at = ? WHERE name = ? AND scheduled_for = ?
+        ''', (datetime.now(), name, scheduled_for))
+
+def record_reminder_run_users(run_id: int, run_date: date, delivered: Iterable[Tuple[int, List[Tuple[int, str]]]],
+                              failed: Iterable[int] = ()):
+    """Log delivered users' reminders and update their run state in one transaction.
+    delivered is [(user_id, [(invoice_id, reminder_type), ...]), ...]"""
+    delivered = list(delivered)
+    entries = [entry for _, user_entries in delivered for entry in user_entries]
+    states = [(run_id, user_id, 'done') for user_id, _ in delivered]
+    states.extend((run_id, user_id, 'failed') for user_id in failed)
     
+    with transaction() as cursor:
+        _insert_reminders(cursor, entries, run_date)
+        cursor.executemany('''
+            INSERT INTO reminder_run_users (run_id, user_id, state)
+            VALUES (?, ?, ?)
+            ON CONFLICT (run_id, user_id) DO UPDATE
+            SET state = excluded.state, updated_at = CURRENT_TIMESTAMP
+        ''', states)
+
+def save_conversation_state(states: Iterable[Tuple[str, str, object]],
+                            user_data: Iterable[Tuple[int, Optional[bytes]]]):
+    """Write a batch of conversation states and pickled user_data in one transaction.
+    A state or data of None deletes the row, so only live conversations are stored"""
+    states, user_data = list(states), list(user_data)
+    
+    with transaction() as cursor:
+        cursor.executemany('''
+            DELETE FROM conversation_states WHERE name = ? AND conversation_key = ?
+        ''', [(name, key) for name, key, state in states if state is None])
+        cursor.executemany('''
+            INSERT INTO conversation_states (name, conversation_key, state) VALUES (?, ?, ?)
+            ON CONFLICT (name, conversation_key) DO UPDATE SET state = excluded.state
+        ''', [row for row in states if row[2] is not None])
+        cursor.executemany('''
+            DELETE FROM conversation_user_data WHERE user_id = ?
+        ''', [(user_id,) for user_id, data in user_data if data is None])
+        cursor.executemany('''
+            INSERT INTO conversation_user_data (user_id, data) VALUES (?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET data = excluded.data
+        ''', [row for row in user_data if row[1] is not None])
+
+def get_conversation_states(name: str) -> List[Tuple[str, object]]:
+    """(conversation_key, state) for every live conversation of one handler"""
+    cursor = get_connection().cursor()
     cursor.execute('''
-        SELECT DISTINCT user_id 
-        FROM invoices 
-        WHERE status = 'unpaid'
-    ''')
+        SELECT conversation_key, state FROM conversation_states WHERE name = ?
+    ''', (name,))
+    return [tuple(row) for row in cursor.fetchall()]
+
+def get_conversation_user_data() -> List[Tuple[int, bytes]]:
+    """(user_id, pickled user_data) for every user with non-empty user_data"""
+    cursor = get_connection().cursor()
+    cursor.execute('SELECT user_id, data FROM conversation_user_data')
+    return [tuple(row) for row in cursor.fetchall()]
+
+def get_weekly_summaries(week_start: date, today: date, after_user_id: int = 0,
+                         limit: int = None) -> List[Dict]:
+    """Paid (from week_start up to, not including, today), outstanding and overdue totals
+    for the next `limit` Pro users after after_user_id, in one grouped pass. Users are
+    walked in telegram_id order, so callers page through everyone with the last user_id;
+    users with nothing to report are skipped"""
+    cursor = get_connection().cursor()
+    cursor.execute('''
+        SELECT u.telegram_id AS user_id,
+               SUM(CASE WHEN i.status = 'paid' THEN i.amount ELSE 0 END) AS paid_total,
+               SUM(i.status = 'paid') AS paid_count,
+               SUM(CASE WHEN i.status = 'unpaid' THEN i.amount ELSE 0 END) AS outstanding_total,
+               SUM(i.status = 'unpaid') AS outstanding_count,
+               SUM(CASE WHEN i.status = 'unpaid' AND i.due_date < :today THEN i.amount ELSE 0 END)
+                   AS overdue_total,
+               SUM(i.status = 'unpaid' AND i.due_date < :today) AS overdue_count
+        FROM users u
+        JOIN invoices i ON i.user_id = u.telegram_id
+        WHERE u.telegram_id > :after
+        AND +u.subscription_tier = :tier  -- walk users by rowid so GROUP BY needs no sort
+        AND (i.status = 'unpaid'
+             OR (i.status = 'paid' AND i.paid_date >= :week_start AND i.paid_date < :today))
+        GROUP BY u.telegram_id
+        ORDER BY u.telegram_id
+        LIMIT :limit
+    ''', {'today': today, 'week_start': week_start, 'after': after_user_id,
+          'tier': config.TIER_PRO, 'limit': limit or config.REMINDER_BATCH_SIZE})
+    return [dict(row) for row in cursor.fetchall()]
+
+def get_reminder_invoices(today: date = None, run_id: int = None,
+                          tz_offset: int = 0) -> List[Tuple[int, List[Dict]]]:
+    """Get one timezone cohort's Pro users' invoices with a reminder due on `today` (overdue /
+    due today / due tomorrow / due soon) in one query, grouped by user with 'days_until',
+    'bucket' and 'stage' columns. Only invoices whose next_reminder_at has come are read.
+    With run_id, users already marked done in that run are skipped."""
+    if today is None:
+        today = date.today()
     
-    user_ids = [row[0] for row in cursor.fetchall()]
-    conn.close()
+    cursor = get_connection().cursor()
     
-    return user_ids
+    cursor.execute(f'''
+        SELECT *, {dates.bucket_sql()} AS bucket, {dates.reminder_stage_sql()} AS stage
+        FROM (
+            SELECT i.*, {dates.days_until_sql(column='i.due_date')} AS days_until
+            FROM invoices i
+            JOIN users u ON u.telegram_id = i.user_id
+            WHERE i.tz_offset = :tz_offset
+            AND i.next_reminder_at <= :today
+            AND +i.status = 'unpaid'
+            AND u.subscription_tier = :tier
+            AND NOT EXISTS (
+                SELECT 1 FROM reminder_run_users r
+                WHERE r.run_id = :run_id AND r.user_id = i.user_id AND r.state = 'done'
+            )
+        )
+        WHERE stage IS NOT NULL
+        ORDER BY user_id, due_date, id
+    ''', {'today': today, 'tier': config.TIER_PRO, 'run_id': run_id, 'tz_offset': tz_offset})
+    
+    return [
+        (user_id, [dict(row) for row in rows])
+        for user_id, rows in groupby(cursor.fetchall(), key=lambda row: row['user_id'])
+    ]
+
+def advance_reminders(run_id: int, today: date, tz_offset: int = 0) -> int:
+    """Move every invoice of a cohort whose reminder came due by `today` on to its next
+    reminder date, recording the stage sent to users the run delivered to. Invoices of
+    users whose delivery failed stay due for the next run, and invoices created since
+    the run started are left for it too. Returns the number of invoices rescheduled"""
+    stage = dates.reminder_stage_sql(dates.days_until_sql())
+    with transaction() as cursor:
+        cursor.execute(f'''
+            UPDATE invoices
+            SET next_reminder_at = {dates.next_reminder_sql(':today', config.OVERDUE_REMINDER_INTERVALS)},
+                reminder_stage = CASE
+                    WHEN EXISTS (
+                        SELECT 1 FROM reminder_run_users r
+                        WHERE r.run_id = :run_id AND r.user_id = invoices.user_id AND r.state = 'done'
+                    ) THEN COALESCE({stage}, reminder_stage)
+                    ELSE reminder_stage
+                END
+            WHERE tz_offset = :tz_offset
+            AND next_reminder_at <= :today
+            AND created_at <= (SELECT started_at FROM reminder_runs WHERE id = :run_id)
+            AND NOT EXISTS (
+                SELECT 1 FROM reminder_run_users r
+                WHERE r.run_id = :run_id AND r.user_id = invoices.user_id AND r.state = 'failed'
+            )
+        ''', {'today': today, 'run_id': run_id, 'tz_offset': tz_offset})
+        return cursor.rowcount
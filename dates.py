@@ -0,0 +1,151 @@
+"""Due date parsing, urgency buckets and UTC offsets shared by the bot and reminders"""
+import re
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+MAX_PAST_DAYS = 365  # reject due dates older than this
+
+class DueDateTooOld(ValueError):
+    """Parsed fine, but the due date is implausibly far in the past"""
+
+def parse_due_date(text: str, today: date = None) -> date:
+    """Parse 'today', 'Nd' (N days from today) or YYYY-MM-DD.
+    Raises ValueError for anything else and DueDateTooOld for dates over a year back"""
+    today = today or date.today()
+    text = text.strip().lower()
+
+    if text == 'today':
+        due_date = today
+    elif text.endswith('d') and text[:-1].isdigit():
+        due_date = today + timedelta(days=int(text[:-1]))
+    else:
+        due_date = datetime.strptime(text, '%Y-%m-%d').date()
+
+    if due_date < today - timedelta(days=MAX_PAST_DAYS):
+        raise DueDateTooOld(f"{due_date} is more than {MAX_PAST_DAYS} days in the past")
+
+    return due_date
+
+# Urgency buckets by days until due. SQL computes days_until (and the bucket)
+# next to each row, so callers never parse dates or do date math per invoice.
+OVERDUE = 'overdue'
+DUE_TODAY = 'due_today'
+DUE_TOMORROW = 'due_tomorrow'
+DUE_SOON = 'due_soon'
+DUE_LATER = 'due_later'
+BUCKETS = (OVERDUE, DUE_TODAY, DUE_TOMORROW, DUE_SOON, DUE_LATER)
+SOON_DAYS = 7  # due_soon covers 2..SOON_DAYS days out
+
+def days_until_sql(today: str = ':today', column: str = 'due_date') -> str:
+    """SQL expression for whole days from `today` (a bound parameter) to `column`"""
+    return f"CAST(julianday({column}) - julianday({today}) AS INTEGER)"
+
+def bucket_sql(days_until: str = 'days_until') -> str:
+    """SQL CASE expression mapping a days_until expression to its bucket name"""
+    return f"""CASE
+        WHEN {days_until} < 0 THEN '{OVERDUE}'
+        WHEN {days_until} = 0 THEN '{DUE_TODAY}'
+        WHEN {days_until} = 1 THEN '{DUE_TOMORROW}'
+        WHEN {days_until} <= {SOON_DAYS} THEN '{DUE_SOON}'
+        ELSE '{DUE_LATER}'
+    END"""
+
+def classify(days_until: int) -> str:
+    """Python twin of bucket_sql() for a single value"""
+    if days_until < 0:
+        return OVERDUE
+    if days_until == 0:
+        return DUE_TODAY
+    if days_until == 1:
+        return DUE_TOMORROW
+    if days_until <= SOON_DAYS:
+        return DUE_SOON
+    return DUE_LATER
+
+def group_by_bucket(invoices: Iterable[Dict]) -> Dict[str, List[Dict]]:
+    """Split rows carrying a SQL-computed 'bucket' into {bucket: [rows]} in one pass,
+    keeping row order within each bucket"""
+    groups = {bucket: [] for bucket in BUCKETS}
+    for inv in invoices:
+        groups[inv['bucket']].append(inv)
+    return groups
+
+# UTC offsets are stored as whole minutes east of UTC (UTC+5:30 -> 330)
+MIN_TZ_OFFSET = -12 * 60
+MAX_TZ_OFFSET = 14 * 60
+_TZ_PATTERN = re.compile(r'^(?:utc|gmt)?\s*([+-]?)(\d{1,2})(?::?(\d{2}))?$')
+
+def parse_tz_offset(text: str) -> int:
+    """Parse 'UTC+5:30', '+0530', '-8', 'GMT' etc. into minutes; raises ValueError"""
+    text = text.strip().lower()
+    if text in ('utc', 'gmt', 'z'):
+        return 0
+    match = _TZ_PATTERN.match(text)
+    if not match:
+        raise ValueError(f"not a UTC offset: {text!r}")
+
+    sign, hours, minutes = match.groups()
+    offset = int(hours) * 60 + int(minutes or 0)
+    if sign == '-':
+        offset = -offset
+    if int(minutes or 0) % 15 or not MIN_TZ_OFFSET <= offset <= MAX_TZ_OFFSET:
+        raise ValueError(f"offset out of range: {text!r}")
+    return offset
+
+def format_tz_offset(offset: int) -> str:
+    """330 -> 'UTC+05:30'"""
+    sign = '-' if offset < 0 else '+'
+    hours, minutes = divmod(abs(offset), 60)
+    return f"UTC{sign}{hours:02d}:{minutes:02d}"
+
+# Reminder policy. An invoice gets a daily heads-up from SOON_DAYS until SOON_MIN_DAYS
+# days out, reminders the day before and on the day, then overdue reminders at the
+# intervals of the escalation policy: [(days overdue, remind every N days), ...].
+# Invoices store the date of their next reminder, so a run only reads what is due.
+SOON_MIN_DAYS = 3
+
+def reminder_stage_sql(days_until: str = 'days_until') -> str:
+    """SQL CASE expression: the reminder stage for a days_until value, NULL if none is due"""
+    return f"""CASE
+        WHEN {days_until} < 0 THEN '{OVERDUE}'
+        WHEN {days_until} = 0 THEN '{DUE_TODAY}'
+        WHEN {days_until} = 1 THEN '{DUE_TOMORROW}'
+        WHEN {days_until} BETWEEN {SOON_MIN_DAYS} AND {SOON_DAYS} THEN '{DUE_SOON}'
+    END"""
+
+def reminder_stage(days_until: int) -> Optional[str]:
+    """Python twin of reminder_stage_sql() for a single value"""
+    if days_until <= 1 or SOON_MIN_DAYS <= days_until <= SOON_DAYS:
+        return classify(days_until)
+    return None
+
+def next_reminder_sql(after: str, intervals: List[Tuple[int, int]], column: str = 'due_date') -> str:
+    """SQL date of the first reminder strictly after the date `after` (an SQL expression)"""
+    days = days_until_sql(after, column)
+    overdue = f"(-{days})"
+    interval = 'CASE'
+    for days_overdue, every in sorted(intervals, reverse=True):
+        interval += f" WHEN {overdue} >= {days_overdue} THEN {int(every)}"
+    interval += ' ELSE 1 END'
+    # Overdue reminders fall on multiples of the interval counted from the due date,
+    # so invoices due on different days are spread over different run days
+    return f"""CASE
+        WHEN {days} < 0 THEN date({after}, '+' || (({interval}) - {overdue} % ({interval})) || ' days')
+        WHEN {days} <= 1 THEN date({after}, '+1 day')
+        WHEN {days} <= {SOON_MIN_DAYS} THEN date({column}, '-1 day')
+        WHEN {days} <= {SOON_DAYS + 1} THEN date({after}, '+1 day')
+        ELSE date({column}, '-{SOON_DAYS} days')
+    END"""
+
+def next_reminder(due_date: date, after: date, intervals: List[Tuple[int, int]]) -> date:
+    """Python twin of next_reminder_sql()"""
+    days = (due_date - after).days
+    if days < 0:
+        every = [step for overdue, step in sorted(intervals) if -days >= overdue]
+        every = every[-1] if every else 1
+        return after + timedelta(days=every - -days % every)
+    if days <= 1 or SOON_MIN_DAYS < days <= SOON_DAYS + 1:
+        return after + timedelta(days=1)
+    if days <= SOON_MIN_DAYS:
+        return due_date - timedelta(days=1)
+    return due_date - timedelta(days=SOON_DAYS)
@@ -0,0 +1,105 @@
+"""Rate-limited, concurrent Telegram message dispatch for PayTrackBot"""
+import asyncio
+import logging
+import time
+from datetime import timedelta
+from typing import Dict, Iterable, List, Tuple
+from telegram.error import NetworkError, RetryAfter, TelegramError
+import config
+
+logger = logging.getLogger(__name__)
+
+class TokenBucket:
+    """Async token bucket: `rate` tokens per second, bursts of up to `capacity`"""
+
+    def __init__(self, rate: float, capacity: float = 1, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._tokens = capacity
+        self._updated = clock()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def pause(self, seconds: float):
+        """Stop handing out tokens for `seconds` (e.g. after a RetryAfter)"""
+        self._blocked_until = max(self._blocked_until, self._clock() + seconds)
+        self._tokens = 0
+
+    async def acquire(self):
+        """Wait until a token is available and take it (waiters are served FIFO)"""
+        async with self._lock:
+            while True:
+                now = self._clock()
+                if now < self._blocked_until:
+                    await asyncio.sleep(self._blocked_until - now)
+                    continue
+
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+def _seconds(retry_after) -> float:
+    """RetryAfter.retry_after is an int in some PTB versions and a timedelta in others"""
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+class Dispatcher:
+    """Send many messages concurrently within Telegram's global and per-chat limits"""
+
+    def __init__(self, bot, global_rate: float = None, per_chat_rate: float = None,
+                 max_in_flight: int = None, max_retries: int = None):
+        self.bot = bot
+        self.per_chat_rate = per_chat_rate or config.TELEGRAM_PER_CHAT_RATE
+        self.max_retries = config.TELEGRAM_MAX_RETRIES if max_retries is None else max_retries
+
+        self._global = TokenBucket(global_rate or config.TELEGRAM_GLOBAL_RATE)
+        self._chats: Dict[int, TokenBucket] = {}
+        self._in_flight = asyncio.Semaphore(max_in_flight or config.TELEGRAM_MAX_IN_FLIGHT)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.per_chat_rate)
+        return bucket
+
+    async def send(self, chat_id: int, text: str, **kwargs) -> bool:
+        """Send one message, retrying on flood control and network errors; True if delivered"""
+        async with self._in_flight:
+            for attempt in range(self.max_retries + 1):
+                # Per-chat first so we don't burn a global token while waiting on one chat
+                await self._chat_bucket(chat_id).acquire()
+                await self._global.acquire()
+
+                try:
+                    await self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                    return True
+                except RetryAfter as e:
+                    # Flood control applies to the whole bot, so everyone waits
+                    delay = _seconds(e.retry_after)
+                    logger.warning(f"Rate limited by Telegram, pausing sends for {delay:.1f}s")
+                    self._global.pause(delay)
+                except NetworkError as e:
+                    delay = config.TELEGRAM_RETRY_BACKOFF * (2 ** attempt)
+                    logger.warning(f"Network error sending to {chat_id} ({e}), retrying in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+                except TelegramError as e:
+                    logger.error(f"Failed to send message to {chat_id}: {e}")
+                    return False
+
+            logger.error(f"Giving up on message to {chat_id} after {self.max_retries + 1} attempts")
+            return False
+
+    async def send_many(self, messages: Iterable[Tuple[int, str, dict]]) -> List[bool]:
+        """Send (chat_id, text, kwargs) messages concurrently; returns delivery flags in order"""
+        return await asyncio.gather(*[
+            self.send(chat_id, text, **kwargs) for chat_id, text, kwargs in messages
+        ])
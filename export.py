@@ -0,0 +1,79 @@
+"""Streaming invoice export (CSV / JSON) for PayTrackBot"""
+import csv
+import io
+import json
+import tempfile
+from datetime import date
+from typing import IO, Iterable, Iterator, Tuple
+import config
+import database as db
+
+FORMATS = ('csv', 'json')
+
+class ExportTooLarge(ValueError):
+    """The export passed EXPORT_MAX_BYTES; streaming stopped after `count` invoices"""
+
+    def __init__(self, count: int):
+        super().__init__(f"export too large after {count} invoices")
+        self.count = count
+
+def write_csv(rows: Iterable[Tuple], out: IO[str]) -> int:
+    """Write a header and one line per row; returns the row count"""
+    writer = csv.writer(out)
+    writer.writerow(db.EXPORT_COLUMNS)
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+    return count
+
+def write_json(rows: Iterable[Tuple], out: IO[str]) -> int:
+    """Write a JSON array of objects one element at a time; returns the row count"""
+    out.write('[')
+    count = 0
+    for row in rows:
+        out.write(',\n' if count else '\n')
+        out.write(json.dumps(dict(zip(db.EXPORT_COLUMNS, row)), ensure_ascii=False))
+        count += 1
+    out.write('\n]\n' if count else ']\n')
+    return count
+
+def _capped(rows: Iterable[Tuple], text: IO[str], max_bytes: int) -> Iterator[Tuple]:
+    """Pass rows through, raising ExportTooLarge once more than max_bytes have been written.
+    The size is checked every EXPORT_CHUNK_SIZE rows, so at most one chunk goes past it"""
+    for count, row in enumerate(rows):
+        if count and count % config.EXPORT_CHUNK_SIZE == 0 and text.tell() > max_bytes:
+            raise ExportTooLarge(count)
+        yield row
+
+def export_invoices(user_id: int, fmt: str = 'csv', status: str = None,
+                    due_from: date = None, due_to: date = None,
+                    max_bytes: int = None) -> Tuple[IO[bytes], int]:
+    """Stream a user's invoices into a spooled temp file (memory up to EXPORT_SPOOL_SIZE,
+    disk beyond). Returns (binary file positioned at 0, row count); the caller closes it.
+    Raises ExportTooLarge as soon as the file passes max_bytes (EXPORT_MAX_BYTES)"""
+    max_bytes = max_bytes or config.EXPORT_MAX_BYTES
+    writer = write_json if fmt == 'json' else write_csv
+    spool = tempfile.SpooledTemporaryFile(max_size=config.EXPORT_SPOOL_SIZE, mode='w+b')
+    rows = db.iter_invoices(user_id, status, due_from, due_to)
+    try:
+        text = io.TextIOWrapper(spool, encoding='utf-8', newline='')
+        count = writer(_capped(rows, text, max_bytes), text)
+        text.flush()
+        text.detach()  # leave the spool open for the caller
+        if spool.tell() > max_bytes:
+            raise ExportTooLarge(count)
+        spool.seek(0)
+        return spool, count
+    except Exception:
+        spool.close()
+        raise
+    finally:
+        rows.close()  # releases the read cursor if streaming stopped early
+
+def file_size(fileobj: IO[bytes]) -> int:
+    """Size of a seekable file without reading it"""
+    position = fileobj.tell()
+    size = fileobj.seek(0, io.SEEK_END)
+    fileobj.seek(position)
+    return size
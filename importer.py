@@ -0,0 +1,123 @@
+"""Bulk CSV invoice import for PayTrackBot"""
+import csv
+import functools
+import io
+import time
+from datetime import date
+from typing import IO, Dict, Iterator, List, Optional, Tuple
+import config
+import database as db
+from dates import parse_due_date, DueDateTooOld
+
+# Accepted header names (case-insensitive, spaces read as underscores) -> field
+COLUMNS = {
+    'client': 'client_name', 'client_name': 'client_name', 'name': 'client_name',
+    'amount': 'amount',
+    'due': 'due_date', 'due_date': 'due_date',
+    'currency': 'currency',
+    'notes': 'notes', 'note': 'notes',
+}
+REQUIRED = ('client_name', 'amount', 'due_date')
+
+def parse_amount(text: str) -> float:
+    """Same rule as /new: a positive number, thousands separators allowed"""
+    amount = float(text.replace(',', ''))
+    if not amount > 0:
+        raise ValueError("amount must be positive")
+    return amount
+
+def _cell(values: List[str], positions: Dict[str, int], field: str) -> str:
+    index = positions.get(field)
+    return values[index].strip() if index is not None and index < len(values) else ''
+
+def parse_rows(text: IO[str], today: date = None) -> Iterator[Tuple[int, Optional[tuple], Optional[str]]]:
+    """Validate CSV rows one at a time, yielding (line, row, None) or (line, None, error).
+    row is (client_name, amount, currency, due_date, notes)"""
+    reader = csv.reader(text)
+    header = next(reader, None)
+    if header is None:
+        raise ValueError("the file is empty")
+
+    fields = [COLUMNS.get(name.strip().lower().replace(' ', '_')) for name in header]
+    missing = [name for name in REQUIRED if name not in fields]
+    if missing:
+        raise ValueError(f"missing column(s): {', '.join(missing)}")
+    positions = {field: fields.index(field) for field in set(fields) if field}
+
+    for values in reader:
+        line = reader.line_num
+        if not any(value.strip() for value in values):
+            continue  # blank line
+        get = functools.partial(_cell, values, positions)
+
+        client_name = get('client_name')
+        if not client_name:
+            yield line, None, "client name is empty"
+            continue
+        try:
+            amount = parse_amount(get('amount'))
+        except ValueError:
+            yield line, None, f"invalid amount {get('amount')!r}"
+            continue
+        try:
+            due_date = parse_due_date(get('due_date'), today)
+        except DueDateTooOld as e:
+            yield line, None, str(e)
+            continue
+        except ValueError:
+            yield line, None, f"invalid due date {get('due_date')!r}"
+            continue
+
+        currency = get('currency').upper() or 'USD'
+        yield line, (client_name, amount, currency, due_date, get('notes') or None), None
+
+def read_chunks(fileobj: IO[bytes], report: Dict, chunk_size: int = None) -> Iterator[List[tuple]]:
+    """Validate a CSV upload into lists of up to chunk_size rows, tallying bad rows in
+    report (see new_report()). Pure parsing: never touches the database"""
+    chunk_size = chunk_size or config.IMPORT_CHUNK_SIZE
+    chunk = []
+    text = io.TextIOWrapper(fileobj, encoding='utf-8-sig', newline='')
+    try:
+        for line, row, error in parse_rows(text):
+            if error:
+                report['error_count'] += 1
+                if len(report['errors']) < config.IMPORT_MAX_REPORTED_ERRORS:
+                    report['errors'].append((line, error))
+                continue
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+    finally:
+        text.detach()  # the caller owns fileobj
+
+def new_report() -> Dict:
+    return {'imported': 0, 'over_limit': 0, 'error_count': 0, 'errors': [],
+            'started': time.perf_counter()}
+
+def skip_chunk(report: Dict, max_unpaid: Optional[int]) -> bool:
+    """Once the free plan allowance turned rows away, later chunks are not even tried"""
+    return max_unpaid is not None and report['over_limit'] > 0
+
+def record_chunk(report: Dict, rows: int, inserted: int):
+    report['imported'] += inserted
+    report['over_limit'] += rows - inserted
+
+def finish_report(report: Dict) -> Dict:
+    seconds = time.perf_counter() - report.pop('started')
+    report['seconds'] = seconds
+    report['rows_per_sec'] = report['imported'] / seconds if seconds else 0.0
+    return report
+
+def import_invoices(user_id: int, fileobj: IO[bytes], max_unpaid: int = None,
+                    chunk_size: int = None) -> Dict:
+    """Stream a CSV file into invoices, inserting chunk_size rows per transaction, all on
+    the calling thread (the bot uses async_db.import_invoices, which parses off the
+    writer thread). With max_unpaid (free plan), rows beyond the allowance are skipped"""
+    report = new_report()
+    for chunk in read_chunks(fileobj, report, chunk_size):
+        inserted = 0 if skip_chunk(report, max_unpaid) else db.create_invoices(user_id, chunk, max_unpaid)
+        record_chunk(report, len(chunk), inserted)
+    return finish_report(report)
@@ -0,0 +1,120 @@
+"""SQLite-backed conversation persistence for PayTrackBot"""
+import asyncio
+import json
+import logging
+import pickle
+from typing import Dict, Optional
+from telegram.ext import BasePersistence, PersistenceInput
+import config
+import async_db as adb
+
+logger = logging.getLogger(__name__)
+
+class SQLitePersistence(BasePersistence):
+    """Persist ConversationHandler states and user_data in the bot's database.
+
+    PTB hands over changed entries every `update_interval` seconds; they are
+    buffered here and written in a single transaction per interval, so handlers
+    never wait on disk. Ended conversations and empty user_data are deleted, so
+    the tables (and the restore on startup) only cover active conversations."""
+
+    def __init__(self, update_interval: float = None):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False,
+                                        user_data=True, callback_data=False),
+            update_interval=update_interval or config.PERSISTENCE_INTERVAL
+        )
+        self._states: Dict[tuple, object] = {}  # (name, key) -> state, None = ended
+        self._user_data: Dict[int, Optional[bytes]] = {}  # user_id -> pickle, None = drop
+        self._write_task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _encode_key(key: tuple) -> str:
+        return json.dumps(list(key))
+
+    @staticmethod
+    def _decode_key(key: str) -> tuple:
+        return tuple(json.loads(key))
+
+    # --- Restore (once, on Application.initialize) ---
+
+    async def get_user_data(self) -> Dict[int, dict]:
+        rows = await adb.get_conversation_user_data()
+        return {user_id: pickle.loads(data) for user_id, data in rows}
+
+    async def get_conversations(self, name: str) -> Dict[tuple, object]:
+        rows = await adb.get_conversation_states(name)
+        return {self._decode_key(key): state for key, state in rows}
+
+    async def get_chat_data(self) -> Dict[int, dict]:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    # --- Updates (buffered, written once per interval) ---
+
+    async def update_conversation(self, name: str, key: tuple, new_state: Optional[object]) -> None:
+        self._states[(name, self._encode_key(key))] = new_state
+        self._schedule_write()
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._user_data[user_id] = pickle.dumps(data, pickle.HIGHEST_PROTOCOL) if data else None
+        self._schedule_write()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._user_data[user_id] = None
+        self._schedule_write()
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass  # this process is the only writer, so memory is always current
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    def _schedule_write(self):
+        # PTB gathers all update_* calls of one interval together; the write task
+        # starts after they have run, so the whole interval lands in one transaction
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.create_task(self._write_pending())
+
+    async def _write_pending(self):
+        await asyncio.sleep(0)
+        while self._states or self._user_data:
+            states, self._states = self._states, {}
+            user_data, self._user_data = self._user_data, {}
+            try:
+                await adb.save_conversation_state(
+                    [(name, key, state) for (name, key), state in states.items()],
+                    user_data.items()
+                )
+            except Exception as e:
+                logger.error(f"[ERROR] Failed to persist conversation state: {e}")
+                # Keep newer values buffered since the failed write, retry on the next write
+                self._states = {**states, **self._states}
+                self._user_data = {**user_data, **self._user_data}
+                return
+
+    async def flush(self) -> None:
+        """Write anything still buffered (called by PTB on shutdown)"""
+        if self._write_task is not None:
+            await self._write_task
+        await self._write_pending()
@@ -1,10 +1,12 @@
 """Automated reminder system for PayTrackBot"""
 import asyncio
-from datetime import date, timedelta
-from telegram import Bot
-from telegram.error import TelegramError
+from datetime import date, datetime, timedelta, timezone
+from telegram import Bot, InlineKeyboardMarkup
 import config
-import database as db
+import async_db as adb
+import dates
+import render
+from dispatch import Dispatcher
 import logging
 
 logging.basicConfig(
@@ -13,116 +15,133 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-async def send_daily_reminders():
-    """Send daily reminder notifications to users with due/overdue invoices"""
-    bot = Bot(token=config.TELEGRAM_BOT_TOKEN)
-    today = date.today()
-    tomorrow = today + timedelta(days=1)
+async def send_daily_reminders(bot: Bot = None, today: date = None, tz_offset: int = 0):
+    """Send daily reminder notifications to one timezone cohort's users with due/overdue
+    invoices; `today` is the cohort's local date"""
+    if bot is None:
+        bot = Bot(token=config.TELEGRAM_BOT_TOKEN)
+    today = today or date.today()
+    cohort = dates.format_tz_offset(tz_offset)
     
-    user_ids = db.get_all_users_for_reminders()
-    logger.info(f"Checking reminders for {len(user_ids)} users...")
+    # The run ledger makes reruns idempotent: a finished run is a no-op and a
+    # crashed one resumes with the users it hadn't finished yet
+    run = await adb.start_reminder_run(today, tz_offset)
+    if run['finished_at']:
+        logger.info(f"Reminders for {today} {cohort} already sent (run {run['id']}), skipping")
+        return 0
     
+    # One joined query returns only the cohort's Pro users' reminder-worthy invoices, pre-bucketed
+    reminder_groups = await adb.get_reminder_invoices(today, run_id=run['id'], tz_offset=tz_offset)
+    logger.info(f"Checking reminders for {len(reminder_groups)} users in {cohort} (run {run['id']})...")
+    
+    # Render each user's reminder (split into several messages if it is very long)
+    outgoing = []
+    for user_id, invoices in reminder_groups:
+        parts, log_entries = render.daily_reminder(dates.group_by_bucket(invoices))
+        # Only send if there's something to report
+        if parts:
+            # Mark-paid buttons for what needs action (not the heads-up section) go under the last part
+            buttons = render.paid_buttons('remind', [invoice_id for invoice_id, _ in log_entries])
+            kwargs = [{'parse_mode': 'Markdown'} for _ in parts]
+            if buttons:
+                kwargs[-1]['reply_markup'] = InlineKeyboardMarkup(buttons)
+            outgoing.append((user_id, list(zip(parts, kwargs)), log_entries))
+    
+    # Send concurrently within Telegram's rate limits, one chunk of users at a time,
+    # and log each chunk's delivered reminders and ledger state in a single transaction
+    dispatcher = Dispatcher(bot)
     reminders_sent = 0
+    chunk_size = config.REMINDER_BATCH_SIZE
     
-    for user_id in user_ids:
-        user = db.get_user(user_id)
-        
-        # Only send auto-reminders to Pro users
-        if user['subscription_tier'] != config.TIER_PRO:
-            continue
-        
-        invoices = db.get_unpaid_invoices(user_id)
-        
-        # Group invoices by urgency
-        overdue = []
-        due_today = []
-        due_tomorrow = []
-        due_soon = []  # 3-7 days
-        
-        for inv in invoices:
-            due_date = date.fromisoformat(inv['due_date'])
-            days_until = (due_date - today).days
-            
-            if days_until < 0:
-                overdue.append((inv, abs(days_until)))
-            elif days_until == 0:
-                due_today.append(inv)
-            elif days_until == 1:
-                due_tomorrow.append(inv)
-            elif 3 <= days_until <= 7:
-                due_soon.append(inv)
-        
-        # Build reminder message
-        msg_parts = []
-        
-        if overdue:
-            msg_parts.append("⚠️ **OVERDUE INVOICES:**")
-            for inv, days in overdue:
-                msg_parts.append(
-                    f"• #{inv['id']} {inv['client_name']} - "
-                    f"${inv['amount']:.2f} ({days} days overdue)"
-                )
-            db.log_reminder(inv['id'], 'overdue')
-        
-        if due_today:
-            msg_parts.append("\n🔴 **DUE TODAY:**")
-            for inv in due_today:
-                msg_parts.append(
-                    f"• #{inv['id']} {inv['client_name']} - ${inv['amount']:.2f}"
-                )
-            db.log_reminder(inv['id'], 'due_today')
+    for start in range(0, len(outgoing), chunk_size):
+        chunk = outgoing[start:start + chunk_size]
+        delivered = iter(await dispatcher.send_many(
+            (user_id, text, kwargs) for user_id, parts, _ in chunk for text, kwargs in parts
+        ))
         
-        if due_tomorrow:
-            msg_parts.append("\n🟡 **DUE TOMORROW:**")
-            for inv in due_tomorrow:
-                msg_parts.append(
-                    f"• #{inv['id']} {inv['client_name']} - ${inv['amount']:.2f}"
-                )
-            db.log_reminder(inv['id'], 'due_tomorrow')
-        
-        if due_soon:
-            msg_parts.append("\n📅 **Coming up soon:**")
-            for inv in due_soon:
-                due_date = date.fromisoformat(inv['due_date'])
-                days = (due_date - today).days
-                msg_parts.append(
-                    f"• #{inv['id']} {inv['client_name']} - "
-                    f"${inv['amount']:.2f} (in {days} days)"
-                )
-        
-        # Only send if there's something to report
-        if msg_parts:
-            msg_parts.insert(0, "📊 **Daily Invoice Reminder**\n")
-            msg_parts.append("\nUse /paid <id> to mark as paid!")
-            
-            try:
-                await bot.send_message(
-                    chat_id=user_id,
-                    text='\n'.join(msg_parts),
-                    parse_mode='Markdown'
-                )
+        done = []
+        failed = []
+        for user_id, parts, entries in chunk:
+            # A reminder counts as delivered only if all of its parts were
+            if all([next(delivered) for _ in parts]):
                 reminders_sent += 1
+                done.append((user_id, entries))
                 logger.info(f"Sent reminder to user {user_id}")
-            except TelegramError as e:
-                logger.error(f"Failed to send reminder to {user_id}: {e}")
+            else:
+                failed.append(user_id)
+                logger.error(f"Failed to send reminder to {user_id}")
+        
+        await adb.record_reminder_run_users(run['id'], today, done, failed)
     
+    # Move everything this run handled on to its next reminder date
+    await adb.advance_reminders(run['id'], today, tz_offset)
+    await adb.finish_reminder_run(run['id'])
     logger.info(f"✅ Sent {reminders_sent} reminders")
     return reminders_sent
 
-async def send_weekly_summary():
-    """Send weekly revenue summary (optional feature)"""
-    bot = Bot(token=config.TELEGRAM_BOT_TOKEN)
+async def send_due_reminders(bot: Bot = None, utc_now: datetime = None) -> int:
+    """Run every timezone cohort whose local reminder time has come today and whose run
+    isn't finished yet. Called each REMINDER_TICK_MINUTES, so delivery is spread across
+    the day one cohort at a time; a cohort missed while the bot was down runs on the next tick"""
+    if bot is None:
+        bot = Bot(token=config.TELEGRAM_BOT_TOKEN)
+    utc_now = utc_now or datetime.now(timezone.utc).replace(tzinfo=None)
+    reminder_time = (config.REMINDER_TIME_HOUR, config.REMINDER_TIME_MINUTE)
     
-    # Get all Pro users
-    # This would need a query to get all users with subscription_tier = 'pro'
-    # For now, simplified version
+    sent = 0
+    for tz_offset in await adb.get_pending_reminder_cohorts(utc_now):
+        local_now = utc_now + timedelta(minutes=tz_offset)
+        if (local_now.hour, local_now.minute) >= reminder_time:
+            sent += await send_daily_reminders(bot, local_now.date(), tz_offset)
+    return sent
+
+def _weekly_summary_text(summary: dict, week_start: date, week_end: date) -> str:
+    lines = [
+        f"📊 **Weekly Summary** ({week_start:%b %d} - {week_end:%b %d})\n",
+        f"✅ Paid this week: ${summary['paid_total']:.2f} ({summary['paid_count']} invoices)",
+        f"⏳ Outstanding: ${summary['outstanding_total']:.2f} ({summary['outstanding_count']} invoices)",
+    ]
+    if summary['overdue_count']:
+        lines.append(f"⚠️ Overdue: ${summary['overdue_total']:.2f} ({summary['overdue_count']} invoices)")
+        lines.append("\nUse /list to follow up on overdue invoices.")
+    return '\n'.join(lines)
+
+async def send_weekly_summary(bot: Bot = None, today: date = None):
+    """Send every Pro user with activity their paid / outstanding / overdue totals for the
+    past 7 days. Each batch of users is one grouped query, sent before the next is read"""
+    if bot is None:
+        bot = Bot(token=config.TELEGRAM_BOT_TOKEN)
+    today = today or date.today()
+    week_start, week_end = today - timedelta(days=7), today - timedelta(days=1)
+    
+    dispatcher = Dispatcher(bot)
+    sent = failed = 0
+    
+    summaries = await adb.get_weekly_summaries(week_start, today)
+    while summaries:
+        # Read the next batch while this one is being sent
+        next_batch = asyncio.ensure_future(
+            adb.get_weekly_summaries(week_start, today, summaries[-1]['user_id']))
+        
+        delivered = await dispatcher.send_many(
+            (summary['user_id'], _weekly_summary_text(summary, week_start, week_end),
+             {'parse_mode': 'Markdown'})
+            for summary in summaries
+        )
+        sent += sum(delivered)
+        failed += len(delivered) - sum(delivered)
+        summaries = await next_batch
     
-    logger.info("Weekly summary feature - coming soon")
-    return 0
+    logger.info(f"✅ Sent {sent} weekly summaries ({failed} failed)")
+    return sent
 
 def run_daily_reminders():
-    """Run the daily reminder check (called by cron)"""
-    asyncio.run(send_daily_reminders())
+    """Send any due cohorts once, outside the bot (manual runs / cron every 15 minutes).
+    The bot schedules this itself; see scheduler.py"""
+    try:
+        asyncio.run(send_due_reminders())
+    finally:
+        adb.close_db()
 
 if __name__ == '__main__':
     # For testing
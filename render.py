@@ -0,0 +1,155 @@
+"""Message rendering for PayTrackBot: precompiled line templates, Markdown escaping
+and packing lines into messages that fit Telegram's size limit"""
+from typing import Dict, List
+from telegram import InlineKeyboardButton
+import config
+import dates
+
+MAX_MESSAGE_LENGTH = 4096  # Telegram's limit, counted in UTF-16 code units
+
+def escape(text: str) -> str:
+    """Escape user-provided text (client names, notes) for parse_mode='Markdown'"""
+    # Chained replace is several times faster than str.translate or re.sub here
+    return text.replace('_', '\\_').replace('*', '\\*').replace('`', '\\`').replace('[', '\\[')
+
+def escape_many(texts: List[str]) -> List[str]:
+    """escape() for a batch: one pass over the joined texts instead of four per text"""
+    escaped = escape('\0'.join(texts)).split('\0')
+    if len(escaped) != len(texts):  # some text contained the separator itself
+        return [escape(text) for text in texts]
+    return escaped
+
+def length(text: str) -> int:
+    """Message length as Telegram counts it (emoji outside the BMP count twice)"""
+    return len(text.encode('utf-16-le')) // 2
+
+# Line templates, %-formatted with a tuple (cheaper than f-strings or str.format per line)
+REMINDER_LINE = "• #%d %s - $%.2f"
+REMINDER_OVERDUE_LINE = "• #%d %s - $%.2f (%d days overdue)"
+REMINDER_SOON_LINE = "• #%d %s - $%.2f (in %d days)"
+UNPAID_LINE = "**#%d** %s\n  💵 %s %.2f | %s\n"
+INVOICE_LINE = "%s **#%d** %s - %s %.2f"
+PAID_LINE = "✅ #%d %s - %s %.2f"
+
+# Reminder sections in message order: (bucket, heading, line template, whether the
+# template takes days, reminder type logged in the ledger or None for heads-up only)
+REMINDER_SECTIONS = (
+    (dates.OVERDUE, "⚠️ **OVERDUE INVOICES:**", REMINDER_OVERDUE_LINE, True, 'overdue'),
+    (dates.DUE_TODAY, "\n🔴 **DUE TODAY:**", REMINDER_LINE, False, 'due_today'),
+    (dates.DUE_TOMORROW, "\n🟡 **DUE TOMORROW:**", REMINDER_LINE, False, 'due_tomorrow'),
+    (dates.DUE_SOON, "\n📅 **Coming up soon:**", REMINDER_SOON_LINE, True, None),
+)
+REMINDER_HEADER = "📊 **Daily Invoice Reminder**\n"
+REMINDER_FOOTER = "\nUse /paid <id> to mark as paid!"
+
+def pack(lines: List[str], limit: int = MAX_MESSAGE_LENGTH) -> List[str]:
+    """Join lines with newlines into as few messages as possible, none longer than
+    limit. Messages break between lines; only a line longer than limit is cut up"""
+    if not lines:
+        return []
+    text = '\n'.join(lines)
+    extra = length(text) - len(text)  # characters that count twice, in the whole text
+    if len(text) + extra <= limit:
+        return [text]  # the usual case: one message, measured once
+
+    # Charge every double-width character to each part up front so lines can be sized
+    # with plain len(); only text full of emoji pays for measuring line by line
+    if extra <= limit // 8:
+        measure, limit = len, limit - extra
+    else:
+        measure = length
+
+    parts = []
+    current: List[str] = []
+    size = 0
+
+    for line in lines:
+        line_size = measure(line)
+        if line_size > limit:
+            if current:
+                parts.append('\n'.join(current))
+                current, size = [], 0
+            # limit // 2 code points never exceed limit UTF-16 units
+            step = max(limit // 2, 2)
+            while measure(line) > limit:
+                cut = step - 1 if line[step - 1] == '\\' else step  # keep escapes whole
+                parts.append(line[:cut])
+                line = line[cut:]
+            line_size = measure(line)
+
+        if current and size + 1 + line_size > limit:
+            parts.append('\n'.join(current))
+            current, size = [], 0
+        size += line_size + 1 if current else line_size
+        current.append(line)
+
+    if current:
+        parts.append('\n'.join(current))
+    return parts
+
+def daily_reminder(buckets: Dict[str, List[Dict]], limit: int = MAX_MESSAGE_LENGTH):
+    """Render one user's reminder from dates.group_by_bucket() output.
+    Returns (message parts, [(invoice_id, reminder_type), ...]); no parts if nothing is due"""
+    lines = []
+    log_entries = []
+
+    for bucket, heading, template, with_days, reminder_type in REMINDER_SECTIONS:
+        invoices = buckets[bucket]
+        if not invoices:
+            continue
+        lines.append(heading)
+        names = escape_many([inv['client_name'] for inv in invoices])
+        if with_days:
+            lines.extend(template % (inv['id'], name, inv['amount'], abs(inv['days_until']))
+                         for inv, name in zip(invoices, names))
+        else:
+            lines.extend(template % (inv['id'], name, inv['amount'])
+                         for inv, name in zip(invoices, names))
+        if reminder_type:
+            log_entries.extend((inv['id'], reminder_type) for inv in invoices)
+
+    if not lines:
+        return [], []
+    lines.insert(0, REMINDER_HEADER)
+    lines.append(REMINDER_FOOTER)
+    return pack(lines, limit), log_entries
+
+def unpaid_line(inv: Dict) -> str:
+    """/list entry; days_until and bucket are computed by the page query"""
+    days_diff = inv['days_until']
+
+    if inv['bucket'] == dates.OVERDUE:
+        status = f"⚠️ *OVERDUE by {abs(days_diff)} days*"
+    elif inv['bucket'] == dates.DUE_TODAY:
+        status = "🔴 *Due TODAY*"
+    elif days_diff <= 3:
+        status = f"🟡 Due in {days_diff} days"
+    else:
+        status = f"🟢 Due in {days_diff} days"
+
+    return UNPAID_LINE % (inv['id'], escape(inv['client_name']), inv['currency'],
+                          inv['amount'], status)
+
+def invoice_line(inv: Dict) -> str:
+    """/all entry"""
+    return INVOICE_LINE % ("✅" if inv['status'] == 'paid' else "⏳", inv['id'],
+                           escape(inv['client_name']), inv['currency'], inv['amount'])
+
+def paid_line(inv: Dict) -> str:
+    """Confirmation entry for an invoice just marked paid"""
+    return PAID_LINE % (inv['id'], escape(inv['client_name']), inv['currency'], inv['amount'])
+
+PAID_BUTTONS_PER_ROW = 4
+
+def paid_buttons(view: str, invoice_ids: List[int]) -> List[List[InlineKeyboardButton]]:
+    """Keyboard rows of '✅ #id' mark-paid buttons, plus 'Mark all paid' when there are
+    several. Callback data is paid:<view>:<id> or paid:<view>:all (all = every button shown)"""
+    ids = list(invoice_ids)[:config.PAID_BUTTONS_MAX]
+    rows = [
+        [InlineKeyboardButton(f"✅ #{invoice_id}", callback_data=f"paid:{view}:{invoice_id}")
+         for invoice_id in ids[start:start + PAID_BUTTONS_PER_ROW]]
+        for start in range(0, len(ids), PAID_BUTTONS_PER_ROW)
+    ]
+    if len(ids) > 1:
+        rows.append([InlineKeyboardButton("✅ Mark all paid", callback_data=f"paid:{view}:all")])
+    return rows
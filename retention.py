@@ -0,0 +1,56 @@
+"""Reminder log retention and free-space reclamation for PayTrackBot"""
+import asyncio
+import logging
+import time
+from datetime import date
+from typing import Dict
+import config
+import async_db as adb
+
+logger = logging.getLogger(__name__)
+
+async def prune_reminders(bot=None, older_than_days: int = None, batch_size: int = None,
+                          today: date = None) -> Dict:
+    """Scheduler job: roll reminder rows older than REMINDER_RETENTION_DAYS into per-invoice
+    counters, then return the freed pages to the filesystem with incremental_vacuum. Both
+    run in small writer-thread steps with pauses in between, so commands never wait long.
+    Returns rows pruned, bytes reclaimed and how long the write lock was held"""
+    batch_size = batch_size or config.REMINDER_PRUNE_BATCH_SIZE
+    start = time.perf_counter()
+    pruned = reclaimed = 0
+    lock_seconds = longest_lock = 0.0
+
+    while True:
+        batch = await adb.prune_reminders(older_than_days, batch_size, today)
+        pruned += batch['pruned']
+        lock_seconds += batch['seconds']
+        longest_lock = max(longest_lock, batch['seconds'])
+        if batch['pruned'] < batch_size:
+            break
+        await asyncio.sleep(config.REMINDER_PRUNE_PAUSE)
+
+    while True:
+        step = await adb.incremental_vacuum(config.VACUUM_PAGES_PER_STEP)
+        reclaimed += step['bytes']
+        lock_seconds += step['seconds']
+        longest_lock = max(longest_lock, step['seconds'])
+        if step['pages'] < config.VACUUM_PAGES_PER_STEP:
+            break
+        await asyncio.sleep(config.REMINDER_PRUNE_PAUSE)
+
+    seconds = time.perf_counter() - start
+    logger.info(f"✅ Pruned {pruned} reminder rows, reclaimed {reclaimed / (1024 * 1024):.1f} MB "
+                f"in {seconds:.1f}s (write lock held {lock_seconds * 1000:.0f} ms in total, "
+                f"{longest_lock * 1000:.0f} ms at most)")
+    return {'pruned': pruned, 'reclaimed_bytes': reclaimed, 'seconds': seconds,
+            'lock_seconds': lock_seconds, 'longest_lock_seconds': longest_lock}
+
+def run_retention():
+    """Prune once, outside the bot (manual runs / cron). The bot schedules this itself"""
+    try:
+        return asyncio.run(prune_reminders())
+    finally:
+        adb.close_db()
+
+if __name__ == '__main__':
+    run_retention()
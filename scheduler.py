@@ -0,0 +1,158 @@
+"""In-process job scheduler for PayTrackBot (runs on the bot's event loop)"""
+import asyncio
+import logging
+import random
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional
+import config
+import async_db as adb
+
+logger = logging.getLogger(__name__)
+
+class Job:
+    """A coroutine function fired daily (weekday=None) or weekly at a local wall-clock time,
+    or every `every` minutes (aligned to midnight)"""
+
+    def __init__(self, name: str, fn: Callable[..., Awaitable], hour: int = 0, minute: int = 0,
+                 weekday: Optional[int] = None, every: Optional[int] = None):
+        self.name = name
+        self.fn = fn
+        self.hour = hour
+        self.minute = minute
+        self.weekday = weekday  # Monday = 0, as in datetime.weekday()
+        self.every = every
+        self.running = False
+        self.failed_slot: Optional[datetime] = None  # latest slot that failed, until retried
+        self.retry_at: Optional[datetime] = None
+
+    @property
+    def period(self) -> timedelta:
+        if self.every:
+            return timedelta(minutes=self.every)
+        return timedelta(days=1 if self.weekday is None else 7)
+
+    def last_slot(self, now: datetime) -> datetime:
+        """Most recent scheduled time at or before now"""
+        if self.every:
+            midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+            return midnight + (now - midnight) // self.period * self.period
+        slot = now.replace(hour=self.hour, minute=self.minute, second=0, microsecond=0)
+        if slot > now:
+            slot -= timedelta(days=1)
+        if self.weekday is not None:
+            slot -= timedelta(days=(slot.weekday() - self.weekday) % 7)
+        return slot
+
+    def next_slot(self, now: datetime) -> datetime:
+        """First scheduled time after now"""
+        return self.last_slot(now) + self.period
+
+class Scheduler:
+    """Fire jobs at their slots with random jitter, catch up on a slot missed while the
+    bot was down, retry a failed slot after its lease, and never run the same slot twice
+    (job_runs ledger, daily and weekly jobs only) or overlap a run"""
+
+    def __init__(self, bot, jitter: float = None, catchup: timedelta = None,
+                 lease: float = None, clock=datetime.now, rng: random.Random = None):
+        self.bot = bot
+        self.jitter = config.SCHEDULER_JITTER_SECONDS if jitter is None else jitter
+        self.catchup = catchup if catchup is not None else timedelta(hours=config.SCHEDULER_CATCHUP_HOURS)
+        self.lease = config.SCHEDULER_LEASE_SECONDS if lease is None else lease
+        self.jobs: Dict[str, Job] = {}
+        self._clock = clock
+        self._rng = rng or random.Random()
+        self._tasks: List[asyncio.Task] = []
+
+    def add_daily(self, name: str, fn, hour: int, minute: int = 0) -> Job:
+        job = self.jobs[name] = Job(name, fn, hour, minute)
+        return job
+
+    def add_weekly(self, name: str, fn, weekday: int, hour: int, minute: int = 0) -> Job:
+        job = self.jobs[name] = Job(name, fn, hour, minute, weekday)
+        return job
+
+    def add_interval(self, name: str, fn, minutes: int) -> Job:
+        job = self.jobs[name] = Job(name, fn, every=minutes)
+        return job
+
+    async def run_job(self, job: Job, slot: datetime) -> bool:
+        """Run one slot of a job unless it is already running, done, or claimed elsewhere"""
+        if job.running:
+            logger.warning(f"[SCHEDULER] {job.name} is still running, skipping {slot}")
+            return False
+        job.running = True
+        # Interval jobs stay out of job_runs (a row per tick would grow it forever);
+        # they keep their own per-run idempotency, e.g. reminder_runs
+        ledger = not job.every
+        try:
+            if ledger and not await adb.claim_job_run(job.name, slot, self.lease):
+                logger.info(f"[SCHEDULER] {job.name} for {slot} already done or in progress")
+                return False
+
+            logger.info(f"[SCHEDULER] Running {job.name} for {slot}")
+            try:
+                await job.fn(self.bot)
+            except Exception as e:
+                # Left unfinished in job_runs; the job loop retries it once the lease expires
+                logger.error(f"[SCHEDULER] {job.name} for {slot} failed: {e}")
+                self._failed(job, slot)
+                return False
+
+            if ledger:
+                await adb.finish_job_run(job.name, slot)
+            if job.failed_slot is not None and slot >= job.failed_slot:
+                job.failed_slot = None  # retried, or superseded by a later run
+            return True
+        finally:
+            job.running = False
+
+    def _failed(self, job: Job, slot: datetime):
+        if job.failed_slot is None or slot >= job.failed_slot:
+            job.failed_slot = slot
+            job.retry_at = self._clock() + timedelta(seconds=self.lease)
+
+    async def _run_guarded(self, job: Job, slot: datetime):
+        """run_job() for the job loop: an error (e.g. the database is locked while claiming)
+        is logged and retried like a failed run instead of ending the loop"""
+        try:
+            await self.run_job(job, slot)
+        except Exception as e:
+            logger.error(f"[SCHEDULER] Could not run {job.name} for {slot}: {e}")
+            self._failed(job, slot)
+
+    async def _sleep_until(self, when: datetime):
+        delay = (when - self._clock()).total_seconds()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _job_loop(self, job: Job):
+        # Catch up on the latest slot if it was missed recently (e.g. the bot was down at 9:00)
+        now = self._clock()
+        slot = job.last_slot(now)
+        if now - slot <= self.catchup:
+            await self._run_guarded(job, slot)
+
+        while True:
+            slot = job.next_slot(self._clock())
+            # Jitter spreads the load if several instances / jobs share a slot
+            when = slot + timedelta(seconds=self._rng.uniform(0, self.jitter))
+            # A failed slot is retried when its lease expires, unless the next slot comes first
+            if job.failed_slot is not None and job.retry_at < when:
+                await self._sleep_until(job.retry_at)
+                await self._run_guarded(job, job.failed_slot)
+                continue
+            await self._sleep_until(when)
+            await self._run_guarded(job, slot)
+
+    def start(self):
+        """Start one loop per job on the running event loop"""
+        for job in self.jobs.values():
+            self._tasks.append(asyncio.create_task(self._job_loop(job), name=f'job:{job.name}'))
+        logger.info(f"[SCHEDULER] Started {', '.join(self.jobs)}")
+
+    async def stop(self):
+        """Cancel the job loops (an in-flight run is cancelled and retried after its lease)"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
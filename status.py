@@ -2,6 +2,7 @@
 import sqlite3
 from datetime import datetime
 import config
+import database as db
 
 def get_bot_status():
     """Get current bot statistics"""
@@ -11,9 +12,15 @@ def get_bot_status():
         'free_users': 0,
         'total_invoices': 0,
         'unpaid_invoices': 0,
+        'archived_invoices': 0,
         'paid_this_month': 0,
         'revenue_this_month': 0,
-        'db_size_mb': 0
+        'db_size_mb': 0,
+        'free_mb': 0,
+        'incremental_vacuum': False,
+        'reminder_rows': 0,
+        'reminder_counters': 0,
+        'summary_mismatches': 0
     }
     
     try:
@@ -35,6 +42,11 @@ def get_bot_status():
         cursor.execute("SELECT COUNT(*) FROM invoices WHERE status='unpaid'")
         stats['unpaid_invoices'] = cursor.fetchone()[0]
         
+        # Paid invoices moved out by archive.py
+        cursor.execute("SELECT COUNT(*) FROM invoices_archive")
+        stats['archived_invoices'] = cursor.fetchone()[0]
+        stats['total_invoices'] += stats['archived_invoices']
+        
         # This month's paid invoices
         cursor.execute("""
             SELECT COUNT(*), SUM(amount) FROM invoices 
@@ -45,8 +57,23 @@ def get_bot_status():
         stats['paid_this_month'] = month_data[0] or 0
         stats['revenue_this_month'] = month_data[1] or 0
         
+        # Reminder log (rows past REMINDER_RETENTION_DAYS are rolled up by retention.py)
+        cursor.execute("SELECT COUNT(*) FROM reminders")
+        stats['reminder_rows'] = cursor.fetchone()[0]
+        cursor.execute("SELECT COUNT(*) FROM reminder_counts")
+        stats['reminder_counters'] = cursor.fetchone()[0]
+        
+        # Free pages inside the file, which incremental_vacuum can hand back
+        page_size = cursor.execute("PRAGMA page_size").fetchone()[0]
+        stats['free_mb'] = cursor.execute("PRAGMA freelist_count").fetchone()[0] * page_size / (1024 * 1024)
+        stats['incremental_vacuum'] = cursor.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+        
         conn.close()
         
+        # Revenue summary tables vs. a full rebuild
+        stats['summary_mismatches'] = len(db.check_user_stats())
+        db.close_db()
+        
         # Database size
         import os
         if os.path.exists(config.DB_PATH):
@@ -78,13 +105,24 @@ def print_status():
     print("\n📋 Invoices:")
     print(f"  Total created: {stats['total_invoices']}")
     print(f"  Currently unpaid: {stats['unpaid_invoices']}")
+    print(f"  Archived (paid): {stats['archived_invoices']}")
     print(f"  Paid this month: {stats['paid_this_month']}")
     
     print("\n💰 Revenue Tracked:")
     print(f"  This month: ${stats['revenue_this_month']:.2f}")
     
     print("\n💾 Database:")
-    print(f"  Size: {stats['db_size_mb']:.2f} MB")
+    print(f"  Size: {stats['db_size_mb']:.2f} MB ({stats['free_mb']:.2f} MB free)")
+    if not stats['incremental_vacuum']:
+        print("  ⚠️ auto_vacuum is not incremental, free space is never returned "
+              "(run database.enable_incremental_vacuum() once, with the bot stopped)")
+    print(f"  Reminder log: {stats['reminder_rows']} rows, "
+          f"{stats['reminder_counters']} rolled-up counters")
+    if stats['summary_mismatches']:
+        print(f"  ⚠️ Revenue summaries: {stats['summary_mismatches']} mismatches "
+              f"(run database.rebuild_user_stats())")
+    else:
+        print("  Revenue summaries: consistent")
     
     print("\n" + "="*50 + "\n")
 
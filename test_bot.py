@@ -71,13 +71,50 @@ def test_mark_paid():
     
     invoice_id = db.create_invoice(12345, "Test Client", 300, date.today())
     
-    success = db.mark_invoice_paid(invoice_id)
+    success = db.mark_invoice_paid(invoice_id, 12345)
     assert success
     
     invoice = db.get_invoice(invoice_id)
     assert invoice['status'] == 'paid'
     assert invoice['paid_date'] is not None
     print("[OK] Mark as paid works")
+    
+    # One conditional statement: owner-checked, never pays twice, returns the row
+    other = db.create_invoice(12345, "Owned Client", 75, date.today())
+    assert db.mark_invoice_paid(other, 999) is None
+    paid = db.mark_invoice_paid(other, 12345)
+    assert paid['client_name'] == "Owned Client" and paid['status'] == 'paid'
+    assert db.mark_invoice_paid(other, 12345) is None
+    
+    import asyncio
+    import async_db as adb
+    async def race():
+        target = await adb.create_invoice(12345, "Raced Client", 10, date.today())
+        return await asyncio.gather(*[adb.mark_invoice_paid(target, 12345) for _ in range(5)])
+    assert sum(result is not None for result in asyncio.run(race())) == 1
+    adb.close_db()
+    
+    assert db.delete_invoice(other, 999) is None
+    assert db.delete_invoice(other, 12345)['client_name'] == "Owned Client"
+    assert db.get_invoice(other) is None
+    print("[OK] Ownership-checked paid/delete run once and return the invoice")
+    
+    # Batches: one UPDATE ... IN, only the caller's unpaid invoices change
+    import render
+    batch = [db.create_invoice(12345, f"Batch {n}", 20, date.today()) for n in range(4)]
+    db.get_or_create_user(907, "other", "Other")
+    foreign = db.create_invoice(907, "Not yours", 20, date.today())
+    db.mark_invoice_paid(batch[0], 12345)
+    paid = db.mark_invoices_paid(batch + [foreign, 10**9], 12345)
+    assert [inv['id'] for inv in paid] == batch[1:]
+    assert db.get_invoice(foreign)['status'] == 'unpaid'
+    assert db.mark_invoices_paid([], 12345) == []
+    db.delete_invoice(foreign, 907)
+    
+    rows = render.paid_buttons('list', batch)
+    assert [len(row) for row in rows] == [4, 1]
+    assert rows[0][1].callback_data == f"paid:list:{batch[1]}" and rows[-1][0].callback_data == "paid:list:all"
+    print(f"[OK] Batch of {len(paid)} marked paid in one statement")
 
 def test_revenue_stats():
     """Test revenue statistics"""
@@ -85,7 +122,7 @@ def test_revenue_stats():
     
     # Create and mark some as paid
     inv1 = db.create_invoice(12345, "Paid Client", 1000, date.today())
-    db.mark_invoice_paid(inv1)
+    db.mark_invoice_paid(inv1, 12345)
     
     stats = db.get_revenue_stats(12345)
     assert stats['month_total'] > 0
@@ -108,12 +145,1128 @@ def test_subscription_limits():
     else:
         print("[OK] Within free tier limits")
 
+def test_pagination():
+    """Test keyset pages cover every invoice once, in order, both directions"""
+    print("\nTesting invoice pagination...")
+    
+    db.get_or_create_user(901, "pager", "Pager")
+    # Repeated due dates so pages have to break ties on id
+    ids = [db.create_invoice(901, f"Client {i}", 10 + i, date.today() + timedelta(days=i // 3))
+           for i in range(25)]
+    db.mark_invoice_paid(ids[4], 901)
+    unpaid = [i for i in ids if i != ids[4]]
+    
+    pages, page = [], db.get_unpaid_invoices_page(901, limit=10)
+    assert not page['has_prev']
+    while True:
+        pages.append(page)
+        if not page['has_next']:
+            break
+        last = page['invoices'][-1]
+        page = db.get_unpaid_invoices_page(901, after=(last['due_date'], last['id']), limit=10)
+    
+    assert [len(p['invoices']) for p in pages] == [10, 10, 4]
+    assert [inv['id'] for p in pages for inv in p['invoices']] == unpaid
+    
+    # Prev from the last page returns the middle page again
+    first = pages[2]['invoices'][0]
+    back = db.get_unpaid_invoices_page(901, before=(first['due_date'], first['id']), limit=10)
+    assert back['invoices'] == pages[1]['invoices']
+    assert back['has_prev'] and back['has_next']
+    
+    # /all walks newest first and includes paid invoices
+    seen, page = [], db.get_invoices_page(901, limit=10)
+    while True:
+        seen.extend(inv['id'] for inv in page['invoices'])
+        if not page['has_next']:
+            break
+        last = page['invoices'][-1]
+        page = db.get_invoices_page(901, after=(last['created_at'], last['id']), limit=10)
+    assert seen == sorted(ids, reverse=True)
+    
+    with db.transaction() as cursor:
+        cursor.execute('DELETE FROM invoices WHERE user_id = 901')
+    print(f"[OK] {len(unpaid)} unpaid invoices paged 10 at a time, forwards and back")
+
+def test_export():
+    """Test CSV/JSON exports stream every matching invoice through the filters"""
+    print("\nTesting invoice export...")
+    import csv
+    import io
+    import json
+    import export
+    
+    today = date.today()
+    db.get_or_create_user(902, "exporter", "Export")
+    ids = [db.create_invoice(902, f'Client "{i}", Ltd ✓', 100 + i, today + timedelta(days=i))
+           for i in range(7)]
+    db.mark_invoice_paid(ids[0], 902)
+    
+    document, count = export.export_invoices(902, 'csv')
+    rows = list(csv.DictReader(io.TextIOWrapper(document, encoding='utf-8', newline='')))
+    assert count == len(rows) == 7
+    assert [int(row['id']) for row in rows] == ids
+    assert rows[1]['client_name'] == 'Client "1", Ltd ✓'
+    
+    document, count = export.export_invoices(
+        902, 'json', status='unpaid', due_from=today + timedelta(days=2), due_to=today + timedelta(days=4))
+    data = json.loads(document.read().decode('utf-8'))
+    document.close()
+    assert count == 3
+    assert [row['id'] for row in data] == ids[2:5]
+    assert all(row['status'] == 'unpaid' for row in data)
+    
+    document, count = export.export_invoices(902, 'json', status='paid', due_from=today + timedelta(days=1))
+    assert count == 0 and json.loads(document.read()) == []
+    document.close()
+    
+    # Streaming stops at the first size check past the cap instead of writing everything
+    chunk_size = config.EXPORT_CHUNK_SIZE
+    config.EXPORT_CHUNK_SIZE = 2
+    try:
+        export.export_invoices(902, 'csv', max_bytes=150)
+        assert False, "oversized export should be rejected"
+    except export.ExportTooLarge as e:
+        assert 0 < e.count < 7
+    finally:
+        config.EXPORT_CHUNK_SIZE = chunk_size
+    
+    with db.transaction() as cursor:
+        cursor.execute('DELETE FROM invoices WHERE user_id = 902')
+    print("[OK] CSV and JSON exports match the filters")
+
+def test_import():
+    """Test CSV import: valid rows inserted in chunks, bad rows reported, free limit enforced"""
+    print("\nTesting invoice import...")
+    import io
+    import importer
+    from dates import parse_due_date, DueDateTooOld
+    
+    today = date.today()
+    assert parse_due_date('today', today) == today
+    assert parse_due_date(' 30D ', today) == today + timedelta(days=30)
+    assert parse_due_date('2030-01-31', today) == date(2030, 1, 31)
+    for text, error in (('soon', ValueError), ('2020-13-01', ValueError),
+                        (str(today - timedelta(days=400)), DueDateTooOld)):
+        try:
+            parse_due_date(text, today)
+            assert False, f"{text!r} should not parse"
+        except error:
+            pass
+    
+    db.create_user(903, "importer", "Import")
+    db.update_user_subscription(903, config.TIER_PRO)
+    csv_text = (
+        "Client Name,Amount,Due Date,Currency,Notes\n"
+        "Acme,\"1,250.50\",2030-01-01,eur,Retainer\n"
+        "Beta,300,30d,,\n"
+        ",100,today,,\n"
+        "Gamma,-5,today,,\n"
+        "\n"
+        "Delta,10,someday,,\n"
+        "Epsilon,20,7d\n"
+    )
+    result = importer.import_invoices(903, io.BytesIO(csv_text.encode()), chunk_size=2)
+    assert result['imported'] == 3 and result['over_limit'] == 0
+    assert [line for line, _ in result['errors']] == [4, 5, 7]
+    acme = db.get_unpaid_invoices(903)[-1]
+    assert (acme['client_name'], acme['amount'], acme['currency'], acme['notes']) == \
+        ('Acme', 1250.50, 'EUR', 'Retainer')
+    
+    # Free plan: the insert itself checks the unpaid count, chunk by chunk
+    free_before = db.count_unpaid_invoices(12345)
+    rows = "client,amount,due\n" + "".join(f"Free {i},10,7d\n" for i in range(5))
+    result = importer.import_invoices(12345, io.BytesIO(rows.encode()),
+                                      max_unpaid=free_before + 2)
+    assert result['imported'] == 2 and result['over_limit'] == 3
+    assert db.count_unpaid_invoices(12345) == free_before + 2
+    
+    try:
+        importer.import_invoices(903, io.BytesIO(b"client,amount\nX,1\n"))
+        assert False, "missing due_date column should be rejected"
+    except ValueError as e:
+        assert 'due_date' in str(e)
+    
+    result = importer.import_invoices(12345, io.BytesIO(rows.encode()), max_unpaid=free_before + 3,
+                                      chunk_size=2)
+    assert result['imported'] == 1 and result['over_limit'] == 4
+    
+    # In the bot, other writes run between an import's chunks
+    import asyncio
+    import async_db as adb
+    big = "client,amount,due\n" + "".join(f"Bulk {i},10,7d\n" for i in range(20000))
+    
+    async def concurrent_writes():
+        try:
+            task = asyncio.ensure_future(adb.import_invoices(903, io.BytesIO(big.encode()), chunk_size=200))
+            await asyncio.sleep(0.05)
+            await adb.get_or_create_user(903, "importer", "Import")
+            interleaved = not task.done()
+            result = await task
+            free = await adb.import_invoices(12345, io.BytesIO(rows.encode()), max_unpaid=free_before + 4)
+            return interleaved, result, free
+        finally:
+            adb.close_db()
+    
+    interleaved, result, free = asyncio.run(concurrent_writes())
+    assert interleaved, "a write waited for the whole import"
+    assert result['imported'] == 20000 and not result['error_count']
+    assert free['imported'] == 1 and free['over_limit'] == 4
+    
+    with db.transaction() as cursor:
+        cursor.execute("DELETE FROM invoices WHERE user_id = 903 OR client_name LIKE 'Free %'")
+    print("[OK] Import validates rows, batches inserts and enforces the free limit")
+
+def test_due_buckets():
+    """Test SQL-computed days_until/bucket agree with dates.classify and drive /list pages"""
+    print("\nTesting due-date buckets...")
+    import dates
+    
+    today = date.today()
+    db.get_or_create_user(904, "buckets", "Buckets")
+    offsets = [-30, -1, 0, 1, 2, 3, 7, 8, 90]
+    for days in offsets:
+        db.create_invoice(904, f"In {days}", 10, today + timedelta(days=days))
+    
+    page = db.get_unpaid_invoices_page(904, limit=len(offsets), today=today)
+    assert [inv['days_until'] for inv in page['invoices']] == offsets
+    for inv in page['invoices']:
+        assert inv['bucket'] == dates.classify(inv['days_until'])
+    
+    groups = dates.group_by_bucket(page['invoices'])
+    assert [len(groups[bucket]) for bucket in dates.BUCKETS] == [2, 1, 1, 3, 2]
+    
+    # Same rows seen from a different "today" shift buckets without touching the data
+    page = db.get_unpaid_invoices_page(904, limit=len(offsets), today=today + timedelta(days=1))
+    assert page['invoices'][2]['bucket'] == dates.OVERDUE
+    
+    with db.transaction() as cursor:
+        cursor.execute('DELETE FROM invoices WHERE user_id = 904')
+    print("[OK] Buckets computed in SQL match dates.classify")
+
+def test_render():
+    """Test Markdown escaping and packing reminders into Telegram-sized messages"""
+    print("\nTesting message rendering...")
+    import dates
+    import render
+    
+    assert render.escape("ACME_co *[beta]* `x`") == "ACME\\_co \\*\\[beta]\\* \\`x\\`"
+    assert render.escape_many(["a_b", "c\0d", "e*"]) == ["a\\_b", "c\0d", "e\\*"]
+    assert render.length("📊 a") == 4  # astral emoji count as two UTF-16 units
+    
+    assert render.pack(["a", "b", "c"], limit=3) == ["a\nb", "c"]
+    assert render.pack([]) == []
+    parts = render.pack(["x" * 7 + "\\_y"], limit=8)
+    assert all(render.length(part) <= 8 for part in parts)
+    assert "".join(parts) == "x" * 7 + "\\_y" and not parts[0].endswith("\\")
+    
+    # 500 overdue invoices with long client names don't fit one message
+    invoices = [{'id': i, 'client_name': f"Client_{i} " + "n" * 40, 'amount': 10.0,
+                 'days_until': -3, 'bucket': dates.OVERDUE} for i in range(500)]
+    parts, log_entries = render.daily_reminder(dates.group_by_bucket(invoices))
+    assert len(parts) > 1
+    assert all(render.length(part) <= render.MAX_MESSAGE_LENGTH for part in parts)
+    assert parts[0].startswith(render.REMINDER_HEADER) and parts[-1].endswith(render.REMINDER_FOOTER)
+    lines = "\n".join(parts).split("\n")
+    assert sum(line.startswith("• #") for line in lines) == 500
+    assert "Client\\_0 " in parts[0] and "(3 days overdue)" in parts[0]
+    assert log_entries == [(i, 'overdue') for i in range(500)]
+    
+    assert render.daily_reminder(dates.group_by_bucket([])) == ([], [])
+    print(f"[OK] 500-invoice reminder packed into {len(parts)} messages")
+
+def test_user_stats():
+    """Test the trigger-maintained revenue summaries stay consistent"""
+    print("\nTesting revenue summaries...")
+    from connection import get_connection
+    
+    db.create_user(555, "statsuser", "Stats")
+    a = db.create_invoice(555, "Stats A", 100, date.today())
+    b = db.create_invoice(555, "Stats B", 250.5, date.today())
+    c = db.create_invoice(555, "Stats C", 40, date.today())
+    db.mark_invoice_paid(a, 555)
+    db.mark_invoice_paid(b, 555, date(2020, 1, 15))
+    db.delete_invoice(c, 555)
+    
+    stats = db.get_revenue_stats(555)
+    assert stats == {
+        'month_total': 100, 'month_count': 1,
+        'all_time_total': 350.5, 'all_time_count': 2,
+        'outstanding': 0
+    }, stats
+    assert db.check_user_stats() == []
+    
+    # The checker catches drift and a rebuild repairs it
+    with get_connection() as conn:
+        conn.execute("UPDATE user_stats SET paid_total = 1 WHERE user_id = 555")
+    mismatches = db.check_user_stats()
+    assert len(mismatches) == 1 and mismatches[0]['key'] == (555,)
+    db.rebuild_user_stats()
+    assert db.check_user_stats() == []
+    print("[OK] Revenue summaries match a full rebuild")
+
+def test_archive():
+    """Test archival moves old paid invoices out of invoices without changing what reads return"""
+    print("\nTesting invoice archival...")
+    import asyncio
+    import archive
+    import async_db as adb
+    
+    today = date.today()
+    db.get_or_create_user(908, "archiver", "Archive")
+    ids = [db.create_invoice(908, f"Archive Client {i}", 100 + i, today) for i in range(6)]
+    with db.transaction() as cursor:
+        for i, invoice_id in enumerate(ids):
+            cursor.execute("UPDATE invoices SET created_at = datetime('now', ?) WHERE id = ?",
+                           (f'-{400 - i} days', invoice_id))
+    for days_ago, invoice_id in zip((300, 250, 200, 10), ids[:4]):
+        db.mark_invoice_paid(invoice_id, 908, today - timedelta(days=days_ago))
+    
+    stats = db.get_revenue_stats(908)
+    newest_first = [inv['id'] for inv in db.get_all_invoices(908)]
+    assert newest_first == ids[::-1]
+    
+    # Batches of 2 until a short one (other tests' old paid invoices may go too)
+    while db.archive_paid_invoices(180, 2) == 2:
+        pass
+    assert db.archive_paid_invoices(180, 2) == 0
+    with db.transaction() as cursor:
+        cursor.execute('SELECT id FROM invoices WHERE user_id = 908 ORDER BY id')
+        assert [row[0] for row in cursor.fetchall()] == ids[3:]
+    
+    # Reads and the summaries see the same history as before
+    assert db.get_revenue_stats(908) == stats
+    assert db.check_user_stats() == []
+    assert [inv['id'] for inv in db.get_all_invoices(908)] == newest_first
+    assert [inv['id'] for inv in db.get_all_invoices(908, limit=4)] == newest_first[:4]
+    seen, page = [], db.get_invoices_page(908, limit=4)
+    while True:
+        seen.extend(inv['id'] for inv in page['invoices'])
+        if not page['has_next']:
+            break
+        last = page['invoices'][-1]
+        page = db.get_invoices_page(908, after=(last['created_at'], last['id']), limit=4)
+    assert seen == newest_first
+    assert [row[0] for row in db.iter_invoices(908)] == ids
+    assert [row[0] for row in db.iter_invoices(908, 'paid')] == ids[:4]
+    assert [row[0] for row in db.iter_invoices(908, 'unpaid')] == ids[4:]
+    
+    # Archived invoices keep their IDs and stay paid
+    assert db.get_invoice(ids[0])['status'] == 'paid'
+    assert db.mark_invoice_paid(ids[0], 908) is None
+    assert db.delete_invoice(ids[0], 908) is None
+    
+    db.rebuild_user_stats()
+    assert db.get_revenue_stats(908) == stats
+    
+    async def run():
+        try:
+            return await archive.archive_paid_invoices(older_than_days=5, batch_size=1)
+        finally:
+            adb.close_db()
+    
+    assert asyncio.run(run())['archived'] == 1
+    assert db.get_revenue_stats(908) == stats and db.check_user_stats() == []
+    print("[OK] Old paid invoices archived in batches; listings, export and stats unchanged")
+
+def test_retention():
+    """Test old reminder rows roll up into counters and their pages are handed back"""
+    print("\nTesting reminder log retention...")
+    import asyncio
+    import retention
+    import async_db as adb
+    
+    today = date.today()
+    invoice_id = db.create_invoice(908, "Retention Client", 10, today - timedelta(days=200))
+    for days_ago in range(200):
+        db.log_reminder(invoice_id, 'overdue', today - timedelta(days=days_ago))
+    db.log_reminder(invoice_id, 'due_today', today - timedelta(days=200))
+    counts = db.get_reminder_counts(invoice_id)
+    assert counts == {'overdue': 200, 'due_today': 1}
+    assert db.database_space()['auto_vacuum'] == 2  # new databases vacuum incrementally
+    
+    async def run():
+        try:
+            return await retention.prune_reminders(older_than_days=90, batch_size=25)
+        finally:
+            adb.close_db()
+    
+    result = asyncio.run(run())
+    assert result['pruned'] == 110 and result['longest_lock_seconds'] <= result['lock_seconds']
+    assert db.get_reminder_counts(invoice_id) == counts
+    with db.transaction() as cursor:
+        cursor.execute('SELECT MIN(reminder_date) FROM reminders WHERE invoice_id = ?', (invoice_id,))
+        assert cursor.fetchone()[0] == str(today - timedelta(days=90))
+        cursor.execute('''
+            SELECT reminder_type, sent_count, first_date, last_date FROM reminder_counts
+            WHERE invoice_id = ? ORDER BY reminder_type
+        ''', (invoice_id,))
+        assert [tuple(row) for row in cursor.fetchall()] == [
+            ('due_today', 1, str(today - timedelta(days=200)), str(today - timedelta(days=200))),
+            ('overdue', 109, str(today - timedelta(days=199)), str(today - timedelta(days=91))),
+        ]
+    assert db.database_space()['freelist_count'] == 0
+    
+    # Nothing left to prune; counters are not double counted
+    assert asyncio.run(run())['pruned'] == 0
+    assert db.get_reminder_counts(invoice_id) == counts
+    print("[OK] Old reminder rows rolled up in batches and free pages reclaimed")
+
+def test_user_cache():
+    """Test the user cache serves repeat reads and is invalidated on writes"""
+    print("\nTesting user cache...")
+    from cache import TTLCache
+    
+    db.user_cache.clear()
+    db.get_user(12345)
+    user = db.get_user(12345)
+    stats = db.user_cache_stats()
+    assert stats['misses'] == 1 and stats['hits'] == 1
+    
+    # Callers get copies, so mutating one can't poison the cache
+    user['subscription_tier'] = 'bogus'
+    assert db.get_user(12345)['subscription_tier'] == config.TIER_FREE
+    
+    # Writes invalidate
+    db.update_user_subscription(12345, config.TIER_PRO)
+    assert db.get_user(12345)['subscription_tier'] == config.TIER_PRO
+    db.update_user_subscription(12345, config.TIER_FREE)
+    assert db.get_user(12345)['subscription_tier'] == config.TIER_FREE
+    
+    # A write that commits between get_user's SELECT and its cache fill wins
+    cache_set = db.user_cache.set
+    def set_after_write(key, value, generation=None):
+        db.user_cache.set = cache_set
+        db.update_user_subscription(12345, config.TIER_PRO)  # the "concurrent" writer
+        cache_set(key, value, generation)
+    db.user_cache.invalidate(12345)
+    db.user_cache.set = set_after_write
+    assert db.get_user(12345)['subscription_tier'] == config.TIER_FREE  # read before the write
+    assert db.get_user(12345)['subscription_tier'] == config.TIER_PRO  # the stale row wasn't cached
+    db.update_user_subscription(12345, config.TIER_FREE)
+    
+    # LRU eviction and TTL expiry
+    now = [0.0]
+    cache = TTLCache(max_size=2, ttl=10, clock=lambda: now[0])
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.get('b') is None and cache.get('a') == 1
+    now[0] = 11
+    assert cache.get('a') is None
+    print(f"[OK] User cache works ({db.user_cache_stats()['hits']} hits)")
+
+def test_async_db():
+    """Test async data access runs concurrently off the event loop"""
+    print("\nTesting async database access...")
+    import asyncio
+    import async_db as adb
+    
+    async def exercise():
+        # Writes are serialized on the writer thread, reads fan out
+        ids = await asyncio.gather(*[
+            adb.create_invoice(12345, f"Async Client {i}", 100 + i, date.today())
+            for i in range(10)
+        ])
+        assert len(set(ids)) == 10
+        
+        invoices = await asyncio.gather(*[adb.get_invoice(i) for i in ids])
+        assert all(inv['user_id'] == 12345 for inv in invoices)
+        
+        assert await adb.mark_invoice_paid(ids[0], 12345)
+        stats, user = await asyncio.gather(
+            adb.get_revenue_stats(12345),
+            adb.get_user(12345)
+        )
+        assert stats['month_count'] > 0
+        assert user['telegram_id'] == 12345
+    
+    asyncio.run(exercise())
+    adb.close_db()
+    print("[OK] Async database access works")
+
+def test_reminder_query():
+    """Test the single-pass reminder query buckets Pro users' invoices only"""
+    print("\nTesting reminder query...")
+    today = date.today()
+    
+    db.create_user(777, "prouser", "Pro")
+    db.update_user_subscription(777, config.TIER_PRO)
+    ids = {
+        days: db.create_invoice(777, f"Due {days}", 100, today + timedelta(days=days))
+        for days in (-3, 0, 1, 2, 5, 10)
+    }
+    
+    groups = dict(db.get_reminder_invoices(today))
+    assert 12345 not in groups  # free tier users are filtered in SQL
+    
+    buckets = {inv['id']: (inv['bucket'], inv['days_until']) for inv in groups[777]}
+    assert buckets == {
+        ids[-3]: ('overdue', -3),
+        ids[0]: ('due_today', 0),
+        ids[1]: ('due_tomorrow', 1),
+        ids[5]: ('due_soon', 5),
+    }
+    print("[OK] Reminder query returns bucketed Pro invoices")
+
+class FakeBot:
+    """Local stand-in for telegram.Bot that records send timestamps"""
+    
+    def __init__(self, latency=0.01, fail_first_with=None):
+        import time
+        self.clock = time.monotonic
+        self.latency = latency
+        self.fail_first_with = fail_first_with
+        self.sent = []  # (timestamp, chat_id, text)
+        self.in_flight = 0
+        self.max_in_flight = 0
+    
+    async def send_message(self, chat_id, text, **kwargs):
+        import asyncio
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.fail_first_with is not None:
+                error, self.fail_first_with = self.fail_first_with, None
+                raise error
+            self.sent.append((self.clock(), chat_id, text))
+            await asyncio.sleep(self.latency)
+        finally:
+            self.in_flight -= 1
+
+def test_dispatcher():
+    """Test concurrent dispatch stays within global, per-chat and in-flight limits"""
+    print("\nTesting reminder dispatcher...")
+    import asyncio
+    from telegram.error import RetryAfter
+    from dispatch import Dispatcher
+    
+    global_rate, chat_rate, max_in_flight = 100, 20, 5
+    bot = FakeBot(latency=0.1, fail_first_with=RetryAfter(0.05))
+    messages = [(chat_id, f"msg {n}", {}) for n in range(3) for chat_id in range(20)]
+    
+    async def run():
+        dispatcher = Dispatcher(bot, global_rate=global_rate, per_chat_rate=chat_rate,
+                                max_in_flight=max_in_flight)
+        return await dispatcher.send_many(messages)
+    
+    delivered = asyncio.run(run())
+    assert all(delivered) and len(bot.sent) == len(messages)
+    assert bot.max_in_flight <= max_in_flight
+    
+    # Token bucket (burst 1): any n consecutive sends span at least (n-1)/rate seconds
+    slack = 0.005
+    times = [t for t, _, _ in bot.sent]
+    for i in range(len(times) - 1):
+        assert times[i + 1] - times[i] >= 1 / global_rate - slack
+    for chat_id in range(20):
+        chat_times = [t for t, c, _ in bot.sent if c == chat_id]
+        for a, b in zip(chat_times, chat_times[1:]):
+            assert b - a >= 1 / chat_rate - slack
+    
+    elapsed = times[-1] - times[0]
+    print(f"[OK] {len(times)} messages in {elapsed:.2f}s "
+          f"({len(times) / elapsed:.0f}/s, limit {global_rate}/s, "
+          f"max in flight {bot.max_in_flight})")
+
+def test_daily_reminders():
+    """Test the daily reminder run end to end against a fake bot"""
+    print("\nTesting daily reminders...")
+    import asyncio
+    import reminders
+    
+    db.create_invoice(777, "Second overdue", 50, date.today() - timedelta(days=1))
+    
+    bot = FakeBot(latency=0)
+    sent = asyncio.run(reminders.send_daily_reminders(bot))
+    assert sent == 1
+    assert [chat_id for _, chat_id, _ in bot.sent] == [777]
+    assert "OVERDUE" in bot.sent[0][2]
+    
+    # Every reminded invoice is logged, not just the last one per bucket
+    from connection import get_connection
+    logged = get_connection().execute('''
+        SELECT r.reminder_type FROM reminders r
+        JOIN invoices i ON i.id = r.invoice_id
+        WHERE i.user_id = 777
+        ORDER BY r.id
+    ''').fetchall()
+    assert [row[0] for row in logged] == ['overdue', 'overdue', 'due_today', 'due_tomorrow']
+    print("[OK] Daily reminders delivered and logged")
+    
+    # Rerunning on the same day is a no-op
+    bot = FakeBot(latency=0)
+    assert asyncio.run(reminders.send_daily_reminders(bot)) == 0
+    assert bot.sent == []
+    print("[OK] Same-day rerun is a no-op")
+
+def test_reminder_run_resume():
+    """Test a crashed reminder run resumes without double-sending"""
+    print("\nTesting reminder run resume...")
+    import asyncio
+    import reminders
+    
+    # A run for tomorrow's date, with two Pro users sent one per chunk
+    run_day = date.today() + timedelta(days=1)
+    db.create_user(778, "prouser2", "Pro2")
+    db.update_user_subscription(778, config.TIER_PRO)
+    db.create_invoice(778, "Other Pro Client", 80, run_day)
+    
+    class CrashingBot(FakeBot):
+        async def send_message(self, chat_id, text, **kwargs):
+            if self.sent:
+                raise RuntimeError("process killed mid-run")
+            await super().send_message(chat_id, text, **kwargs)
+    
+    original_batch, original_date = config.REMINDER_BATCH_SIZE, reminders.date
+    class FrozenDate(date):
+        @classmethod
+        def today(cls):
+            return run_day
+    config.REMINDER_BATCH_SIZE = 1
+    reminders.date = FrozenDate
+    try:
+        crashing = CrashingBot(latency=0)
+        try:
+            asyncio.run(reminders.send_daily_reminders(crashing))
+            assert False, "run should have crashed"
+        except RuntimeError:
+            pass
+        assert [chat_id for _, chat_id, _ in crashing.sent] == [777]
+        
+        # The restarted run only sends to the user it hadn't finished
+        bot = FakeBot(latency=0)
+        assert asyncio.run(reminders.send_daily_reminders(bot)) == 1
+        assert [chat_id for _, chat_id, _ in bot.sent] == [778]
+        
+        bot = FakeBot(latency=0)
+        assert asyncio.run(reminders.send_daily_reminders(bot)) == 0
+        assert bot.sent == []
+    finally:
+        config.REMINDER_BATCH_SIZE = original_batch
+        reminders.date = original_date
+    
+    # Logging the same reminder twice on one day is ignored
+    invoice_id = db.get_unpaid_invoices(778)[0]['id']
+    db.log_reminder(invoice_id, 'due_today', run_day)
+    from connection import get_connection
+    count = get_connection().execute(
+        'SELECT COUNT(*) FROM reminders WHERE invoice_id = ?', (invoice_id,)
+    ).fetchone()[0]
+    assert count == 1
+    print("[OK] Crashed run resumed without double-sending")
+
+def test_reminder_schedule():
+    """Test next_reminder_at: runs read only due invoices and escalation spaces out overdue ones"""
+    print("\nTesting reminder scheduling...")
+    import dates
+    from connection import get_connection
+    
+    policy = [(0, 1), (7, 3), (30, 7)]
+    today = date.today()
+    conn = get_connection()
+    for days in range(-40, 16):
+        due = today + timedelta(days=days)
+        sql_next, sql_stage = conn.execute(
+            f"SELECT {dates.next_reminder_sql(':after', policy, ':due')}, "
+            f"{dates.reminder_stage_sql(':days')}",
+            {'after': today, 'due': due, 'days': days}
+        ).fetchone()
+        assert sql_next == str(dates.next_reminder(due, today, policy)), days
+        assert sql_stage == dates.reminder_stage(days), days
+    
+    # A Pro user alone in the UTC+1 cohort, walked day by day through 50 daily runs
+    db.create_user(906, "schedule", "Schedule")
+    db.update_user_subscription(906, config.TIER_PRO)
+    db.update_user_timezone(906, 60)
+    original_policy = config.OVERDUE_REMINDER_INTERVALS
+    config.OVERDUE_REMINDER_INTERVALS = policy
+    try:
+        due = today + timedelta(days=5)
+        invoice_id = db.create_invoice(906, "Scheduled", 100, due)
+        reminded = []
+        for offset in range(51):
+            day = today + timedelta(days=offset)
+            run = db.start_reminder_run(day, 60)
+            groups = dict(db.get_reminder_invoices(day, run['id'], 60))
+            if 906 in groups:
+                reminded.append(groups[906][0]['days_until'])
+                db.record_reminder_run_users(run['id'], day, [(906, [])])
+            db.advance_reminders(run['id'], day, 60)
+            db.finish_reminder_run(run['id'])
+            if offset == 0:
+                assert db.get_invoice(invoice_id)['reminder_stage'] == dates.DUE_SOON
+    finally:
+        config.OVERDUE_REMINDER_INTERVALS = original_policy
+    assert reminded == [5, 4, 3, 1, 0, -1, -2, -3, -4, -5, -6, -7,
+                        -9, -12, -15, -18, -21, -24, -27, -30, -35, -42], reminded
+    assert db.get_invoice(invoice_id)['reminder_stage'] == dates.OVERDUE
+    
+    # A failed delivery leaves the invoice due for the next run
+    day = due + timedelta(days=52)
+    run = db.start_reminder_run(day, 60)
+    assert 906 in dict(db.get_reminder_invoices(day, run['id'], 60))
+    db.record_reminder_run_users(run['id'], day, [], failed=[906])
+    assert db.advance_reminders(run['id'], day, 60) == 0
+    assert db.get_invoice(invoice_id)['next_reminder_at'] <= str(day)
+    
+    # Paying clears the schedule
+    db.mark_invoice_paid(invoice_id, 906)
+    assert db.get_invoice(invoice_id)['next_reminder_at'] is None
+    assert 906 not in dict(db.get_reminder_invoices(day, tz_offset=60))
+    print(f"[OK] {len(reminded)} reminders over 50 runs, backing off once overdue")
+    
+    # A free user's overdue invoice is never scheduled, so runs neither read nor move it
+    db.create_user(909, "freeloader", "Free")
+    db.update_user_timezone(909, 180)
+    overdue_id = db.create_invoice(909, "Overdue", 100, today - timedelta(days=40))
+    assert db.get_invoice(overdue_id)['next_reminder_at'] is None
+    for offset in range(3):
+        day = today + timedelta(days=offset)
+        run = db.start_reminder_run(day, 180)
+        assert db.get_reminder_invoices(day, run['id'], 180) == []
+        assert db.advance_reminders(run['id'], day, 180) == 0
+        db.finish_reminder_run(run['id'])
+    assert db.get_invoice(overdue_id)['next_reminder_at'] is None
+    
+    # Upgrading schedules the user's unpaid invoices; downgrading clears them again
+    db.update_user_subscription(909, config.TIER_PRO)
+    assert db.get_invoice(overdue_id)['next_reminder_at'] is not None
+    assert 909 in dict(db.get_reminder_invoices(today + timedelta(days=7), tz_offset=180))
+    db.update_user_subscription(909, config.TIER_FREE)
+    assert db.get_invoice(overdue_id)['next_reminder_at'] is None
+    print("[OK] Free users' invoices stay out of reminder runs until they upgrade")
+
+def test_timezones():
+    """Test per-user offsets reach invoices and reminders go out per local-time cohort"""
+    print("\nTesting timezone cohorts...")
+    import asyncio
+    from datetime import datetime, time
+    import dates
+    import reminders
+    
+    assert dates.parse_tz_offset('UTC+5:30') == 330
+    assert dates.parse_tz_offset('-8') == -480
+    assert dates.parse_tz_offset('+0545') == 345
+    assert dates.parse_tz_offset('gmt') == 0
+    for bad in ('+15', '+5:20', 'tomorrow'):
+        try:
+            dates.parse_tz_offset(bad)
+            assert False, f"{bad!r} should be rejected"
+        except ValueError:
+            pass
+    assert dates.format_tz_offset(-210) == 'UTC-03:30'
+    
+    # The offset is copied onto existing and new invoices by triggers
+    db.update_user_timezone(777, 120)
+    assert db.get_user(777)['tz_offset'] == 120
+    invoice_id = db.create_invoice(777, "TZ Client", 40, date.today() - timedelta(days=2))
+    conn = db.get_connection()
+    offsets = {row[0] for row in conn.execute('SELECT tz_offset FROM invoices WHERE user_id = 777')}
+    assert offsets == {120}
+    
+    today = date.today()
+    assert 777 not in dict(db.get_reminder_invoices(today, tz_offset=0))
+    assert 777 in dict(db.get_reminder_invoices(today, tz_offset=120))
+    
+    # 06:30 UTC is 08:30 for UTC+2: too early. 07:00 UTC is 09:00 there: send
+    bot = FakeBot(latency=0)
+    early = datetime.combine(today, time(6, 30))
+    assert asyncio.run(reminders.send_due_reminders(bot, early)) == 0
+    pending = db.get_pending_reminder_cohorts(early)
+    assert 120 in pending and pending == sorted(pending, reverse=True)
+    assert set(pending) <= {row[0] for row in conn.execute(
+        "SELECT tz_offset FROM users WHERE subscription_tier = 'pro'")}
+    on_time = datetime.combine(today, time(7, 0))
+    assert asyncio.run(reminders.send_due_reminders(bot, on_time)) == 1
+    assert [chat_id for _, chat_id, _ in bot.sent] == [777]
+    assert 120 not in db.get_pending_reminder_cohorts(on_time)
+    assert asyncio.run(reminders.send_due_reminders(bot, on_time)) == 0  # cohort done today
+    
+    db.update_user_timezone(777, 0)
+    with db.transaction() as cursor:
+        cursor.execute('DELETE FROM reminders WHERE invoice_id = ?', (invoice_id,))
+        cursor.execute('DELETE FROM invoices WHERE id = ?', (invoice_id,))
+    print("[OK] Timezone cohort sent at its local reminder time, once")
+    
+    # An invoice whose user has no users row keeps the default offset
+    orphan = db.create_invoice(424242, "No user", 1, today)
+    assert db.get_invoice(orphan)['tz_offset'] == 0
+    db.delete_invoice(orphan, 424242)
+    print("[OK] Invoices without a user row keep UTC")
+
+def test_weekly_summary():
+    """Test the grouped weekly aggregate and its delivery to Pro users only"""
+    print("\nTesting weekly summary...")
+    import asyncio
+    import reminders
+    
+    today = date.today()
+    db.create_user(905, "weekly", "Weekly")
+    db.update_user_subscription(905, config.TIER_PRO)
+    paid_recent = db.create_invoice(905, "Paid this week", 100, today - timedelta(days=5))
+    paid_old = db.create_invoice(905, "Paid last month", 50, today - timedelta(days=40))
+    db.mark_invoice_paid(paid_recent, 905, today - timedelta(days=3))
+    db.mark_invoice_paid(paid_old, 905, today - timedelta(days=30))
+    # Today's payments belong to next week's summary; the first day of the week to this one only
+    paid_today = db.create_invoice(905, "Paid today", 7, today - timedelta(days=1))
+    paid_boundary = db.create_invoice(905, "Paid a week ago", 9, today - timedelta(days=10))
+    db.mark_invoice_paid(paid_today, 905, today)
+    db.mark_invoice_paid(paid_boundary, 905, today - timedelta(days=7))
+    db.create_invoice(905, "Overdue", 30, today - timedelta(days=2))
+    db.create_invoice(905, "Upcoming", 20, today + timedelta(days=9))
+    
+    # Page one user at a time to exercise the keyset walk
+    summaries, after = [], 0
+    while True:
+        page = db.get_weekly_summaries(today - timedelta(days=7), today, after, limit=1)
+        if not page:
+            break
+        summaries.extend(page)
+        after = page[-1]['user_id']
+    by_user = {summary['user_id']: summary for summary in summaries}
+    assert 12345 not in by_user  # free tier
+    assert [summary['user_id'] for summary in summaries] == sorted(by_user)
+    weekly = by_user[905]
+    assert (weekly['paid_total'], weekly['paid_count']) == (109, 2)
+    last_week = {summary['user_id']: summary for summary in db.get_weekly_summaries(
+        today - timedelta(days=14), today - timedelta(days=7))}[905]
+    assert (last_week['paid_total'], last_week['paid_count']) == (0, 0)
+    assert (weekly['outstanding_total'], weekly['outstanding_count']) == (50, 2)
+    assert (weekly['overdue_total'], weekly['overdue_count']) == (30, 1)
+    
+    bot = FakeBot(latency=0)
+    sent = asyncio.run(reminders.send_weekly_summary(bot, today))
+    assert sent == len(summaries)
+    text = {chat_id: text for _, chat_id, text in bot.sent}[905]
+    assert "$109.00" in text and "Overdue: $30.00" in text
+    
+    with db.transaction() as cursor:
+        cursor.execute('DELETE FROM invoices WHERE user_id = 905')
+    print(f"[OK] Weekly summaries sent to {sent} Pro users from one grouped query per batch")
+
+def test_scheduler():
+    """Test job slots, the job_runs claim, missed-run catch-up and overlap protection"""
+    print("\nTesting scheduler...")
+    import asyncio
+    from datetime import datetime
+    from scheduler import Job, Scheduler
+    
+    # Thursday 2026-01-15 08:30
+    now = datetime(2026, 1, 15, 8, 30)
+    daily = Job('d', None, hour=9)
+    assert daily.last_slot(now) == datetime(2026, 1, 14, 9, 0)
+    assert daily.next_slot(now) == datetime(2026, 1, 15, 9, 0)
+    weekly = Job('w', None, hour=9, weekday=0)
+    assert weekly.last_slot(now) == datetime(2026, 1, 12, 9, 0)
+    assert weekly.next_slot(now) == datetime(2026, 1, 19, 9, 0)
+    assert weekly.last_slot(datetime(2026, 1, 19, 9, 0)) == datetime(2026, 1, 19, 9, 0)
+    
+    slot = datetime(2026, 1, 15, 9, 0)
+    assert db.claim_job_run('test_job', slot, lease_seconds=3600)
+    assert not db.claim_job_run('test_job', slot, lease_seconds=3600)  # in progress
+    assert db.claim_job_run('test_job', slot, lease_seconds=0)  # lease expired: retry
+    db.finish_job_run('test_job', slot)
+    assert not db.claim_job_run('test_job', slot, lease_seconds=0)  # done for good
+    
+    async def run():
+        calls = []
+        release = asyncio.Event()
+        
+        async def job_fn(bot):
+            calls.append(bot)
+            await release.wait()
+        
+        # Bot comes up at 09:40; the 09:00 slot was missed and gets caught up
+        scheduler = Scheduler('bot', jitter=0, clock=lambda: datetime(2026, 1, 16, 9, 40))
+        job = scheduler.add_daily('catchup_job', job_fn, hour=9)
+        scheduler.start()
+        await asyncio.sleep(0.05)
+        assert calls == ['bot'] and job.running
+        
+        # A second trigger while the first run is still going is skipped
+        assert not await scheduler.run_job(job, datetime(2026, 1, 16, 9, 0))
+        release.set()
+        await asyncio.sleep(0.05)
+        assert not job.running
+        await scheduler.stop()
+        
+        # Restarting later the same day doesn't repeat the finished slot
+        again = Scheduler('bot', jitter=0, clock=lambda: datetime(2026, 1, 16, 10, 0))
+        again.add_daily('catchup_job', job_fn, hour=9)
+        again.start()
+        await asyncio.sleep(0.05)
+        await again.stop()
+        return calls
+    
+    assert len(asyncio.run(run())) == 1
+    print("[OK] Missed slot caught up once, overlapping run skipped")
+    
+    async def run_failing():
+        import async_db as adb
+        attempts = []
+        claim = adb.claim_job_run
+        
+        async def flaky_claim(*args):
+            if not attempts:
+                attempts.append('locked')
+                raise sqlite3.OperationalError('database is locked')
+            return await claim(*args)
+        
+        async def job_fn(bot):
+            attempts.append('run')
+            if attempts.count('run') == 1:
+                raise RuntimeError('send failed')
+        
+        # Catch-up claim fails, then the run itself fails once; both are retried
+        adb.claim_job_run = flaky_claim
+        try:
+            scheduler = Scheduler('bot', jitter=0, lease=0, clock=lambda: datetime(2026, 1, 17, 9, 5))
+            job = scheduler.add_daily('flaky_job', job_fn, hour=9)
+            scheduler.start()
+            await asyncio.sleep(0.1)
+            await scheduler.stop()
+        finally:
+            adb.claim_job_run = claim
+            adb.close_db()
+        return attempts, job
+    
+    attempts, job = asyncio.run(run_failing())
+    assert attempts == ['locked', 'run', 'run'] and job.failed_slot is None
+    assert not db.claim_job_run('flaky_job', datetime(2026, 1, 17, 9, 0), lease_seconds=0)  # finished
+    print("[OK] Failed catch-up and failed run retried after the lease")
+    
+    async def run_interval():
+        import async_db as adb
+        ticks = []
+        
+        async def tick(bot):
+            ticks.append(bot)
+        
+        scheduler = Scheduler('bot', jitter=0)
+        job = scheduler.add_interval('tick_job', tick, minutes=15)
+        try:
+            assert await scheduler.run_job(job, datetime(2026, 1, 18, 9, 0))
+            assert await scheduler.run_job(job, datetime(2026, 1, 18, 9, 15))
+        finally:
+            adb.close_db()
+        return ticks
+    
+    assert len(asyncio.run(run_interval())) == 2
+    with db.transaction() as cursor:
+        cursor.execute("SELECT COUNT(*) FROM job_runs WHERE name = 'tick_job'")
+        assert cursor.fetchone()[0] == 0
+    print("[OK] Interval jobs run without growing job_runs")
+
+def test_update_processor():
+    """Test updates run concurrently across chats but in order within a chat"""
+    print("\nTesting per-chat update processor...")
+    import asyncio
+    import time
+    from telegram import Update
+    from update_processor import PerChatUpdateProcessor
+    
+    def make_update(update_id, chat_id):
+        return Update.de_json({
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id, 'date': 0, 'text': 'hi',
+                'chat': {'id': chat_id, 'type': 'private'},
+            }
+        }, None)
+    
+    async def run():
+        processor = PerChatUpdateProcessor(4, max_pending=100)
+        await processor.initialize()
+        log = []
+        active = {'now': 0, 'max': 0}
+        
+        async def handle(update):
+            active['now'] += 1
+            active['max'] = max(active['max'], active['now'])
+            await asyncio.sleep(0.02)
+            log.append((update.effective_chat.id, update.update_id))
+            active['now'] -= 1
+        
+        updates = [make_update(i, chat_id=i % 5) for i in range(40)]
+        start = time.perf_counter()
+        await asyncio.gather(*[
+            processor.process_update(update, handle(update)) for update in updates
+        ])
+        await processor.shutdown()
+        return log, active['max'], time.perf_counter() - start
+    
+    log, max_active, elapsed = asyncio.run(run())
+    for chat_id in range(5):
+        ids = [update_id for chat, update_id in log if chat == chat_id]
+        assert ids == sorted(ids) and len(ids) == 8
+    assert max_active == 4  # 5 chats but at most 4 workers
+    assert elapsed < 40 * 0.02 / 2  # well under sequential time
+    print(f"[OK] 40 updates from 5 chats in {elapsed:.2f}s, ordered per chat")
+    
+    async def back_pressure():
+        from update_processor import BoundedUpdateQueue
+        queue = BoundedUpdateQueue(maxsize=2, max_pending=2)
+        queue.put_nowait(0)
+        queue.put_nowait(1)
+        assert [await queue.get(), await queue.get()] == [0, 1]
+        queue.put_nowait(2)
+        queue.put_nowait(3)
+        # Two updates taken and unfinished: the next get() waits, and the queue stays full
+        assert queue.full()
+        try:
+            await asyncio.wait_for(queue.get(), 0.05)
+            assert False, "a third update was handed out"
+        except asyncio.TimeoutError:
+            pass
+        queue.task_done()
+        return await asyncio.wait_for(queue.get(), 0.05)
+    
+    assert asyncio.run(back_pressure()) == 2
+    print("[OK] Update queue holds back intake while max_pending updates are unfinished")
+
+def test_persistence():
+    """Test conversation state and user_data survive a restart and ended ones are dropped"""
+    print("\nTesting conversation persistence...")
+    import asyncio
+    from persistence import SQLitePersistence
+    
+    async def first_run():
+        persistence = SQLitePersistence()
+        # What Application.update_persistence hands over after a few /new steps
+        await asyncio.gather(
+            persistence.update_conversation('new_invoice', (12345, 12345), 2),
+            persistence.update_conversation('new_invoice', (777, 777), 1),
+            persistence.update_user_data(12345, {'client_name': 'Acme', 'amount': 50.0}),
+            persistence.update_user_data(777, {'client_name': 'Beta'}),
+        )
+        await persistence._write_task
+        # 777 finishes (or cancels) before the next interval
+        await asyncio.gather(
+            persistence.update_conversation('new_invoice', (777, 777), None),
+            persistence.update_user_data(777, {}),
+        )
+        await persistence.flush()
+    
+    async def restart():
+        persistence = SQLitePersistence()
+        return (await persistence.get_conversations('new_invoice'),
+                await persistence.get_user_data())
+    
+    asyncio.run(first_run())
+    conversations, user_data = asyncio.run(restart())
+    assert conversations == {(12345, 12345): 2}
+    assert user_data == {12345: {'client_name': 'Acme', 'amount': 50.0}}
+    
+    conn = db.get_connection()
+    assert conn.execute('SELECT COUNT(*) FROM conversation_states').fetchone()[0] == 1
+    assert conn.execute('SELECT COUNT(*) FROM conversation_user_data').fetchone()[0] == 1
+    print("[OK] Active conversations restored, ended ones removed")
+
+def _traced_statements(fn, *args, **kwargs):
+    """Call a database.py function and return the SQL statements it ran"""
+    from connection import get_connection
+    statements = []
+    conn = get_connection()
+    conn.set_trace_callback(statements.append)
+    try:
+        fn(*args, **kwargs)
+    finally:
+        conn.set_trace_callback(None)
+    return [sql for sql in statements
+            if sql.split(None, 1)[0].upper() in ('SELECT', 'UPDATE', 'DELETE', 'INSERT', 'WITH')]
+
+# Plan rows that are meant to scan, per function
+ALLOWED_SCANS = {
+    # Maintenance check: recomputes every user's summaries from all invoices (live and
+    # archived) and compares them with every summary row
+    'check_user_stats': {'SCAN invoices', 'SCAN invoices_archive', 'SCAN (subquery-2)',
+                         'SCAN user_stats', 'SCAN user_monthly_revenue'},
+    # Maintenance rebuild: recomputes every user's summaries from all invoices
+    'rebuild_user_stats': {'SCAN invoices', 'SCAN invoices_archive', 'SCAN (subquery-2)'},
+    # Loaded once at startup by the persistence layer, which needs every user's data
+    'get_conversation_user_data': {'SCAN conversation_user_data'},
+    # Walks the recursive CTE's own rows, one per timezone cohort; users are only sought
+    'get_pending_reminder_cohorts': {'SCAN cohorts', 'SCAN c'},
+}
+
+def test_query_plans():
+    """Test that no database.py query falls back to a full table scan it isn't meant to do"""
+    print("\nTesting query plans...")
+    from connection import get_connection
+    
+    invoice_id = db.create_invoice(12345, "Plan Client", 10, date.today())
+    calls = [
+        (db.get_user, 12345),
+        (db.get_or_create_user, 12345),
+        (db.create_invoice, 12345, "Plan Client", 10, date.today()),
+        (db.create_invoices, 12345, [("Plan Client", 10, 'USD', date.today(), None)]),
+        (db.get_unpaid_invoices, 12345),
+        (db.get_all_invoices, 12345),
+        (db.get_unpaid_invoices_page, 12345),
+        (db.get_unpaid_invoices_page, 12345, (str(date.today()), 1)),
+        (db.get_unpaid_invoices_page, 12345, None, (str(date.today()), 1)),
+        (db.get_invoices_page, 12345, ('2024-01-01 00:00:00', 1)),
+        (lambda *args: list(db.iter_invoices(*args)), 12345, 'unpaid', date.today(), date.today()),
+        (db.get_invoice, invoice_id),
+        (db.count_unpaid_invoices, 12345),
+        (db.get_revenue_stats, 12345),
+        (db.get_reminder_invoices,),
+        (db.update_user_subscription, 12345, config.TIER_FREE),
+        (db.log_reminder, invoice_id, 'overdue'),
+        (db.log_reminders, [(invoice_id, 'overdue'), (invoice_id, 'due_today')]),
+        (db.start_reminder_run,),
+        (db.record_reminder_run_users, 1, date.today(), [(12345, [(invoice_id, 'overdue')])], [777]),
+        (db.finish_reminder_run, 1),
+        (db.advance_reminders, 1, date.today(), 60),
+        (db.claim_job_run, 'plan_job', date.today(), 60),
+        (db.finish_job_run, 'plan_job', date.today()),
+        (db.get_reminder_invoices, date.today(), 1),
+        (db.get_reminder_invoices, date.today(), 1, 330),
+        (db.get_pending_reminder_cohorts, date.today()),
+        (db.get_weekly_summaries, date.today(), date.today(), 100),
+        (db.update_user_timezone, 12345, 0),
+        (db.mark_invoice_paid, invoice_id, 12345),
+        (db.mark_invoices_paid, [invoice_id, invoice_id + 1], 12345),
+        (db.delete_invoice, invoice_id, 12345),
+        (db.save_conversation_state, [('new_invoice', '[1, 1]', 1), ('new_invoice', '[2, 2]', None)],
+         [(1, b'data'), (2, None)]),
+        (db.get_conversation_states, 'new_invoice'),
+        (db.archive_paid_invoices, 100000, 10),
+        (db.prune_reminders, 0, 10),
+        (db.get_reminder_counts, invoice_id),
+        (db.get_all_invoices, 908),
+        (db.get_invoices_page, 908, ('2024-01-01 00:00:00', 1)),
+        (lambda *args: list(db.iter_invoices(*args)), 908),
+        (db.check_user_stats,),
+        (db.rebuild_user_stats,),
+        (db.get_conversation_user_data,),
+    ]
+    
+    conn = get_connection()
+    for fn, *args in calls:
+        allowed = ALLOWED_SCANS.get(fn.__name__, set())
+        for sql in _traced_statements(fn, *args):
+            plan = conn.execute('EXPLAIN QUERY PLAN ' + sql).fetchall()
+            for row in plan:
+                detail = row[3]
+                # SCAN ... USING [COVERING] INDEX still reads the whole index
+                assert not detail.startswith('SCAN ') or detail in allowed, \
+                    f"{fn.__name__} does a full scan: {detail}\n  {sql.strip()}"
+    
+    print(f"[OK] {len(calls)} database functions use indexes")
+
 def cleanup_test_db():
     """Remove test database"""
     import os
+    db.close_db()
     if os.path.exists('data/test_paytrack.db'):
         os.remove('data/test_paytrack.db')
         print("\n[CLEAN] Test database removed")
+    for suffix in ('-wal', '-shm'):
+        if os.path.exists('data/test_paytrack.db' + suffix):
+            os.remove('data/test_paytrack.db' + suffix)
 
 def run_all_tests():
     """Run all tests"""
@@ -129,7 +1282,28 @@ def run_all_tests():
         test_invoice_listing()
         test_mark_paid()
         test_revenue_stats()
+        test_pagination()
+        test_due_buckets()
+        test_render()
+        test_export()
+        test_import()
+        test_user_stats()
+        test_archive()
+        test_retention()
         test_subscription_limits()
+        test_user_cache()
+        test_async_db()
+        test_reminder_query()
+        test_dispatcher()
+        test_daily_reminders()
+        test_reminder_run_resume()
+        test_reminder_schedule()
+        test_timezones()
+        test_weekly_summary()
+        test_scheduler()
+        test_update_processor()
+        test_persistence()
+        test_query_plans()
         
         print("\n" + "="*50)
         print("[OK] All tests passed!")
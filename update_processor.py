@@ -0,0 +1,80 @@
+"""Concurrent update processing with per-chat ordering for PayTrackBot"""
+import asyncio
+from typing import Any, Awaitable, Dict, Hashable, Optional
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Run updates from different chats concurrently, but each chat's updates one at a
+    time in arrival order so ConversationHandler state stays consistent"""
+
+    def __init__(self, max_concurrent_updates: int, max_pending: int = None):
+        # PTB takes the base semaphore before do_process_update, so a chat with a backlog
+        # would pin worker slots while it waits on its own lock. The base semaphore only
+        # bounds admitted updates; the worker limit is applied once the chat lock is held.
+        self._workers_limit = max_concurrent_updates
+        super().__init__(max(max_pending or 0, max_concurrent_updates))
+        self._workers: Optional[asyncio.Semaphore] = None
+        self._chats: Dict[Hashable, list] = {}  # key -> [lock, users]
+
+    @property
+    def max_concurrent_updates(self) -> int:
+        return self._workers_limit
+
+    @staticmethod
+    def _key(update: Any) -> Optional[Hashable]:
+        if isinstance(update, Update):
+            if update.effective_chat:
+                return update.effective_chat.id
+            if update.effective_user:
+                return ('user', update.effective_user.id)
+        return None
+
+    async def do_process_update(self, update: Any, coroutine: Awaitable[Any]) -> None:
+        key = self._key(update)
+        if key is None:
+            async with self._workers:
+                await coroutine
+            return
+
+        entry = self._chats.get(key)
+        if entry is None:
+            entry = self._chats[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+
+        try:
+            async with entry[0]:
+                async with self._workers:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chats[key]
+
+    async def initialize(self) -> None:
+        self._workers = asyncio.Semaphore(self._workers_limit)
+
+    async def shutdown(self) -> None:
+        self._chats.clear()
+
+class BoundedUpdateQueue(asyncio.Queue):
+    """Application.update_queue that stops handing out updates while max_pending of those
+    already handed out are unfinished. PTB's fetcher starts a task per update as soon as
+    it gets one and calls task_done() when it finishes, so without this nothing bounds the
+    pending tasks; with it the queue fills and put() holds back polling / webhook intake"""
+
+    def __init__(self, maxsize: int, max_pending: int):
+        super().__init__(maxsize)
+        self._pending = asyncio.Semaphore(max_pending)
+
+    async def get(self) -> Any:
+        await self._pending.acquire()
+        try:
+            return await super().get()
+        except BaseException:
+            self._pending.release()
+            raise
+
+    def task_done(self) -> None:
+        super().task_done()
+        self._pending.release()